@@ -4,3 +4,42 @@ Configuration and settings for our Flask application.
 
 DEBUG   = True
 DB_NAME = 'db.json'
+
+# The database backend: 'tinydb' keeps the data in the JSON file DB_NAME, 'sqlite' in the
+# SQLite file DB_SQLITE_NAME. When the SQLite file is created, the data from DB_NAME is
+# imported into it.
+DB_BACKEND     = 'tinydb'
+DB_SQLITE_NAME = 'db.sqlite'
+
+# The storage engine for the 'tinydb' backend: 'json' rewrites the whole DB file on every
+# change, 'log' appends each change to a log file, which is compacted into the DB file
+# every DB_LOG_COMPACT_AFTER changes, 'tables' keeps each table in a file of its own in the
+# directory DB_NAME + '.tables'.
+DB_STORAGE           = 'json'
+DB_LOG_COMPACT_AFTER = 1000
+
+# When changes are written to disk: 'always' before the request returns, 'interval' in the
+# background every DB_FLUSH_INTERVAL_MS milliseconds or after DB_FLUSH_AFTER_WRITES changes,
+# whichever comes first. 'never' is like 'interval', but doesn't wait for the written data
+# to reach the disk. Changes that haven't been written are lost if the server crashes.
+DB_FSYNC              = 'always'
+DB_FLUSH_INTERVAL_MS  = 100
+DB_FLUSH_AFTER_WRITES = 100
+
+# The change stream (/changes) keeps the CHANGES_RETAIN most recent changes, from which
+# clients can resume. An idle stream sends a keep-alive comment every CHANGES_KEEPALIVE_S
+# seconds. Streams are woken up by changes in their own process, only: If the server runs in
+# several processes (with the 'sqlite' backend), changes committed by another process are
+# only sent with the next keep-alive check, up to CHANGES_KEEPALIVE_S seconds later.
+CHANGES_RETAIN      = 10000
+CHANGES_KEEPALIVE_S = 15
+
+# The maximum number of resources, which can be created by one request to a bulk resource
+# (for example /tickets/_bulk)
+BULK_MAX_ITEMS = 10000
+
+# Resumable attachment uploads (/attachments/uploads) are sent in at most UPLOAD_MAX_CHUNKS
+# chunks. An upload session, which hasn't received a chunk for UPLOAD_SESSION_TTL_S seconds,
+# is removed when the next session is created.
+UPLOAD_MAX_CHUNKS    = 10000
+UPLOAD_SESSION_TTL_S = 86400
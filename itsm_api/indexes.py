@@ -0,0 +1,606 @@
+"""
+Secondary indexes for the TinyDB tables of the API.
+
+TinyDB itself does not know about indexes: Every search evaluates the query
+against every single document of a table. The classes in this module maintain
+in-memory lookup structures alongside the table data, so that lookups by the
+value of a field only cost as much as the number of matching documents.
+
+"""
+
+import bisect
+import collections
+import collections.abc
+import itertools
+
+from tinydb.database import Document, Table, _get_doc_id, _get_doc_ids
+
+
+# Tables take the next value of this counter as their generation whenever their data changes
+# (see IndexLookups.changed()). The counter is shared by all tables, so that no generation is
+# ever used twice within the process, not even when tables are opened again.
+_GENERATIONS = itertools.count(1)
+
+
+class HashIndex:
+    """
+    A hash index over a single field of the documents in a table.
+
+    Maps each value of the field to the set of IDs of the documents, which have
+    this value. Documents that don't have the field (or which have an
+    unhashable value for it) are not indexed.
+
+    """
+
+    def __init__(self, field):
+        """
+        Create an empty index over the specified field.
+        """
+        self.field    = field
+        self._entries = collections.defaultdict(set)
+
+    def keys_for(self, doc):
+        """
+        Return the index keys under which a document is to be stored.
+        """
+        if doc is None or self.field not in doc:
+            return []
+        value = doc[self.field]
+        if not isinstance(value, collections.abc.Hashable):
+            return []
+        return [value]
+
+    def check(self, doc_id, doc):
+        """
+        Raise ValueError if the document cannot be added to the index.
+
+        The plain hash index accepts any document.
+
+        """
+
+    def check_all(self, id_doc_pairs):
+        """
+        Raise ValueError if any of the (doc_id, doc) pairs cannot be added.
+        """
+        for doc_id, doc in id_doc_pairs:
+            self.check(doc_id, doc)
+
+    def add(self, doc_id, doc):
+        """
+        Add a document to the index.
+        """
+        for key in self.keys_for(doc):
+            self._entries[key].add(doc_id)
+
+    def discard(self, doc_id, doc):
+        """
+        Remove a document from the index.
+
+        The document needs to be passed in as it was when it was added, so that
+        we know under which keys it was stored.
+
+        """
+        for key in self.keys_for(doc):
+            doc_ids = self._entries.get(key)
+            if doc_ids is not None:
+                doc_ids.discard(doc_id)
+                if not doc_ids:
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Remove all entries from the index.
+        """
+        self._entries.clear()
+
+    def lookup(self, value):
+        """
+        Return the set of IDs of all documents with the specified value.
+        """
+        return frozenset(self._entries.get(value, ()))
+
+
+class UniqueIndex(HashIndex):
+    """
+    A hash index, which enforces that no two documents have the same value.
+
+    Documents are only ever stored under a single key, so a lookup finds at most
+    one document.
+
+    """
+
+    def check(self, doc_id, doc):
+        """
+        Raise ValueError if another document has the same value already.
+        """
+        for key in self.keys_for(doc):
+            if self._entries.get(key, {doc_id}) != {doc_id}:
+                raise ValueError(f"duplicate value '{key}' for unique field '{self.field}'")
+
+    def check_all(self, id_doc_pairs):
+        """
+        Raise ValueError if any pair clashes with the index or with another pair.
+        """
+        super().check_all(id_doc_pairs)
+        seen = {}
+        for doc_id, doc in id_doc_pairs:
+            for key in self.keys_for(doc):
+                if key in seen and seen[key] != doc_id:
+                    raise ValueError(f"duplicate value '{key}' for unique field "
+                                     f"'{self.field}'")
+                seen[key] = doc_id
+
+
+class InvertedIndex(HashIndex):
+    """
+    An index over a field with a list of values.
+
+    Each document is stored under every one of the values in its list. A lookup
+    for a single value therefore finds all documents that contain this value.
+
+    A normalization function may be specified, which is applied to the stored
+    values as well as the values we look up, for example to make lookups case
+    insensitive.
+
+    """
+
+    def __init__(self, field, normalize=None):
+        """
+        Create an empty index over the list field, with an optional normalization.
+        """
+        super().__init__(field)
+        self.normalize = normalize or (lambda value: value)
+
+    def keys_for(self, doc):
+        """
+        Return the normalized values of the document's list.
+        """
+        if doc is None or not isinstance(doc.get(self.field), list):
+            return []
+        return [self.normalize(value) for value in doc[self.field]
+                if isinstance(value, collections.abc.Hashable)]
+
+    def lookup(self, value):
+        """
+        Return the set of IDs of all documents, which contain the value.
+        """
+        return super().lookup(self.normalize(value))
+
+
+class SortedIndex(HashIndex):
+    """
+    A hash index, which also keeps the values of the field in sorted order.
+
+    In addition to lookups by value, it finds the documents whose value is
+    equal to or greater than a given one, at a cost that depends on the number
+    of documents found rather than the size of the table. This is meant for
+    fields with ISO 8601 timestamps, which sort in chronological order. Only
+    string values are indexed.
+
+    """
+
+    def __init__(self, field):
+        """
+        Create an empty index over the specified field.
+        """
+        super().__init__(field)
+        self._keys = []
+
+    def keys_for(self, doc):
+        """
+        Return the value of the document's field, if it's a string.
+        """
+        return [key for key in super().keys_for(doc) if isinstance(key, str)]
+
+    def add(self, doc_id, doc):
+        """
+        Add a document to the index.
+        """
+        for key in self.keys_for(doc):
+            if key not in self._entries:
+                bisect.insort(self._keys, key)
+        super().add(doc_id, doc)
+
+    def discard(self, doc_id, doc):
+        """
+        Remove a document from the index.
+        """
+        super().discard(doc_id, doc)
+        for key in self.keys_for(doc):
+            pos = bisect.bisect_left(self._keys, key)
+            if key not in self._entries and pos < len(self._keys) and self._keys[pos] == key:
+                del self._keys[pos]
+
+    def clear(self):
+        """
+        Remove all entries from the index.
+        """
+        super().clear()
+        self._keys.clear()
+
+    def lookup_from(self, value):
+        """
+        Return the set of IDs of all documents with the specified value or a greater one.
+        """
+        start = bisect.bisect_left(self._keys, value)
+        return frozenset().union(*(self._entries[key]
+                                   for key in itertools.islice(self._keys, start, None)))
+
+
+class AssociationIndex(HashIndex):
+    """
+    A bidirectional index over a pair of fields.
+
+    This is meant for tables that associate two kinds of entities with each
+    other, with each document holding the IDs of two associated entities. The
+    index answers whether two entities are associated, and which entities are
+    associated with a given one (in either direction), without looking at any
+    unrelated documents.
+
+    """
+
+    def __init__(self, first, second):
+        """
+        Create an empty index over the pair of fields.
+        """
+        super().__init__((first, second))
+        # For each of the two fields: Maps a value to the set of values of the other field
+        # that it is associated with.
+        self._partners = {first : collections.defaultdict(set),
+                          second : collections.defaultdict(set)}
+
+    def keys_for(self, doc):
+        """
+        Return the pair of values of the document as index key.
+        """
+        first, second = self.field
+        if doc is None or first not in doc or second not in doc:
+            return []
+        return [(doc[first], doc[second])]
+
+    def add(self, doc_id, doc):
+        """
+        Add a document to the index.
+        """
+        super().add(doc_id, doc)
+        first, second = self.field
+        for first_value, second_value in self.keys_for(doc):
+            self._partners[first][first_value].add(second_value)
+            self._partners[second][second_value].add(first_value)
+
+    def discard(self, doc_id, doc):
+        """
+        Remove a document from the index.
+        """
+        super().discard(doc_id, doc)
+        first, second = self.field
+        for key in self.keys_for(doc):
+            if key in self._entries:
+                # Some other document still stores the same association
+                continue
+            first_value, second_value = key
+            for field, value, partner in [(first, first_value, second_value),
+                                          (second, second_value, first_value)]:
+                partners = self._partners[field][value]
+                partners.discard(partner)
+                if not partners:
+                    del self._partners[field][value]
+
+    def clear(self):
+        """
+        Remove all entries from the index.
+        """
+        super().clear()
+        for partners in self._partners.values():
+            partners.clear()
+
+    def contains(self, **pair):
+        """
+        Return True if the two specified values are associated with each other.
+
+        Both fields of the index need to be specified as keyword arguments.
+
+        """
+        first, second = self.field
+        return (pair[first], pair[second]) in self._entries
+
+    def associated(self, field, value):
+        """
+        Return the set of values of the other field associated with the value.
+
+        For example, for an index over ('customer_id', 'user_id'), this returns
+        the IDs of all customers of user 123:
+
+            index.associated('user_id', 123)
+
+        """
+        return frozenset(self._partners[field].get(value, ()))
+
+
+class IndexLookups:
+    """
+    A mixin for tables with indexes, which provides lookups via those indexes.
+
+    The class using this mixin needs to provide the indexes in a dictionary
+    'indexes', keyed by the indexed field, as well as a 'get_multiple()' method
+    to retrieve documents by their IDs.
+
+    The mixin also keeps the 'generation' of the table, which changes whenever
+    the data of the table has changed. The class using this mixin needs to
+    call changed() once a change is visible to readers.
+
+    """
+
+    generation = 0
+    indexes    = {}   # replaced by the class using this mixin
+
+    def get_multiple(self, doc_ids):
+        """
+        Return the documents with the specified IDs, in the order given.
+        """
+        raise NotImplementedError("To be overridden!")
+
+    def changed(self):
+        """
+        Move the table to a new generation, after its data has changed.
+        """
+        self.generation = next(_GENERATIONS)
+
+    def is_indexed(self, field):
+        """
+        Return True if there is an index for the specified field.
+        """
+        return field in self.indexes
+
+    def search_by(self, **fields):
+        """
+        Return all documents whose fields have the specified values.
+
+        Only indexed fields may be specified. If more than one field is given
+        then the documents need to match all of them. The documents are
+        returned in the order of their IDs.
+
+        """
+        id_sets = sorted((self.indexes[field].lookup(value)
+                          for field, value in fields.items()), key=len)
+        doc_ids = id_sets[0].intersection(*id_sets[1:])
+        if not doc_ids:
+            return []
+        return self.get_multiple(sorted(doc_ids))
+
+    def get_by(self, **fields):
+        """
+        Return the first document whose fields have the specified values.
+
+        Returns None if there is no such document.
+
+        """
+        docs = self.search_by(**fields)
+        return docs[0] if docs else None
+
+
+class IndexedTable(IndexLookups, Table):
+    """
+    A TinyDB table, which keeps a number of indexes up to date.
+
+    The indexes are built when the table is opened, and are maintained on any
+    insert, update or removal of documents through this table object.
+
+    Use this class via the 'table_class' option of TinyDB. The indexes for a
+    table are passed in via the 'indexes' option when the table is opened:
+
+        db     = TinyDB(fname, table_class=IndexedTable)
+        table  = db.table('comments', indexes=[HashIndex('ticket_id')])
+        result = table.search_by(ticket_id=123)
+
+    """
+
+    def __init__(self, storage, name, indexes=(), **kwargs):
+        """
+        Open the table and build its indexes from the stored documents.
+        """
+        super().__init__(storage, name, **kwargs)
+        self.indexes = {index.field : index for index in indexes}
+        self.rebuild_indexes()
+
+    def rebuild_indexes(self, generation=None):
+        """
+        Build all indexes from scratch, based on the current table data.
+
+        This happens whenever the table data may have changed behind our back,
+        so the table also moves to a new generation. If the data is known to
+        be that of an earlier generation, then that generation may be passed
+        in to go back to.
+
+        """
+        for index in self.indexes.values():
+            index.clear()
+        for doc_id, doc in self._read().items():
+            self._index_doc(doc_id, doc)
+        if generation is None:
+            self.changed()
+        else:
+            self.generation = generation
+
+    def _check_doc(self, doc_id, doc):
+        for index in self.indexes.values():
+            index.check(doc_id, doc)
+
+    def _check_multiple(self, id_doc_pairs):
+        for index in self.indexes.values():
+            index.check_all(id_doc_pairs)
+
+    def _index_doc(self, doc_id, doc):
+        for index in self.indexes.values():
+            index.add(doc_id, doc)
+
+    def _unindex_doc(self, doc_id, doc):
+        for index in self.indexes.values():
+            index.discard(doc_id, doc)
+
+    def _raw_table(self):
+        """
+        Return the table data as it is stored.
+
+        Unlike _read(), this doesn't create a Document for every document of
+        the table. The document IDs may be strings or integers, depending on
+        whether the table was last read from disk or written by TinyDB.
+
+        """
+        # The table's storage is a proxy for just this table, we need the storage behind it
+        raw_data = self._storage._storage.read() or {}  # pylint: disable=protected-access
+        return raw_data.get(self.name, {})
+
+    def _hint_written(self, doc_ids):
+        """
+        Tell the storage which documents are about to be written (None for all).
+
+        Storages that support it can then look at just those documents, rather
+        than comparing the whole table to find the changes.
+
+        """
+        hint_written = getattr(self._storage._storage,  # pylint: disable=protected-access
+                               "hint_written", None)
+        if hint_written is not None:
+            hint_written(self.name, doc_ids)
+
+    def _get_next_id(self):
+        # Every insert takes the IDs of its new documents from here
+        doc_id = super()._get_next_id()
+        self._hint_written([doc_id])
+        return doc_id
+
+    def __len__(self):
+        # TinyDB's version creates a Document for every document of the table, just to
+        # count them
+        return len(self._raw_table())
+
+    def doc_ids(self):
+        """
+        Return the IDs of all documents of the table, in ascending order.
+        """
+        return sorted(int(doc_id) for doc_id in self._raw_table())
+
+    def get_multiple(self, doc_ids):
+        """
+        Return the documents with the specified IDs, in the order given.
+
+        IDs of documents that don't exist are skipped. Only the requested
+        documents are turned into Documents, so the cost depends on the number
+        of IDs rather than the size of the table.
+
+        """
+        raw_table = self._raw_table()
+        docs      = []
+        for doc_id in doc_ids:
+            doc = raw_table.get(doc_id)
+            if doc is None:
+                doc = raw_table.get(str(doc_id))
+            if doc is not None:
+                docs.append(Document(doc, doc_id))
+        return docs
+
+    def get(self, cond=None, doc_id=None, eid=None):
+        """
+        Return the document with the specified ID or the first matching one.
+
+        Returns None if there is no such document. Unlike TinyDB's version, a
+        lookup by ID doesn't create a Document for every document of the table.
+
+        """
+        doc_id = _get_doc_id(doc_id, eid)
+        if doc_id is None:
+            return super().get(cond)
+        docs = self.get_multiple([doc_id])
+        return docs[0] if docs else None
+
+    def contains(self, cond=None, doc_ids=None, eids=None):
+        """
+        Return True if a document matches the query, or has one of the IDs.
+        """
+        doc_ids = _get_doc_ids(doc_ids, eids)
+        if doc_ids is None:
+            return super().contains(cond)
+        return bool(self.get_multiple(doc_ids))
+
+    def insert(self, document):
+        """
+        Insert a document, after checking it against the indexes.
+        """
+        # A new document can't be in conflict with itself, so any not yet used ID will do
+        # for the check.
+        self._check_doc(None, document)
+        doc_id = super().insert(document)
+        self._index_doc(doc_id, document)
+        self.changed()
+        return doc_id
+
+    def insert_multiple(self, documents):
+        """
+        Insert several documents, after checking them against the indexes.
+        """
+        # We may get an iterator for the documents, but need to access them twice.
+        documents = list(documents)
+        # The new documents don't have IDs yet, but need distinct ones for the check.
+        self._check_multiple([(-i, doc) for i, doc in enumerate(documents, 1)])
+        doc_ids   = super().insert_multiple(documents)
+        for doc_id, doc in zip(doc_ids, documents):
+            self._index_doc(doc_id, doc)
+        self.changed()
+        return doc_ids
+
+    def process_elements(self, func, cond=None, doc_ids=None, eids=None):
+        """
+        Update or remove documents, keeping the indexes in line with them.
+        """
+        # All updates and removals go through here. We remove the document from the indexes
+        # before the change and add it back afterwards (unless it was removed).
+        # A violated constraint raises an exception before anything is written.
+        def indexed_func(data, doc_id):
+            self._hint_written([doc_id])
+            old_doc = dict(data[doc_id]) if doc_id in data else None
+            func(data, doc_id)
+            new_doc = data.get(doc_id)
+            self._check_doc(doc_id, new_doc)
+            self._unindex_doc(doc_id, old_doc)
+            self._index_doc(doc_id, new_doc)
+
+        try:
+            res = super().process_elements(indexed_func, cond, doc_ids, eids)
+            self.changed()
+            return res
+        except ValueError:
+            # Documents processed before the failing one have been re-indexed already, but
+            # they were never written. Bring the indexes back in line with the stored data,
+            # which is still that of the current generation.
+            self.rebuild_indexes(self.generation)
+            raise
+
+    def write_back(self, documents, doc_ids=None, eids=None):
+        """
+        Replace documents, keeping the indexes in line with them.
+        """
+        doc_ids = _get_doc_ids(doc_ids, eids)
+        if doc_ids is None:
+            doc_ids = [doc.doc_id for doc in documents]
+        # The parent class consumes the list of documents, so we need to keep a copy
+        old_data = self._read()
+        new_docs = list(documents)
+        self._check_multiple(list(zip(doc_ids, new_docs)))
+        self._hint_written(doc_ids)
+        res      = super().write_back(documents, doc_ids=doc_ids)
+        for doc_id, doc in zip(doc_ids, new_docs):
+            self._unindex_doc(doc_id, old_data.get(doc_id))
+            self._index_doc(doc_id, doc)
+        self.changed()
+        return res
+
+    def purge(self):
+        """
+        Remove all documents, and clear the indexes.
+        """
+        self._hint_written(None)
+        super().purge()
+        for index in self.indexes.values():
+            index.clear()
+        self.changed()
@@ -0,0 +1,606 @@
+"""
+An SQLite backend for the database of the API.
+
+The tables in this module offer the subset of the TinyDB table interface,
+which is used by the resources of the API, so that they can be used in place
+of TinyDB tables without any change to the resources. Each document is stored
+as JSON text in a row, with the document ID as the row's primary key.
+
+The indexes, which are specified for a table (see 'itsm_api.indexes') are
+implemented as real SQLite indexes:
+
+* HashIndex, UniqueIndex, SortedIndex: An (unique) index on the JSON field
+  of the document. Since SQLite indexes are sorted, they all support range
+  lookups.
+* InvertedIndex: A separate table holding one row per (normalized) value in
+  the list field of each document.
+* AssociationIndex: Indexes on both fields of the pair.
+
+The database is opened in WAL journal mode. Each thread gets its own
+connection to the database. The 'synchronous' setting of the connections
+determines how often SQLite waits for data to reach the disk.
+
+The generations of the tables (see IndexLookups) are kept in the database
+itself, in the '_generations' table, so that several processes can share
+the database: A write in one process moves the table to a new generation in
+all of them.
+
+"""
+
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from tinydb.database import Document
+
+from itsm_api.indexes import AssociationIndex, IndexLookups, InvertedIndex, UniqueIndex
+
+
+# Documents are fetched in batches of this many IDs, to stay below SQLite's limit for the
+# number of parameters in a single statement.
+_MAX_IDS_PER_QUERY = 500
+
+# The table, which holds the generation of each table. The row with the empty name holds a
+# random number, which identifies the database (see SQLiteDB.epoch).
+_GENERATIONS_TABLE = "_generations"
+
+
+def _field_expr(field):
+    """
+    Return the SQL expression, which extracts a top-level field from a document.
+
+    The expression needs to be exactly the same in the index definition and in
+    any query that should use the index, so the field name is rendered into the
+    expression, rather than passed as a parameter.
+
+    """
+    if not re.fullmatch(r"\w+", field):
+        raise ValueError(f"invalid field name for index '{field}'")
+    return f"json_extract(doc, '$.{field}')"
+
+
+class SQLiteDB:
+    """
+    An SQLite database, with a connection for each thread.
+
+    Provides 'table()' and 'close()', like TinyDB does.
+
+    """
+
+    def __init__(self, path, synchronous="NORMAL"):
+        """
+        Open the database in the specified file, with the given 'synchronous' setting.
+        """
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"invalid synchronous setting '{synchronous}'")
+        self.path         = path
+        self.synchronous  = synchronous
+        self._local       = threading.local()
+        self._connections = []
+        self._lock        = threading.Lock()
+        self.connection().execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{_GENERATIONS_TABLE}" '
+                         f'(name TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+            conn.execute(f'INSERT OR IGNORE INTO "{_GENERATIONS_TABLE}" VALUES (\'\', ?)',
+                         (int.from_bytes(os.urandom(7), "big"),))
+            epoch = conn.execute(f'SELECT generation FROM "{_GENERATIONS_TABLE}" '
+                                 f'WHERE name = \'\'').fetchone()[0]
+        # Generations are only meaningful for this database. The epoch stays the same when
+        # the database is opened again, by this or another process.
+        self.epoch = f"{epoch:014x}"
+
+    def connection(self):
+        """
+        Return the connection of the current thread, opening it if necessary.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # We manage transactions ourselves (see transaction()), hence no automatic
+            # transactions via the isolation level. The connections are all closed from
+            # whichever thread calls close(), so they can't be restricted to their thread.
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn  = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the enclosed block in a write transaction.
+
+        Transactions may be nested, in which case only the outermost one
+        commits. If an exception is raised in the block then all changes are
+        rolled back. The tables changed in the transaction move to a new
+        generation (see IndexLookups), which is committed together with the
+        changes.
+
+        """
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth   = 1
+        self._local.changed = set()
+        try:
+            yield conn
+            conn.executemany(f'INSERT INTO "{_GENERATIONS_TABLE}" VALUES (?, 1) '
+                             f'ON CONFLICT (name) DO UPDATE SET generation = generation + 1',
+                             [(table.name,) for table in self._local.changed])
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def mark_changed(self, table):
+        """
+        Have a table move to a new generation at the end of the current transaction.
+        """
+        self._local.changed.add(table)
+
+    def table(self, name, indexes=()):
+        """
+        Return a table, creating it in the database if necessary.
+        """
+        return SQLiteTable(self, name, indexes)
+
+    def import_json(self, path):
+        """
+        Import all tables of a TinyDB JSON file, keeping the document IDs.
+
+        This is used to populate a new database from an existing TinyDB file.
+        Indexes are built once the tables are opened.
+
+        """
+        with open(path, "r", encoding="utf-8") as json_file:
+            data = json.load(json_file)
+        with self.transaction() as conn:
+            for name, docs in data.items():
+                SQLiteTable.create(conn, name)
+                conn.executemany(f'INSERT INTO "{name}" (doc_id, doc) VALUES (?, ?)',
+                                 [(int(doc_id), json.dumps(doc))
+                                  for doc_id, doc in docs.items()])
+
+    def close(self):
+        """
+        Close the connections of all threads.
+        """
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class SQLiteHashIndex:
+    """
+    An SQLite index on a single field of the documents, which may be unique.
+    """
+
+    def __init__(self, table, spec):
+        """
+        Create the index for the table, as described by the index spec.
+        """
+        self.table  = table
+        self.field  = spec.field
+        self.unique = isinstance(spec, UniqueIndex)
+        self._expr  = _field_expr(spec.field)
+
+    def create(self, conn):
+        """
+        Create the index in the database if it doesn't exist yet.
+        """
+        unique = "UNIQUE" if self.unique else ""
+        conn.execute(f'CREATE {unique} INDEX IF NOT EXISTS "{self.table.name}__{self.field}" '
+                     f'ON "{self.table.name}" ({self._expr})')
+
+    def lookup(self, value):
+        """
+        Return the set of IDs of all documents with the specified value.
+        """
+        rows = self.table.db.connection().execute(
+                    f'SELECT doc_id FROM "{self.table.name}" WHERE {self._expr} = ?', (value,))
+        return frozenset(row[0] for row in rows)
+
+    def lookup_from(self, value):
+        """
+        Return the set of IDs of all documents with the specified value or a greater one.
+        """
+        rows = self.table.db.connection().execute(
+                    f'SELECT doc_id FROM "{self.table.name}" WHERE {self._expr} >= ?',
+                    (value,))
+        return frozenset(row[0] for row in rows)
+
+    def check(self, doc_id, doc):
+        """
+        Raise ValueError if the document clashes with another one.
+        """
+        if not self.unique or doc is None or self.field not in doc:
+            return
+        if self.lookup(doc[self.field]) - {doc_id}:
+            raise ValueError(f"duplicate value '{doc[self.field]}' for unique field "
+                             f"'{self.field}'")
+
+    def add(self, conn, doc_id, doc):
+        """
+        Nothing to do, SQLite maintains the index.
+        """
+
+    def discard(self, conn, doc_id):
+        """
+        Nothing to do, SQLite maintains the index.
+        """
+
+
+class SQLiteInvertedIndex:
+    """
+    An index over a list field, kept in a separate table.
+
+    The separate table has a row for each (normalized) value in the list of
+    each document.
+
+    """
+
+    def __init__(self, table, spec):
+        """
+        Create the index for the table, as described by the index spec.
+        """
+        self.table      = table
+        self.field      = spec.field
+        self.normalize  = spec.normalize
+        self.keys_for   = spec.keys_for
+        _field_expr(spec.field)   # just to validate the field name
+        self.index_name = f"{table.name}__{spec.field}"
+
+    def create(self, conn):
+        """
+        Create the index table, filling it if it doesn't exist yet.
+        """
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                              (self.index_name,)).fetchone()
+        if exists:
+            return
+        conn.execute(f'CREATE TABLE "{self.index_name}" (key, doc_id INTEGER NOT NULL)')
+        conn.execute(f'CREATE INDEX "{self.index_name}__key" ON "{self.index_name}" (key)')
+        conn.execute(f'CREATE INDEX "{self.index_name}__doc_id" '
+                     f'ON "{self.index_name}" (doc_id)')
+        for row in conn.execute(f'SELECT doc_id, doc FROM "{self.table.name}"').fetchall():
+            self.add(conn, row[0], json.loads(row[1]))
+
+    def lookup(self, value):
+        """
+        Return the set of IDs of all documents, which contain the value.
+        """
+        rows = self.table.db.connection().execute(
+                    f'SELECT doc_id FROM "{self.index_name}" WHERE key = ?',
+                    (self.normalize(value),))
+        return frozenset(row[0] for row in rows)
+
+    def check(self, doc_id, doc):
+        """
+        Nothing to check, documents may share values.
+        """
+
+    def add(self, conn, doc_id, doc):
+        """
+        Add the values of the document to the index table.
+        """
+        conn.executemany(f'INSERT INTO "{self.index_name}" (key, doc_id) VALUES (?, ?)',
+                         [(key, doc_id) for key in set(self.keys_for(doc))])
+
+    def discard(self, conn, doc_id):
+        """
+        Remove all values of the document from the index table.
+        """
+        conn.execute(f'DELETE FROM "{self.index_name}" WHERE doc_id = ?', (doc_id,))
+
+
+class SQLiteAssociationIndex:
+    """
+    Indexes over a pair of fields, to look up associations in both directions.
+    """
+
+    def __init__(self, table, spec):
+        """
+        Create the indexes for the table, as described by the index spec.
+        """
+        self.table  = table
+        self.field  = spec.field
+        self._exprs = {field : _field_expr(field) for field in spec.field}
+
+    def create(self, conn):
+        """
+        Create an index for each direction, if they don't exist yet.
+        """
+        first, second = self.field
+        for a, b in [(first, second), (second, first)]:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.table.name}__{a}__{b}" '
+                         f'ON "{self.table.name}" ({self._exprs[a]}, {self._exprs[b]})')
+
+    def lookup(self, key):
+        """
+        Return the set of IDs of all documents for the pair of values.
+        """
+        first, second = self.field
+        rows = self.table.db.connection().execute(
+                    f'SELECT doc_id FROM "{self.table.name}" '
+                    f'WHERE {self._exprs[first]} = ? AND {self._exprs[second]} = ?', key)
+        return frozenset(row[0] for row in rows)
+
+    def contains(self, **pair):
+        """
+        Return True if the two specified values are associated with each other.
+        """
+        return bool(self.lookup(tuple(pair[field] for field in self.field)))
+
+    def associated(self, field, value):
+        """
+        Return the set of values of the other field associated with the value.
+        """
+        other = [f for f in self.field if f != field][0]
+        rows  = self.table.db.connection().execute(
+                    f'SELECT DISTINCT {self._exprs[other]} FROM "{self.table.name}" '
+                    f'WHERE {self._exprs[field]} = ?', (value,))
+        return frozenset(row[0] for row in rows)
+
+    def check(self, doc_id, doc):
+        """
+        Nothing to check, the same association may be stored more than once.
+        """
+
+    def add(self, conn, doc_id, doc):
+        """
+        Nothing to do, SQLite maintains the index.
+        """
+
+    def discard(self, conn, doc_id):
+        """
+        Nothing to do, SQLite maintains the index.
+        """
+
+
+def _sqlite_index(table, spec):
+    """
+    Return the SQLite implementation for an index specification.
+    """
+    if isinstance(spec, AssociationIndex):
+        return SQLiteAssociationIndex(table, spec)
+    if isinstance(spec, InvertedIndex):
+        return SQLiteInvertedIndex(table, spec)
+    return SQLiteHashIndex(table, spec)
+
+
+class SQLiteTable(IndexLookups):
+    """
+    A table in an SQLite database, which behaves like a TinyDB table.
+    """
+
+    def __init__(self, db, name, indexes=()):
+        """
+        Open the table, creating it and its indexes if they don't exist yet.
+        """
+        self.db      = db
+        self.name    = name
+        self.indexes = {}
+        with db.transaction() as conn:
+            self.create(conn, name)
+            for spec in indexes:
+                index = _sqlite_index(self, spec)
+                index.create(conn)
+                self.indexes[index.field] = index
+
+    @property
+    def generation(self):
+        """
+        The generation of the table, as committed by any process using the database.
+        """
+        row = self.db.connection().execute(f'SELECT generation FROM "{_GENERATIONS_TABLE}" '
+                                           f'WHERE name = ?', (self.name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def changed(self):
+        """
+        Nothing to do, the generation is moved on by the transaction of the change.
+        """
+
+    @staticmethod
+    def create(conn, name):
+        """
+        Create the table in the database, if it doesn't exist yet.
+        """
+        # AUTOINCREMENT makes sure that IDs of removed documents are never used again.
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" '
+                     f'(doc_id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT NOT NULL)')
+
+    def _query(self, sql, params=()):
+        """
+        Run a query, returning a list of Documents for the resulting rows.
+        """
+        rows = self.db.connection().execute(sql, params)
+        return [Document(json.loads(doc), doc_id) for doc_id, doc in rows]
+
+    def clear_cache(self):
+        """
+        Nothing to do, there is no query cache.
+        """
+
+    def __len__(self):
+        row = self.db.connection().execute(f'SELECT COUNT(*) FROM "{self.name}"').fetchone()
+        return row[0]
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        """
+        Return all documents of the table.
+        """
+        return self._query(f'SELECT doc_id, doc FROM "{self.name}" ORDER BY doc_id')
+
+    def doc_ids(self):
+        """
+        Return the IDs of all documents of the table, in ascending order.
+        """
+        rows = self.db.connection().execute(f'SELECT doc_id FROM "{self.name}" '
+                                            f'ORDER BY doc_id')
+        return [row[0] for row in rows]
+
+    def search(self, cond):
+        """
+        Return all documents matching the TinyDB query.
+        """
+        return [doc for doc in self.all() if cond(doc)]
+
+    def get(self, cond=None, doc_id=None):
+        """
+        Return the document with the specified ID or the first matching one.
+
+        Returns None if there is no such document.
+
+        """
+        if doc_id is not None:
+            docs = self.get_multiple([doc_id])
+        else:
+            docs = self.search(cond)
+        return docs[0] if docs else None
+
+    def get_multiple(self, doc_ids):
+        """
+        Return the documents with the specified IDs, in the order given.
+
+        IDs of documents that don't exist are skipped.
+
+        """
+        doc_ids = list(doc_ids)
+        found   = {}
+        for i in range(0, len(doc_ids), _MAX_IDS_PER_QUERY):
+            chunk = doc_ids[i:i + _MAX_IDS_PER_QUERY]
+            for doc in self._query(f'SELECT doc_id, doc FROM "{self.name}" '
+                                   f'WHERE doc_id IN ({", ".join("?" * len(chunk))})',
+                                   chunk):
+                found[doc.doc_id] = doc
+        return [found[doc_id] for doc_id in doc_ids if doc_id in found]
+
+    def count(self, cond):
+        """
+        Return the number of documents matching the TinyDB query.
+        """
+        return len(self.search(cond))
+
+    def contains(self, cond=None, doc_ids=None):
+        """
+        Return True if a document matches the query, or has one of the IDs.
+        """
+        if doc_ids is not None:
+            return bool(self.get_multiple(doc_ids))
+        return self.get(cond) is not None
+
+    def _check_all(self, id_doc_pairs):
+        for index in self.indexes.values():
+            for doc_id, doc in id_doc_pairs:
+                index.check(doc_id, doc)
+
+    def _store(self, conn, doc_id, doc):
+        """
+        Write a document and update the indexes, which we maintain ourselves.
+        """
+        try:
+            if doc_id is None:
+                doc_id = conn.execute(f'INSERT INTO "{self.name}" (doc) VALUES (?)',
+                                      (json.dumps(doc),)).lastrowid
+            else:
+                conn.execute(f'UPDATE "{self.name}" SET doc = ? WHERE doc_id = ?',
+                             (json.dumps(doc), doc_id))
+        except sqlite3.IntegrityError as ex:
+            # A unique index was violated, which our check did not catch because another
+            # writer got in first.
+            raise ValueError(f"duplicate value for unique field: {str(ex)}") from ex
+        for index in self.indexes.values():
+            index.discard(conn, doc_id)
+            index.add(conn, doc_id, doc)
+        return doc_id
+
+    def insert(self, document):
+        """
+        Insert a new document, returning its ID.
+        """
+        return self.insert_multiple([document])[0]
+
+    def insert_multiple(self, documents):
+        """
+        Insert several documents in a single transaction, returning their IDs.
+        """
+        documents = [dict(doc) for doc in documents]
+        with self.db.transaction() as conn:
+            self.db.mark_changed(self)
+            # The new documents don't have IDs yet, but need distinct ones for the check.
+            self._check_all([(-i, doc) for i, doc in enumerate(documents, 1)])
+            return [self._store(conn, None, doc) for doc in documents]
+
+    def _doc_ids_for(self, cond, doc_ids):
+        if doc_ids is not None:
+            return list(doc_ids)
+        if cond is not None:
+            return [doc.doc_id for doc in self.search(cond)]
+        return [doc.doc_id for doc in self.all()]
+
+    def update(self, fields, cond=None, doc_ids=None):
+        """
+        Update the specified documents with the fields or an update function.
+
+        Returns the list of IDs of the updated documents.
+
+        """
+        with self.db.transaction() as conn:
+            self.db.mark_changed(self)
+            docs = self.get_multiple(self._doc_ids_for(cond, doc_ids))
+            for doc in docs:
+                if callable(fields):
+                    fields(doc)
+                else:
+                    doc.update(fields)
+                self._check_all([(doc.doc_id, doc)])
+                self._store(conn, doc.doc_id, doc)
+        return [doc.doc_id for doc in docs]
+
+    def remove(self, cond=None, doc_ids=None):
+        """
+        Remove the specified documents, returning the list of their IDs.
+        """
+        if cond is None and doc_ids is None:
+            raise RuntimeError('Use purge() to remove all documents')
+        with self.db.transaction() as conn:
+            self.db.mark_changed(self)
+            doc_ids = [doc.doc_id for doc in
+                       self.get_multiple(self._doc_ids_for(cond, doc_ids))]
+            for doc_id in doc_ids:
+                conn.execute(f'DELETE FROM "{self.name}" WHERE doc_id = ?', (doc_id,))
+                for index in self.indexes.values():
+                    index.discard(conn, doc_id)
+        return doc_ids
+
+    def purge(self):
+        """
+        Remove all documents from the table.
+        """
+        with self.db.transaction() as conn:
+            self.db.mark_changed(self)
+            for doc_id in [doc.doc_id for doc in self.all()]:
+                for index in self.indexes.values():
+                    index.discard(conn, doc_id)
+            conn.execute(f'DELETE FROM "{self.name}"')
@@ -0,0 +1,813 @@
+"""
+Storage engines for the TinyDB database of the API.
+
+TinyDB's default JSON storage serializes and rewrites the entire database
+file whenever a single document is inserted or updated. The storages in this
+module avoid this, so that the cost of a write depends on the size of the
+change, rather than the size of the database.
+
+Those storages also support transactions: All writes within a transaction are
+committed together, or not at all. Use them via the 'transaction()' method of
+TransactionalTinyDB.
+
+The WriteBehindMiddleware can be put in front of any of the storages, so that
+writes are done in the background, trading durability for latency.
+
+"""
+
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+
+from tinydb             import TinyDB
+from tinydb.middlewares import Middleware
+from tinydb.storages    import JSONStorage, Storage
+
+
+def _fsync_dir(path):
+    """
+    Make sure that renames and deletions of files in a directory are on disk.
+    """
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _write_json_file(path, data, fsync=True, **kwargs):
+    """
+    Write data to a JSON file.
+
+    With 'fsync', we make sure that the data is on disk when we return.
+    Otherwise, the operating system decides when to write it.
+
+    """
+    with open(path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file, **kwargs)
+        json_file.flush()
+        if fsync:
+            os.fsync(json_file.fileno())
+
+
+class JSONFileStorage(JSONStorage):
+    """
+    TinyDB's JSON storage, with the option to not fsync the file on writes.
+
+    Writes may be grouped in a transaction, in which case the data is only
+    written to the file at the end of the transaction, if no exception was
+    raised in it.
+
+    """
+
+    def __init__(self, path, fsync=True, **kwargs):
+        """
+        Open the JSON file, which is synced to disk on writes if 'fsync' is set.
+        """
+        super().__init__(path, **kwargs)
+        self.fsync    = fsync
+        self._lock    = threading.RLock()
+        self._depth   = 0      # nesting depth of transactions
+        self._pending = None   # the data written in the current transaction
+
+    def read(self):
+        """
+        Return the data in the file, or the data written in the current transaction.
+        """
+        with self._lock:
+            if self._pending is not None:
+                # TinyDB modifies the dictionary we hand out, so it gets a copy
+                return dict(self._pending)
+            return super().read()
+
+    def write(self, data):
+        """
+        Write the data to the file, without waiting for the disk unless 'fsync' is set.
+        """
+        with self._lock:
+            if self._depth:
+                self._pending = data
+            else:
+                self._write(data)
+
+    def _write(self, data):
+        if self.fsync:
+            super().write(data)
+            return
+        self._handle.seek(0)
+        self._handle.write(json.dumps(data, **self.kwargs))
+        self._handle.flush()
+        self._handle.truncate()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Write the data once, at the end of the enclosed block.
+
+        If an exception is raised in the block, then nothing is written. Other
+        threads are blocked from reading or writing for the duration of the
+        transaction.
+
+        """
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            self._depth = 1
+            try:
+                yield
+                if self._pending is not None:
+                    self._write(self._pending)
+            finally:
+                self._depth   = 0
+                self._pending = None
+
+
+class _WrittenDocs:
+    """
+    Keeps track of the documents written to each table since the last persist.
+
+    Tables announce the IDs of the documents they are about to write via
+    hint() (see IndexedTable). Hints are kept per thread, and are taken up by
+    the next write of that thread, which reports the tables it changed via
+    written(). A table that was changed without a hint is marked with None,
+    so that it's compared as a whole. The recorded IDs may include documents
+    that didn't change in the end, but never miss one that did.
+
+    """
+
+    def __init__(self):
+        """
+        Start with no written documents.
+        """
+        self.docs   = {}   # table name to a set of document IDs (as strings), or None
+        self._local = threading.local()
+
+    def hint(self, table, doc_ids):
+        """
+        Announce a write to the specified documents of a table (None for all).
+        """
+        hints = getattr(self._local, "hints", None)
+        if hints is None:
+            hints = self._local.hints = {}
+        if doc_ids is None:
+            hints[table] = None
+        elif hints.get(table, ()) is not None:
+            hints.setdefault(table, set()).update(str(doc_id) for doc_id in doc_ids)
+
+    def written(self, tables):
+        """
+        Record a write of the current thread, which changed the specified tables.
+        """
+        hints = getattr(self._local, "hints", None) or {}
+        self._local.hints = {}
+        self.merge({name : hints.get(name) for name in tables})
+
+    def merge(self, docs):
+        """
+        Add written documents, as returned by take().
+        """
+        for name, doc_ids in docs.items():
+            if doc_ids is None or (name in self.docs and self.docs[name] is None):
+                self.docs[name] = None
+            else:
+                self.docs.setdefault(name, set()).update(doc_ids)
+
+    def take(self):
+        """
+        Return the written documents and start over.
+        """
+        docs, self.docs = self.docs, {}
+        return docs
+
+
+def _get_doc(table, doc_id):
+    """
+    Return a document of a table by its ID as a string, or None if it's missing.
+    """
+    # Tables read from disk have string IDs, tables written by TinyDB have integer IDs
+    doc = table.get(doc_id)
+    if doc is None:
+        doc = table.get(int(doc_id))
+    return doc
+
+
+class TransactionalTinyDB(TinyDB):
+    """
+    A TinyDB database, which supports transactions if its storage does.
+    """
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group all writes within the enclosed block into a single commit.
+
+        If an exception is raised in the block, then none of the writes are
+        committed. If the storage doesn't support transactions then every
+        write is committed on its own, as usual.
+
+        """
+        storage_transaction = getattr(self.storage, "transaction", None)
+        if storage_transaction is None:
+            yield self
+            return
+        generations = {}
+        try:
+            with storage_transaction():
+                generations = {name : getattr(table, "generation", None)
+                               for name, table in self._table_cache.items()}
+                yield self
+        except BaseException:
+            # The storage has gone back to the state before the transaction. The tables that
+            # were written need to follow with their query caches and indexes. We can tell them
+            # by their generation, which changes on every write.
+            for name, table in self._table_cache.items():
+                generation = getattr(table, "generation", None)
+                if generation is not None and generation == generations.get(name):
+                    continue
+                table.clear_cache()
+                if hasattr(table, "rebuild_indexes"):
+                    table.rebuild_indexes()
+            raise
+
+
+class MemoryStateStorage(Storage):
+    """
+    Base class for storages, which keep the state of the database in memory.
+
+    The state is a dictionary of tables, with each table a dictionary of
+    document IDs to documents. The IDs are strings for tables that were read
+    from disk, and integers for tables that were written by TinyDB. On a
+    write, the tables that have changed are determined and handed to
+    '_persist()', which needs to be implemented by the child class. Tables
+    may announce which of their documents they write via hint_written(), so
+    that only those need to be compared.
+
+    Writes may be grouped in a transaction, in which case the changed tables
+    are only persisted at the end of the transaction, all in one go.
+
+    """
+
+    def __init__(self, fsync=True):
+        """
+        Create the storage with an empty state.
+        """
+        super().__init__()
+        self.fsync    = fsync   # whether to make sure that persisted data is on disk
+        self._data    = {}
+        self._lock    = threading.RLock()
+        self._depth   = 0    # nesting depth of transactions
+        self._pending = {}   # changed tables in the current transaction
+        self._written = _WrittenDocs()
+
+    def _persist(self, changed, written=None):
+        """
+        Write changes to disk.
+
+        The 'changed' dictionary maps the name of each changed table to the
+        table's previous state (None for a new table). The new state of the
+        table is in self._data (the table is missing there if it was dropped).
+
+        The optional 'written' dictionary maps the name of a changed table to
+        the IDs (as strings) of all documents that may have changed in it. If
+        a table is missing there, or maps to None, then any of its documents
+        may have changed.
+
+        """
+        raise NotImplementedError("To be overridden!")
+
+    def hint_written(self, table, doc_ids):
+        """
+        Announce that the current thread is about to write the specified documents.
+
+        Passing None for the document IDs means that any document of the table
+        may be written.
+
+        """
+        with self._lock:
+            self._written.hint(table, doc_ids)
+
+    def read(self):
+        """
+        Return the state of the database.
+        """
+        # We hand out a copy of the table lookup, so that TinyDB can replace tables in it
+        # without changing our state, which we need to compare against on the next write.
+        with self._lock:
+            return dict(self._data) if self._data else None
+
+    def write(self, data):
+        """
+        Replace the state of the database, persisting the tables that changed.
+        """
+        with self._lock:
+            old_data  = self._data
+            new_state = {}
+            changed   = {}
+            for name, table in data.items():
+                new_state[name] = table
+                # Tables that are still the same object as in our state haven't been written
+                # to by TinyDB.
+                if table is not old_data.get(name):
+                    changed[name] = old_data.get(name)
+            for name in old_data.keys() - data.keys():
+                changed[name] = old_data[name]
+            self._data = new_state
+            self._written.written(changed)
+
+            if self._depth:
+                # We only remember the state of each table before the transaction
+                for name, old_table in changed.items():
+                    self._pending.setdefault(name, old_table)
+            elif changed:
+                self._persist(changed, self._written.take())
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Persist all writes within the enclosed block together at the end.
+
+        If an exception is raised in the block, then the state in memory goes
+        back to what it was before the transaction and nothing is persisted.
+        Other threads are blocked from reading or writing for the duration of
+        the transaction.
+
+        """
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            start_state = self._data
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._data = start_state
+                raise
+            else:
+                if self._pending:
+                    self._persist(self._pending, self._written.take())
+            finally:
+                self._depth   = 0
+                self._pending = {}
+
+
+class LogStorage(MemoryStateStorage):
+    """
+    A storage, which appends every change to a log file.
+
+    The database consists of two files:
+
+    * The snapshot, which has the same format as a file written by TinyDB's
+      JSON storage. It holds the state of the database at the time of the
+      last compaction.
+
+    * The log, which is the snapshot file name with a '.log' suffix. It holds
+      one JSON record per line, each describing a change that was made since
+      the snapshot was written.
+
+    On a write, the changed tables are compared to their previous state, and
+    only records for the changed documents are appended to the log. If there
+    is more than one record for a write (or transaction), then they are all
+    written in a single 'batch' record. Every 'compact_after' records, the
+    state is written to a new snapshot and the log is cleared.
+
+    When the storage is opened, the log is replayed on top of the snapshot and
+    then compacted right away. An incomplete record at the end of the log (for
+    example after a crash during a write) is ignored.
+
+    """
+
+    LOG_SUFFIX = ".log"
+
+    def __init__(self, path, compact_after=1000, fsync=True, **kwargs):
+        """
+        Open the storage, using the snapshot in the specified file.
+
+        Any additional keyword arguments are passed on to json.dumps() when
+        writing a snapshot.
+
+        """
+        super().__init__(fsync)
+        self.path          = path
+        self.log_path      = path + self.LOG_SUFFIX
+        self.compact_after = compact_after
+        self._kwargs       = kwargs
+        self._data, num_records = self._load()
+        # The log stays open for the lifetime of the storage, it's closed in close()
+        self._log          = open(self.log_path, "a",  # pylint: disable=consider-using-with
+                                  encoding="utf-8")
+        self._num_records  = num_records
+        if num_records:
+            self.compact()
+
+    def _load(self):
+        """
+        Read the snapshot and replay the log on top of it.
+
+        Returns the resulting data and the number of replayed log records.
+
+        """
+        data = {}
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, "r", encoding="utf-8") as snapshot_file:
+                data = json.load(snapshot_file)
+
+        num_records = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record that was only partially written, we stop here
+                        break
+                    self._apply_record(data, record)
+                    num_records += 1
+        return data, num_records
+
+    @classmethod
+    def _apply_record(cls, data, record):
+        """
+        Apply a single log record to the data.
+        """
+        op    = record['op']
+        table = record.get('table')
+        if op == "set":
+            data.setdefault(table, {})[record['id']] = record['doc']
+        elif op == "del":
+            data.get(table, {}).pop(record['id'], None)
+        elif op == "table":
+            data[table] = record['docs']
+        elif op == "drop":
+            data.pop(table, None)
+        elif op == "batch":
+            for sub_record in record['records']:
+                cls._apply_record(data, sub_record)
+        else:
+            raise ValueError(f"unknown log record type '{op}'")
+
+    def _diff(self, changed, written=None):
+        """
+        Return the log records for the changed tables.
+
+        Only the documents listed in 'written' are compared, for tables that
+        are listed there (see MemoryStateStorage._persist()).
+
+        """
+        written = written or {}
+        records = []
+        for name, old_table in changed.items():
+            table = self._data.get(name)
+            if table is old_table:
+                continue
+            if table is None:
+                records.append({"op" : "drop", "table" : name})
+            elif old_table is None:
+                records.append({"op" : "table", "table" : name,
+                                "docs" : {str(doc_id) : doc for doc_id, doc in table.items()}})
+            elif written.get(name) is not None:
+                for doc_id in sorted(written[name], key=int):
+                    doc = _get_doc(table, doc_id)
+                    if doc is None:
+                        if _get_doc(old_table, doc_id) is not None:
+                            records.append({"op" : "del", "table" : name, "id" : doc_id})
+                    elif _get_doc(old_table, doc_id) != doc:
+                        records.append({"op" : "set", "table" : name, "id" : doc_id,
+                                        "doc" : doc})
+            else:
+                # Compare by the IDs as they are written to the log
+                table     = {str(doc_id) : doc for doc_id, doc in table.items()}
+                old_table = {str(doc_id) : doc for doc_id, doc in old_table.items()}
+                records.extend({"op" : "set", "table" : name, "id" : doc_id, "doc" : doc}
+                               for doc_id, doc in table.items()
+                               if old_table.get(doc_id) != doc)
+                records.extend({"op" : "del", "table" : name, "id" : doc_id}
+                               for doc_id in old_table.keys() - table.keys())
+        return records
+
+    def _persist(self, changed, written=None):
+        records = self._diff(changed, written)
+        if not records:
+            return
+        # A single line is either written completely or ignored when the log is replayed,
+        # so putting all records in one line makes the write atomic.
+        record = records[0] if len(records) == 1 else {"op" : "batch", "records" : records}
+        self._log.write(json.dumps(record) + "\n")
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._num_records += len(records)
+        if self._num_records >= self.compact_after:
+            self._compact()
+
+    def compact(self):
+        """
+        Write the current state to a new snapshot and clear the log.
+        """
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        # The new snapshot is written to a temporary file first, which then atomically
+        # replaces the old one. Should we crash before the log is cleared, then the log is
+        # replayed on top of the new snapshot next time, which does no harm.
+        tmp_path = self.path + ".tmp"
+        _write_json_file(tmp_path, self._data, self.fsync, **self._kwargs)
+        os.replace(tmp_path, self.path)
+        self._log.truncate(0)
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._num_records = 0
+
+    def close(self):
+        """
+        Close the log file.
+        """
+        self._log.close()
+
+
+class TableFileStorage(MemoryStateStorage):
+    """
+    A storage, which keeps each table in a file of its own.
+
+    The files are kept in a directory, which is named after the database file
+    name with a '.tables' suffix. Only the files of tables that were changed
+    are written on a write (or at the end of a transaction).
+
+    Each write creates new files for the changed tables, with a generation
+    number in their name. A manifest file lists the current file for each
+    table. Replacing the manifest is the atomic commit, after which the files
+    of the previous generation are deleted. Files that are not listed in the
+    manifest (for example after a crash during a write) are ignored and
+    cleaned up when the storage is opened.
+
+    If the directory doesn't exist yet, but the database file does, then the
+    contents of the database file are used as initial state.
+
+    """
+
+    DIR_SUFFIX    = ".tables"
+    MANIFEST_NAME = "MANIFEST.json"
+
+    def __init__(self, path, fsync=True, **kwargs):
+        """
+        Open the storage for the specified database file name.
+
+        Any additional keyword arguments are passed on to json.dumps() when
+        writing a table file.
+
+        """
+        super().__init__(fsync)
+        self.path          = path
+        self.dir_path      = path + self.DIR_SUFFIX
+        self.manifest_path = os.path.join(self.dir_path, self.MANIFEST_NAME)
+        self._kwargs       = kwargs
+        self._generation   = 0
+        self._files        = {}   # table name to its current file name
+
+        if os.path.exists(self.manifest_path):
+            self._load()
+        else:
+            os.makedirs(self.dir_path, exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path):
+                with open(path, "r", encoding="utf-8") as json_file:
+                    self._data = json.load(json_file)
+                self._persist({name : None for name in self._data})
+
+    def _load(self):
+        """
+        Read the manifest and all the table files it lists.
+        """
+        with open(self.manifest_path, "r", encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        self._generation = manifest['generation']
+        self._files      = manifest['tables']
+        for name, fname in self._files.items():
+            with open(os.path.join(self.dir_path, fname), "r", encoding="utf-8") as table_file:
+                self._data[name] = json.load(table_file)
+        # Remove anything left behind by an unfinished commit
+        for fname in os.listdir(self.dir_path):
+            if fname != self.MANIFEST_NAME and fname not in self._files.values():
+                os.remove(os.path.join(self.dir_path, fname))
+
+    def _persist(self, changed, written=None):
+        generation = self._generation + 1
+        files      = dict(self._files)
+        for name in changed:
+            if not re.fullmatch(r"\w+", name):
+                raise ValueError(f"invalid table name '{name}'")
+            if name in self._data:
+                files[name] = f"{name}.{generation}.json"
+                _write_json_file(os.path.join(self.dir_path, files[name]),
+                                 self._data[name], self.fsync, **self._kwargs)
+            else:
+                files.pop(name, None)
+
+        # The commit: Atomically replace the manifest with one that lists the new files
+        tmp_path = self.manifest_path + ".tmp"
+        _write_json_file(tmp_path, {"generation" : generation, "tables" : files}, self.fsync)
+        os.replace(tmp_path, self.manifest_path)
+        if self.fsync:
+            _fsync_dir(self.dir_path)
+
+        for name, fname in self._files.items():
+            if files.get(name) != fname:
+                os.remove(os.path.join(self.dir_path, fname))
+        self._files      = files
+        self._generation = generation
+
+
+class WriteBehindMiddleware(Middleware):  # pylint: disable=too-many-instance-attributes
+    """
+    A caching middleware, which writes changes to the storage in the background.
+
+    Reads are served from memory. A write only updates the cache, and a
+    background thread writes the latest state to the storage every
+    'flush_interval' seconds, or as soon as 'flush_after' writes have piled
+    up (a transaction counts as a single write). Changes that haven't been
+    flushed are lost if the process dies. On close, all outstanding changes
+    are flushed.
+
+    Without a flush interval, every write goes to the storage right away, so
+    that the middleware is merely a read cache.
+
+    Writes may be grouped in a transaction. A flush never contains part of a
+    transaction, and the cache goes back to the state before the transaction
+    if an exception is raised in it.
+
+        db = TinyDB(fname, storage=WriteBehindMiddleware(JSONStorage, 0.1, 100))
+
+    """
+
+    def __init__(self, storage_cls=TinyDB.DEFAULT_STORAGE, flush_interval=None,
+                 flush_after=100):
+        """
+        Create the middleware for the specified storage class.
+        """
+        super().__init__(storage_cls)
+        self.flush_interval = flush_interval
+        self.flush_after    = flush_after
+        self._cache         = None
+        self._num_writes    = 0                   # writes since the last flush
+        self._depth         = 0                   # nesting depth of transactions
+        self._lock          = threading.RLock()   # protects the cache
+        self._flush_lock    = threading.Lock()    # serializes writes to the storage
+        self._written_docs  = _WrittenDocs()      # written documents since the last flush
+        self._wakeup        = threading.Event()
+        self._closed        = False
+        self._thread        = None
+
+    def __call__(self, *args, **kwargs):
+        """
+        Open the storage, load the cache and start flushing in the background.
+        """
+        super().__call__(*args, **kwargs)
+        self._cache = self.storage.read()
+        if self.flush_interval is not None:
+            self._thread = threading.Thread(target=self._flush_loop, name="db-flush",
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def _flush_loop(self):
+        """
+        Flush the cache periodically, or when woken up, until we are closed.
+        """
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                # The changes stay in the cache, we try again next time
+                logging.getLogger(__name__).exception("flushing the database failed")
+
+    def _written(self):
+        """
+        Trigger a flush, if a write (or transaction) requires it.
+
+        Returns True if the caller needs to flush right away. It must do so
+        without holding the cache lock, which a flush takes after the flush
+        lock.
+
+        """
+        if self.flush_interval is None:
+            return True
+        if self._num_writes >= self.flush_after:
+            self._wakeup.set()
+        return False
+
+    def read(self):
+        """
+        Return the cached state of the database.
+        """
+        # TinyDB modifies the dictionary we hand out, so it gets a copy. The tables in it are
+        # never modified, only replaced.
+        with self._lock:
+            return dict(self._cache) if self._cache is not None else None
+
+    def hint_written(self, table, doc_ids):
+        """
+        Announce a write to documents of a table (see MemoryStateStorage).
+        """
+        with self._lock:
+            self._written_docs.hint(table, doc_ids)
+
+    def write(self, data):
+        """
+        Replace the cached state, flushing it to the storage when it's due.
+        """
+        with self._lock:
+            old_data          = self._cache or {}
+            self._written_docs.written([name for name in data.keys() | old_data.keys()
+                                        if data.get(name) is not old_data.get(name)])
+            self._cache       = data
+            self._num_writes += 1
+            flush_now         = not self._depth and self._written()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current state to the storage, if there are unwritten changes.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._num_writes:
+                    return
+                data, num_writes = self._cache, self._num_writes
+                written_docs     = self._written_docs.take()
+                self._num_writes = 0
+            # Writing to the storage may take a while, so we allow further writes to the cache
+            # in the meantime. They replace the cached state, rather than modifying it.
+            try:
+                hint_written = getattr(self.storage, "hint_written", None)
+                if hint_written is not None:
+                    for name, doc_ids in written_docs.items():
+                        hint_written(name, doc_ids)
+                self.storage.write(data)
+            except Exception:
+                with self._lock:
+                    self._num_writes += num_writes
+                    self._written_docs.merge(written_docs)
+                raise
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Flush all writes within the enclosed block together, or not at all.
+
+        Other threads are blocked from reading or writing for the duration of
+        the transaction.
+
+        """
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            start_cache, start_writes = self._cache, self._num_writes
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._cache, self._num_writes = start_cache, start_writes
+                raise
+            finally:
+                self._depth = 0
+            flush_now = False
+            if self._num_writes != start_writes:
+                self._num_writes = start_writes + 1
+                flush_now        = self._written()
+        if flush_now:
+            self.flush()
+
+    def close(self):
+        """
+        Flush all outstanding changes and close the storage.
+        """
+        self._closed = True
+        if self._thread is not None:
+            self._wakeup.set()
+            self._thread.join()
+        self.flush()
+        self.storage.close()
@@ -0,0 +1,343 @@
+"""
+Handling of uploaded attachment files.
+
+Uploaded files can be large, so they are never held in memory as a whole.
+Instead, the data is written to a staging file in fixed-size chunks as it
+arrives, and the size and SHA-256 hash of the file are computed on the way.
+Only once the upload is complete and the attachment has been created, the
+staging file is moved to its final place in the attachment storage.
+
+This is also done for files, which are sent base64 encoded in a JSON
+document: parse_json_upload() reads the document incrementally, and decodes
+the file into a staging file while it is read.
+
+"""
+
+import binascii
+import codecs
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024   # Size of the blocks, in which uploaded data is read
+
+_JSON_DECODER     = json.JSONDecoder()
+_JSON_WHITESPACE  = " \t\n\r"
+_JSON_STR_SPECIAL = re.compile(r'["\\]')   # The end of a string or an escape sequence
+_JSON_STR_ESCAPES = {'"' : '"', '\\' : '\\', '/' : '/', 'b' : '\b', 'f' : '\f', 'n' : '\n',
+                     'r' : '\r', 't' : '\t'}
+
+# Characters, which base64.b64decode() ignores
+_BASE64_IGNORED = re.compile(r'[^A-Za-z0-9+/=]')
+
+
+class StagedFile:
+    """
+    An uploaded file, which is written to a staging directory.
+
+    The staging directory needs to be on the same file system as the final
+    place of the file, so that commit() can simply rename it. If the file is
+    not committed, then it is removed by discard(), which is also done when
+    it is used as a context manager.
+
+    The write() and seek() methods allow it to be used as the stream of a
+    file that is parsed from a multipart form.
+
+    """
+
+    def __init__(self, staging_dir):
+        """
+        Create an empty staging file in the specified directory.
+        """
+        os.makedirs(staging_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=staging_dir, suffix=".upload")
+        self._file    = os.fdopen(fd, "wb")
+        self._hash    = hashlib.sha256()
+        self.size     = 0
+        # An exception, which occurred while the data was produced (for example while
+        # decoding it). The file is incomplete in that case.
+        self.error    = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.discard()
+
+    @property
+    def sha256(self):
+        """
+        The hex digest of the SHA-256 hash of the data written so far.
+        """
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        """
+        Append a chunk of data to the file.
+        """
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def write_from(self, stream, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Append all data of a stream to the file, reading one chunk at a time.
+        """
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            self.write(chunk)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        Set the position in the file (only called when a form has been parsed).
+        """
+        return self._file.seek(offset, whence)
+
+    def commit(self, path):
+        """
+        Move the complete file to its final place.
+        """
+        self._file.close()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path, path)
+        self.path = None
+
+    def discard(self):
+        """
+        Remove the file, unless it has been committed.
+        """
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class _Base64Writer:
+    """
+    Decodes base64 text, which arrives in parts, and writes the data to a file.
+
+    Characters outside of the base64 alphabet are ignored, like it is done by
+    base64.b64decode(). The text is decoded in groups of four characters, so
+    that only an incomplete group needs to be held back.
+
+    """
+
+    def __init__(self, file):
+        """
+        Create the writer for the specified file.
+        """
+        self._file    = file
+        self._pending = ""
+
+    def write(self, text):
+        """
+        Decode the next part of the text.
+        """
+        text  = self._pending + _BASE64_IGNORED.sub("", text)
+        split = len(text) - len(text) % 4
+        if split:
+            self._file.write(binascii.a2b_base64(text[:split]))
+        self._pending = text[split:]
+
+    def close(self):
+        """
+        Decode the end of the text, raising binascii.Error if it is incomplete.
+        """
+        if self._pending:
+            raise binascii.Error("Incorrect padding")
+
+
+class _JSONReader:
+    """
+    The text of a JSON document, which is read from a byte stream in chunks.
+
+    Only the unparsed rest of the current chunk is held in memory. Strings
+    can be read in parts (see string_parts()), so that they don't need to fit
+    into memory either.
+
+    """
+
+    def __init__(self, stream, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Create the reader for the specified stream, which is read in chunks of chunk_size.
+        """
+        self._stream     = stream
+        self._chunk_size = chunk_size
+        self._decoder    = codecs.getincrementaldecoder("utf-8")()
+        self.buf         = ""
+        self.pos         = 0
+        self.eof         = False
+        self._consumed   = 0   # The number of characters before the buffer
+
+    @property
+    def offset(self):
+        """
+        The number of characters of the document, which have been parsed.
+        """
+        return self._consumed + self.pos
+
+    def _fill(self):
+        """
+        Read the next chunk of the stream, returning False at the end of it.
+        """
+        if self.eof:
+            return False
+        data            = self._stream.read(self._chunk_size)
+        self.eof        = not data
+        self.buf        = self.buf[self.pos:] + self._decoder.decode(data, final=self.eof)
+        self._consumed += self.pos
+        self.pos        = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character ('' at the end of the document).
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _JSON_WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        """
+        Skip the next character, which has to be the specified one.
+        """
+        if self.peek() != char:
+            raise ValueError(f"invalid JSON: expected '{char}' at offset {self.offset}")
+        self.pos += 1
+
+    def value(self, max_size):
+        """
+        Parse the next JSON value, which mustn't be longer than max_size characters.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _JSON_DECODER.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as ex:
+                if self.eof:
+                    raise ValueError(f"invalid JSON: {str(ex)}") from ex
+            if len(self.buf) - self.pos > max_size:
+                raise ValueError(f"JSON value larger than {max_size} characters")
+            self._fill()
+
+    def string_parts(self):
+        """
+        Generate the next JSON string in parts, with escape sequences resolved.
+        """
+        self.expect('"')
+        while True:
+            match = _JSON_STR_SPECIAL.search(self.buf, self.pos)
+            if match is None:
+                if self.pos < len(self.buf):
+                    yield self.buf[self.pos:]
+                    self.pos = len(self.buf)
+                if not self._fill():
+                    raise ValueError("invalid JSON: unterminated string")
+                continue
+            if match.start() > self.pos:
+                yield self.buf[self.pos:match.start()]
+            self.pos = match.end()
+            if match.group() == '"':
+                return
+            # An escape sequence is at most 5 characters after the backslash
+            while len(self.buf) - self.pos < 5 and self._fill():
+                pass
+            escape = self.buf[self.pos:self.pos + 1]
+            if escape == "u":
+                code = self.buf[self.pos + 1:self.pos + 5]
+                if not re.fullmatch(r'[0-9a-fA-F]{4}', code):
+                    raise ValueError("invalid JSON: invalid \\u escape in string")
+                yield chr(int(code, 16))
+                self.pos += 5
+            elif escape in _JSON_STR_ESCAPES:
+                yield _JSON_STR_ESCAPES[escape]
+                self.pos += 1
+            else:
+                raise ValueError("invalid JSON: invalid escape in string")
+
+
+def _decode_base64_string(reader, upload):
+    """
+    Decode the next string of the JSON document into the staged file.
+
+    If the string isn't valid base64, then the rest of it is skipped, and the
+    error is kept in the file.
+
+    """
+    writer = _Base64Writer(upload)
+    parts  = reader.string_parts()
+    try:
+        for part in parts:
+            writer.write(part)
+        writer.close()
+    except binascii.Error as ex:
+        upload.error = ex
+        for _ in parts:
+            pass
+
+
+def parse_json_upload(stream, staging_dir, file_key, max_metadata_size=64 * 1024):
+    """
+    Parse a JSON object, which contains a base64 encoded file, from a stream.
+
+    The object is read incrementally. The string value of 'file_key' is
+    decoded into a StagedFile while it is read, which is returned in its
+    place. Only the other (small) values are held in memory, which mustn't be
+    longer than 'max_metadata_size' characters in total.
+
+    If the file isn't valid base64, then this isn't raised, but kept as the
+    'error' of the StagedFile. The document can then still be checked, just
+    like one that was parsed as a whole. Raises ValueError if the document
+    isn't a valid JSON object.
+
+    """
+    reader        = _JSONReader(stream)
+    data          = {}
+    metadata_size = 0
+    try:
+        reader.expect("{")
+        while reader.peek() != "}":
+            if data:
+                reader.expect(",")
+            start = reader.offset
+            key   = reader.value(max_metadata_size)
+            if not isinstance(key, str):
+                raise ValueError("invalid JSON: expected a string as key")
+            reader.expect(":")
+            if key == file_key and reader.peek() == '"':
+                if isinstance(data.get(key), StagedFile):
+                    data[key].discard()
+                data[key] = StagedFile(staging_dir)
+                _decode_base64_string(reader, data[key])
+            else:
+                data[key]      = reader.value(max_metadata_size - metadata_size)
+                metadata_size += reader.offset - start
+                if metadata_size > max_metadata_size:
+                    raise ValueError(f"JSON document has more than {max_metadata_size} "
+                                     f"characters besides the file")
+        reader.expect("}")
+        if reader.peek() != "":
+            raise ValueError("invalid JSON: extra data after the object")
+    except BaseException:
+        for value in data.values():
+            if isinstance(value, StagedFile):
+                value.discard()
+        raise
+    return data
@@ -7,34 +7,166 @@ flask_restful.
 """
 
 import base64
+import bisect
+import collections.abc
 import datetime
 import flask
+import hashlib
 import flask_restful
 import json
 import os
+import re
+import shutil
+import threading
+import time
 
 from flask_accept         import accept
-from tinydb               import TinyDB, Query, where
+from tinydb               import where
 from tinydb.operations    import delete
-from urllib.parse         import unquote_plus
+from urllib.parse         import unquote_plus, urlencode
 from validator_collection import validators
+from werkzeug.exceptions  import HTTPException
+from werkzeug.formparser  import parse_form_data
 
-from itsm_api      import app
+from itsm_api                import app
+from itsm_api.indexes        import (AssociationIndex, HashIndex, IndexedTable,
+                                     InvertedIndex, SortedIndex, UniqueIndex)
+from itsm_api.sqlite_backend import SQLiteDB
+from itsm_api.storages       import (JSONFileStorage, LogStorage, TableFileStorage,
+                                     TransactionalTinyDB, WriteBehindMiddleware)
+from itsm_api.uploads        import StagedFile, parse_json_upload
 
 API = flask_restful.Api(app)    # Initialize the API (managed by flask_restful)
 
-_ATTACHMENT_FOLDER = "attachment_storage"
+_ATTACHMENT_FOLDER  = "attachment_storage"
+_ATTACHMENT_STAGING = os.path.join(_ATTACHMENT_FOLDER, ".staging")  # Uploads in progress
+_ATTACHMENT_BLOBS   = os.path.join(_ATTACHMENT_FOLDER, "blobs")     # Files by their hash
+_UPLOAD_SESSIONS    = os.path.join(_ATTACHMENT_FOLDER, "uploads")   # Chunked uploads
+_MAX_FORM_MEMORY    = 64 * 1024   # Maximum size of the fields of an upload besides the file
+
+_DB        = None   # The currently open database, closed when init_db() is called again
+_DB_TABLES = {}     # The tables of the open database, by name
+_DB_EPOCH  = None   # Identifies the open database in ETags (see ApiResource.etag())
+
+# Notified whenever changes may have been recorded for the change stream (see ChangeStream)
+_CHANGES_CONDITION = threading.Condition()
+
+_FSYNC_MODES = ["always", "interval", "never"]
+
+# The SQLite 'synchronous' setting, which corresponds to each of the fsync modes
+_SQLITE_SYNCHRONOUS = {"always" : "FULL", "interval" : "NORMAL", "never" : "OFF"}
+
+_MAX_PAGE_LIMIT     = 1000        # The maximum number of resources on a page of a list
+_SCAN_BATCH         = 100         # Documents loaded at once when going through a table
+_STREAM_BUFFER_SIZE = 64 * 1024   # Minimum size of the blocks of a streamed response
 
 
 # =============================================================
 # Utility functions, used by the framework and resource classes
 # =============================================================
 
+def _fsync_mode():
+    """
+    Return the fsync mode selected in the config.
+
+    The config parameter 'DB_FSYNC' can be one of:
+
+    * always: Every change is on disk before the request returns.
+    * interval: Changes are written in the background, every
+      'DB_FLUSH_INTERVAL_MS' milliseconds or as soon as there are
+      'DB_FLUSH_AFTER_WRITES' unwritten changes, whichever comes first.
+    * never: Like 'interval', but the operating system decides when the
+      written data actually reaches the disk.
+
+    """
+    fsync_mode = app.config.get('DB_FSYNC', "always")
+    if fsync_mode not in _FSYNC_MODES:
+        raise ValueError(f"unknown fsync mode '{fsync_mode}'")
+    return fsync_mode
+
+
+def _db_storage_args():
+    """
+    Return the TinyDB arguments for the storage engine selected in the config.
+
+    The config parameter 'DB_STORAGE' can be one of:
+
+    * json: TinyDB's default storage, which rewrites the full file on every
+      change.
+    * log: Appends changes to a log file, which is compacted into the DB file
+      every 'DB_LOG_COMPACT_AFTER' changes.
+    * tables: Keeps every table in a file of its own, so that only the files
+      of changed tables are rewritten.
+
+    Unless the fsync mode (see _fsync_mode()) is 'always', the storage is
+    used through a caching middleware, which writes the changes to it in the
+    background.
+
+    """
+    storage_name = app.config.get('DB_STORAGE', "json")
+    if storage_name == "json":
+        storage, args = JSONFileStorage, {}
+    elif storage_name == "log":
+        storage, args = LogStorage, {"compact_after" : app.config.get('DB_LOG_COMPACT_AFTER',
+                                                                      1000)}
+    elif storage_name == "tables":
+        storage, args = TableFileStorage, {}
+    else:
+        raise ValueError(f"unknown DB storage '{storage_name}'")
+
+    fsync_mode      = _fsync_mode()
+    args['fsync']   = fsync_mode != "never"
+    args['storage'] = storage
+    if fsync_mode != "always":
+        args['storage'] = WriteBehindMiddleware(
+                              storage, app.config.get('DB_FLUSH_INTERVAL_MS', 100) / 1000,
+                              app.config.get('DB_FLUSH_AFTER_WRITES', 100))
+    return args
+
+
+def _open_db():
+    """
+    Open the database with the backend selected in the config.
+
+    The config parameter 'DB_BACKEND' can be one of:
+
+    * tinydb: The database is kept in the TinyDB file 'DB_NAME'.
+    * sqlite: The database is kept in the SQLite file 'DB_SQLITE_NAME'. If
+      this file doesn't exist yet, then it is created and the data of the
+      TinyDB file 'DB_NAME' (if it exists) is imported into it.
+
+    """
+    backend = app.config.get('DB_BACKEND', "tinydb")
+    if backend == "tinydb":
+        return TransactionalTinyDB(app.config['DB_NAME'], table_class=IndexedTable,
+                                   **_db_storage_args())
+    if backend == "sqlite":
+        path   = app.config['DB_SQLITE_NAME']
+        is_new = not os.path.exists(path)
+        db     = SQLiteDB(path, synchronous=_SQLITE_SYNCHRONOUS[_fsync_mode()])
+        if is_new and os.path.exists(app.config['DB_NAME']):
+            db.import_json(app.config['DB_NAME'])
+        return db
+    raise ValueError(f"unknown DB backend '{backend}'")
+
+
 def init_db():
     """
     Initialize the handles for the different database tables.
 
-    Note that the config parameter 'DB_NAME' is used to find the DB file.
+    Note that the config parameter 'DB_BACKEND' selects the database backend,
+    see _open_db() for details.
+
+    Some tables maintain indexes over the fields that are used to look up
+    documents by foreign key, or which are commonly searched for. Those are
+    built here, when the tables are opened. Searches via URL parameters make
+    use of them (see ApiResourceList.search_table()).
+    The index of user/customer associations is also made available on its own,
+    since it is used to answer questions in both directions.
+
+    The 'changes' table records the changes to tickets, comments and
+    attachments for the change stream (see ChangeStream). The 'uploads' table
+    holds the sessions of resumable attachment uploads (see UploadSession).
 
     """
     # We are setting the module variables here for the first time, so disable the warning
@@ -44,15 +176,264 @@ def init_db():
     global DB_TICKET_TABLE              # pylint: disable=global-variable-undefined
     global DB_COMMENT_TABLE             # pylint: disable=global-variable-undefined
     global DB_ATTACHMENT_TABLE          # pylint: disable=global-variable-undefined
+    global DB_USER_CUSTOMER_RELS_INDEX  # pylint: disable=global-variable-undefined
+    global DB_CHANGE_TABLE              # pylint: disable=global-variable-undefined
+    global DB_UPLOAD_TABLE              # pylint: disable=global-variable-undefined
+    global _DB                          # pylint: disable=global-statement
+    global _DB_TABLES                   # pylint: disable=global-statement
+    global _DB_EPOCH                    # pylint: disable=global-statement
+
+    if _DB is not None:
+        _DB.close()
+
+    db  = _open_db()
+    _DB = db
+
+    DB_USER_TABLE               = db.table('users',
+                                           indexes=[InvertedIndex('email', _normalize_email),
+                                                    *_timestamp_indexes()])
+    DB_CUSTOMER_TABLE           = db.table('customers',
+                                           indexes=[HashIndex('name'),
+                                                    HashIndex('parent_id'),
+                                                    *_timestamp_indexes()])
+    DB_USER_CUSTOMER_RELS_TABLE = db.table('user_customer_rels',
+                                           indexes=[AssociationIndex('customer_id',
+                                                                     'user_id')])
+    DB_USER_CUSTOMER_RELS_INDEX = DB_USER_CUSTOMER_RELS_TABLE.indexes[('customer_id',
+                                                                       'user_id')]
+    DB_TICKET_TABLE             = db.table('tickets',
+                                           indexes=[HashIndex('customer_id'),
+                                                    HashIndex('user_id'),
+                                                    HashIndex('status'),
+                                                    UniqueIndex('aportio_id'),
+                                                    *_timestamp_indexes()])
+    DB_COMMENT_TABLE            = db.table('comments',
+                                           indexes=[HashIndex('ticket_id'),
+                                                    HashIndex('user_id'),
+                                                    HashIndex('type'),
+                                                    *_timestamp_indexes()])
+    DB_ATTACHMENT_TABLE         = db.table('attachments',
+                                           indexes=[HashIndex('ticket_id'),
+                                                    HashIndex('sha256'),
+                                                    *_timestamp_indexes()])
+    DB_CHANGE_TABLE             = db.table('changes')
+    DB_UPLOAD_TABLE             = db.table('uploads')
+
+    _DB_TABLES = {table.name : table
+                  for table in [DB_USER_TABLE, DB_CUSTOMER_TABLE, DB_USER_CUSTOMER_RELS_TABLE,
+                                DB_TICKET_TABLE, DB_COMMENT_TABLE, DB_ATTACHMENT_TABLE,
+                                DB_CHANGE_TABLE, DB_UPLOAD_TABLE]}
+    # ETags also need to identify the database they were issued for. The SQLite backend
+    # keeps the generations of the tables in the database, which is identified by its
+    # epoch. With TinyDB, the generations start over with every process.
+    _DB_EPOCH  = getattr(db, "epoch", None) or os.urandom(8).hex()
+
+
+# The search keys for documents created or updated at or after a point in time, and the
+# timestamp fields they refer to. Lists that support them include them in their
+# VALID_SEARCH_FIELDS.
+_TIMESTAMP_SEARCH_KEYS   = {
+    "created_since" : "_created",
+    "updated_since" : "_updated",
+}
+_TIMESTAMP_SEARCH_FIELDS = {key : datetime.datetime for key in _TIMESTAMP_SEARCH_KEYS}
+
+
+def _timestamp_indexes():
+    """
+    Return the indexes over the timestamp fields, which serve the timestamp searches.
+    """
+    return [SortedIndex(field) for field in _TIMESTAMP_SEARCH_KEYS.values()]
+
+
+def _parse_timestamp(value):
+    """
+    Return an ISO 8601 timestamp in the format of the '_created' and '_updated' fields.
+
+    Those are stored in local time, without time zone. Timestamps with a time
+    zone are converted to local time. Timestamps in this format sort in
+    chronological order, so they can be compared as strings.
+
+    """
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        timestamp = datetime.datetime.fromisoformat(value)
+    except ValueError as ex:
+        raise ValueError(f"invalid timestamp: {value}") from ex
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp.isoformat()
+
+
+def _normalize_email(email):
+    """
+    Return the normalized form of an email address, used for comparisons.
+
+    Email addresses are compared without regard to case or surrounding
+    whitespace.
+
+    """
+    if not isinstance(email, str):
+        return email
+    return email.strip().lower()
+
+
+def _encode_cursor(direction, doc_id):
+    """
+    Return an opaque cursor, which points before or after the specified document.
+    """
+    cursor = json.dumps({direction : doc_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    """
+    Return the direction ('after' or 'before') and the document ID of a cursor.
+
+    Raises ValueError if this is not a valid cursor.
+
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        ((direction, doc_id),) = data.items()
+    except (ValueError, TypeError, AttributeError) as ex:
+        raise ValueError(f"invalid cursor: {cursor}") from ex
+    if direction not in ("after", "before") or not isinstance(doc_id, int):
+        raise ValueError(f"invalid cursor: {cursor}")
+    return direction, doc_id
+
+
+def _index_field(key):
+    """
+    Return the field of the index, which serves a search key.
+    """
+    return _TIMESTAMP_SEARCH_KEYS.get(key, key)
+
 
-    db = TinyDB(app.config['DB_NAME'])
+def _is_indexed(table, key):
+    """
+    Return whether a search key can be answered by an index lookup.
+
+    The document ID is the key of the table itself, so an ID search is always
+    answered by looking up the documents directly.
 
-    DB_USER_TABLE               = db.table('users')
-    DB_CUSTOMER_TABLE           = db.table('customers')
-    DB_USER_CUSTOMER_RELS_TABLE = db.table('user_customer_rels')
-    DB_TICKET_TABLE             = db.table('tickets')
-    DB_COMMENT_TABLE            = db.table('comments')
-    DB_ATTACHMENT_TABLE         = db.table('attachments')
+    """
+    return key == "id" or table.is_indexed(_index_field(key))
+
+
+def _index_name(table, key):
+    """
+    Return the name of the index, which serves a search key (for explaining searches).
+    """
+    if key == "id":
+        return "DocumentID"
+    return type(table.indexes[_index_field(key)]).__name__
+
+
+def _index_lookup(table, key, value):
+    """
+    Return the IDs of the documents, which match a single value of a search key.
+
+    Timestamp searches match the documents with the timestamp or a later one.
+    An ID search returns the ID itself, since documents that don't exist are
+    skipped when the documents are loaded.
+
+    """
+    if key == "id":
+        return (value,)
+    index = table.indexes[_index_field(key)]
+    if key in _TIMESTAMP_SEARCH_KEYS:
+        return index.lookup_from(value)
+    return index.lookup(value)
+
+
+def _record_change(changed_class, doc_id, action):
+    """
+    Record a change of a resource for the change stream (see ChangeStream).
+
+    This is called in the same transaction as the change itself, so that the
+    record is only committed together with the change. The ID of the record is
+    the sequence number of the change. Only the 'CHANGES_RETAIN' most recent
+    changes are kept. Older ones are removed in batches, whenever there are
+    10% more than that.
+
+    """
+    DB_CHANGE_TABLE.insert({
+        "resource"    : changed_class.__name__.lower(),
+        "action"      : action,
+        "resource_id" : doc_id,
+        "href"        : changed_class.get_self_url(doc_id),
+        "_created"    : datetime.datetime.now().isoformat()
+    })
+    retain = app.config.get('CHANGES_RETAIN', 10000)
+    if len(DB_CHANGE_TABLE) > retain * 1.1:
+        DB_CHANGE_TABLE.remove(doc_ids=DB_CHANGE_TABLE.doc_ids()[:-retain])
+
+
+def _notify_changes():
+    """
+    Wake up the change streams, after changes may have been committed.
+    """
+    with _CHANGES_CONDITION:
+        _CHANGES_CONDITION.notify_all()
+
+
+def _embed_all(embed_func, data):
+    """
+    Apply an embedding function to every element of the data.
+
+    Returns a list if the data is a list. Otherwise, the data is being streamed
+    (see ApiResourceList), and the elements are embedded one at a time, as they
+    are consumed.
+
+    """
+    embedded = map(embed_func, data)
+    return list(embedded) if isinstance(data, list) else embedded
+
+
+def _json_chunks(value):
+    """
+    Serialize a value to JSON, in a sequence of chunks of text.
+
+    Iterators in the value are serialized as lists, one element at a time. A
+    callable is called for its value once the serialization reaches it, which
+    allows values that are only known after the elements of an iterator have
+    been produced.
+
+    """
+    if isinstance(value, dict):
+        yield "{"
+        for i, (key, element) in enumerate(value.items()):
+            yield ("," if i else "") + json.dumps(key) + ":"
+            yield from _json_chunks(element)
+        yield "}"
+    elif isinstance(value, collections.abc.Iterator):
+        yield "["
+        for i, element in enumerate(value):
+            yield ("," if i else "") + json.dumps(element)
+        yield "]"
+    elif callable(value):
+        yield json.dumps(value())
+    else:
+        yield json.dumps(value)
+
+
+def _buffered(chunks):
+    """
+    Join chunks of text into blocks of at least _STREAM_BUFFER_SIZE characters.
+    """
+    buf     = []
+    buf_len = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= _STREAM_BUFFER_SIZE:
+            yield "".join(buf)
+            buf     = []
+            buf_len = 0
+    if buf:
+        yield "".join(buf)
 
 
 def _str_len_check(text, min_len, max_len):
@@ -66,7 +447,57 @@ def _str_len_check(text, min_len, max_len):
     return text
 
 
-def _dict_sanity_check(data, mandatory_keys, optional_keys, obj=None):
+def _merge_patch(target, patch):
+    """
+    Apply a JSON merge patch (RFC 7396) to a value and return the result.
+
+    Objects in the patch are merged into the target recursively, where a null
+    value removes the key. Any other value replaces the target. The target
+    itself isn't modified.
+
+    """
+    if not isinstance(patch, dict):
+        return patch
+    res = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            res.pop(key, None)
+        else:
+            res[key] = _merge_patch(res.get(key), value)
+    return res
+
+
+def _patched_document(obj, changes):
+    """
+    Return how the document obj looks after the changes of a patch.
+
+    The changes are those returned by _dict_sanity_check() for a patch, in
+    which removed keys have the value None.
+
+    """
+    res = {k: v for k, v in obj.items() if k not in changes}
+    res.update((k, v) for k, v in changes.items() if v is not None)
+    return res
+
+
+def _patch_document(table, doc_id, changes):
+    """
+    Write the changes of a patch to a document.
+
+    All changes are applied by a single update, so that the document is only
+    written once, regardless of the number of changed keys.
+
+    """
+    def apply_changes(doc):
+        for key, value in changes.items():
+            if value is None:
+                doc.pop(key, None)
+            else:
+                doc[key] = value
+    table.update(apply_changes, doc_ids=[doc_id])
+
+
+def _dict_sanity_check(data, mandatory_keys, optional_keys, obj=None, patch=False):
     """
     Perform a sanity check of a dictionary.
 
@@ -88,20 +519,43 @@ def _dict_sanity_check(data, mandatory_keys, optional_keys, obj=None):
 
     The _updated field is always going to be set to the current time.
 
+    The _version field counts the writes of the document: It is 1 for a new
+    document, and one more than the version of obj otherwise (see
+    ApiResource.check_if_match()). Documents that were never written through
+    the API have version 0.
+
+    The server-side fields (id, _created, _updated, _version, _links and
+    _embedded) may be present in the data, for example when a client sends
+    back a resource it has read, but their values are ignored.
+
+    If patch is set, then data is a JSON merge patch (RFC 7396) for obj,
+    rather than a full document: Mandatory keys may be missing, a key with
+    a null value is removed (which isn't allowed for mandatory keys), and an
+    object value is merged into the object stored under the key. Only the
+    keys in the patch are validated, each with its value after the merge, so
+    that unchanged keys don't incur the cost of their validation. The result
+    then only contains the changed keys, with None for the removed ones (see
+    _patch_document()).
+
     Raises ValueError if something is wrong.
 
     """
     # Both mandatory and optional key lists contain tuples, with key name being the first
     # element in each tuple. The validator is not needed for the mandatory / optional key
     # check, so we can ignore it here.
-    missing_keys = [k for k, _ in mandatory_keys if k not in data]
-    if missing_keys:
-        raise ValueError(f"missing mandatory key(s): {', '.join(missing_keys)}")
+    if patch:
+        removed_keys = [k for k, _ in mandatory_keys if k in data and data[k] is None]
+        if removed_keys:
+            raise ValueError(f"cannot remove mandatory key(s): {', '.join(removed_keys)}")
+    else:
+        missing_keys = [k for k, _ in mandatory_keys if k not in data]
+        if missing_keys:
+            raise ValueError(f"missing mandatory key(s): {', '.join(missing_keys)}")
 
     # Create a lookup of key name to validator function. The lookup will have an entry for all
     # possible keys, so we can also use it to check if we have any invalid keys.
     keys_to_validators = dict(mandatory_keys + optional_keys)
-    always_allowed     = ["id", "_created", "_updated", "_links", "_embedded"]
+    always_allowed     = ["id", "_created", "_updated", "_version", "_links", "_embedded"]
     invalid_keys = [k for k in data
                     if k not in keys_to_validators and k not in always_allowed]
     if invalid_keys:
@@ -111,6 +565,13 @@ def _dict_sanity_check(data, mandatory_keys, optional_keys, obj=None):
     # error message if possible
     res = {}
     for key, value in data.items():
+        if key in always_allowed:
+            continue
+        if patch:
+            if value is None:
+                res[key] = None
+                continue
+            value = _merge_patch(obj.get(key), value)
         try:
             res[key] = keys_to_validators[key](value)
         except ValueError as ex:
@@ -120,6 +581,7 @@ def _dict_sanity_check(data, mandatory_keys, optional_keys, obj=None):
     if obj is None:
         res['_created'] = now_time_string
     res['_updated'] = now_time_string
+    res['_version'] = 1 if obj is None else obj.get('_version', 0) + 1
     return res
 
 
@@ -148,6 +610,37 @@ class ApiResource:
 
     URL = "<overwrite in child class>"
 
+    # URL parameters, which control how a resource is returned, rather than being search
+    # terms
+    CONTROL_PARAMS = ["_explain", "_stream", "limit", "cursor", "fields", "embed"]
+
+    # The names of the resources, which are embedded in this resource unless the 'embed'
+    # URL parameter asks for a subset of them
+    EMBEDS = ()
+
+    # The requested fields of the resource and the requested embedded resources (see
+    # parse_fields_and_embeds()). None means all of them.
+    fields = None
+    embeds = None
+
+    # The requested fields of the resources in a list (see ApiResourceList)
+    item_fields = None
+
+    # The names of the tables, from which the resource is built (see etag()). Empty if the
+    # resource doesn't have an ETag. For individual resources, the first table holds the
+    # document of the resource.
+    ETAG_TABLES = ()
+
+    # The ETag of an individual resource starts with the version of its document
+    ETAG_VERSION = re.compile(r'v(\d+)-[0-9a-f]+')
+
+    # The keys of an individual resource, which can only be written once, with their names
+    # for error messages (see check_fixed_keys())
+    FIXED_KEYS = ()
+
+    # The content types accepted for the request body of a PATCH
+    PATCH_CONTENT_TYPES = ("application/merge-patch+json", "application/json")
+
     def _get_title_and_explanation(self):
         """
         Extract class docstring to use as title and text in HTML.
@@ -210,28 +703,199 @@ class ApiResource:
         return {name : {"href" : self._render_link(url)}
                 for name, url in name_url_pairs.items()}
 
-    def make_search_query(self, search):
+    def etag(self, variant, version=None):
         """
-        Construct TinyDB search query expression from URL parameters.
+        Return the ETag of the requested resource, without building the resource.
 
-        A key can appear multiple times. For example:
+        The ETag is derived from the URL (with its parameters), the variant of
+        the representation (for example 'json' or 'html') and the generation
+        of each of the ETAG_TABLES. It therefore changes whenever one of those
+        tables has changed. Returns None if the resource doesn't have an ETag.
+        With the SQLite backend, the generations are stored in the database, so
+        that the ETags are the same in all server processes sharing it.
 
-            ?email=foo@bar.com&email=x@y.com
+        If the version of the resource's document is given, then the ETag
+        starts with it (see check_if_match()).
 
-        This finds all records with email entries that match either one of the
-        two specified emails.
+        """
+        if not self.ETAG_TABLES:
+            return None
+        state = [_DB_EPOCH, variant, flask.request.full_path,
+                 [_DB_TABLES[name].generation for name in self.ETAG_TABLES]]
+        etag  = hashlib.sha1(json.dumps(state).encode()).hexdigest()
+        if version is not None:
+            etag = f"v{version}-{etag}"
+        return etag
 
-        Returns None if no parameters were provided.
+    def document_version(self, **kwargs):
+        """
+        Return the version of the document of an individual resource.
+
+        The keyword arguments are those of _get(), which consist of the ID of
+        the document, named after the last parameter of the URL. Returns None
+        if there is no such document.
+
+        """
+        id_param = re.fullmatch(r".*/<(\w+)>", self.URL)
+        if not self.ETAG_TABLES or id_param is None:
+            return None
+        doc_id = kwargs.get(id_param.group(1))
+        try:
+            doc = _DB_TABLES[self.ETAG_TABLES[0]].get(doc_id=int(doc_id))
+        except (TypeError, ValueError):
+            return None
+        return None if doc is None else doc.get('_version', 0)
+
+    def check_if_match(self, obj):
+        """
+        Abort with '412 Precondition Failed' if the client's copy of the document is stale.
+
+        A client may send the ETag of the resource it has read in the
+        'If-Match' header of a PUT. The update is only done if the document
+        hasn't been written since, which is the case if its version is still
+        the one at the start of the ETag. This is checked in the transaction
+        of the update, so that concurrent writers can't overwrite each other's
+        changes.
+
+        """
+        if_match = flask.request.if_match
+        if not if_match or if_match.star_tag:
+            return
+        versions = set()
+        for etag in if_match.as_set(include_weak=True):
+            match = self.ETAG_VERSION.fullmatch(etag)
+            if match:
+                versions.add(int(match.group(1)))
+        if obj.get('_version', 0) not in versions:
+            flask_restful.abort(412, message="Precondition Failed - the resource has been "
+                                             "changed in the meantime")
+
+    def check_fixed_keys(self, data, obj, name, patch=False):
+        """
+        Abort with '400 Bad Request' if the data changes a key in FIXED_KEYS.
+
+        The name of the resource (for example "ticket '1'") is used in the
+        error message. For a patch, only the keys present in the data are
+        checked, since the others are left unchanged.
+
+        """
+        for key, key_name in self.FIXED_KEYS:
+            if patch and key not in data:
+                continue
+            if data.get(key) != obj.get(key):
+                flask_restful.abort(400, message=f"Bad Request - cannot change {key_name} in "
+                                                 f"{name}")
+
+    def not_modified(self, variant, version=None):
+        """
+        Handle a conditional GET, before the resource is built.
+
+        Returns a '304 Not Modified' response if the client's copy of the
+        resource is current, according to the 'If-None-Match' header.
+        Otherwise, returns None and the ETag is added to the response, if it
+        is successful.
+
+        """
+        etag = self.etag(variant, version)
+        if etag is None:
+            return None
+        if flask.request.if_none_match.contains_weak(etag):
+            resp = flask.Response(status=304)
+            resp.set_etag(etag)
+            return resp
+
+        @flask.after_this_request
+        def add_etag(resp):
+            if resp.status_code == 200:
+                resp.set_etag(etag)
+            # The representation depends on the requested content type
+            resp.vary.add("Accept")
+            return resp
+        return None
+
+    def search_args(self):
+        """
+        Return the URL parameters of the request, without the control parameters.
+        """
+        search = flask.request.args.copy()
+        for param in self.CONTROL_PARAMS:
+            search.poplist(param)
+        return search
+
+    @staticmethod
+    def _list_arg(name):
+        """
+        Return the comma separated values of a URL parameter, or None if it's not present.
+        """
+        if name not in flask.request.args:
+            return None
+        values = [value.strip() for arg in flask.request.args.getlist(name)
+                  for value in arg.split(",") if value.strip()]
+        if not values:
+            raise ValueError(f"no values specified for '{name}'")
+        return values
+
+    def parse_fields_and_embeds(self):
+        """
+        Store the fields and embedded resources requested in the URL parameters.
+
+        The 'fields' parameter is a comma separated list of the fields to return.
+        The '_links' and '_embedded' sections are not affected by it. The
+        'embed' parameter is either 'none' or a comma separated list of the
+        names in EMBEDS. Resources, which are not embedded, are not loaded at
+        all.
+
+        """
+        fields = self._list_arg('fields')
+        embeds = self._list_arg('embed')
+        if embeds == ["none"]:
+            embeds = []
+        elif embeds is not None:
+            invalid = [name for name in embeds if name not in self.EMBEDS]
+            if invalid:
+                raise ValueError(f"cannot embed '{', '.join(invalid)}' in this resource")
+        # pylint: disable=attribute-defined-outside-init
+        self.fields = None if fields is None else set(fields)
+        self.embeds = None if embeds is None else set(embeds)
+
+    def wants_embed(self, name):
+        """
+        Return True if the named resource should be embedded in the result.
+        """
+        return self.embeds is None or name in self.embeds
+
+    def wants_field(self, name):
+        """
+        Return True if the named field should be in the result.
+        """
+        return self.fields is None or name in self.fields
+
+    @staticmethod
+    def select_fields(data, fields):
+        """
+        Return only the requested fields of a resource (all of them if fields is None).
+        """
+        if fields is None:
+            return data
+        return {key : value for key, value in data.items()
+                if key in fields or key in ("_links", "_embedded")}
+
+    def make_search_terms(self, search):
+        """
+        Parse the URL parameters into a list of search terms.
+
+        Each term is a tuple of the search key, the list of search values (cast
+        to the data type of the field) and the TinyDB query expression for the
+        term. A document matches the search if it matches all the terms.
 
         """
         if search and not hasattr(self, 'VALID_SEARCH_FIELDS'):
             raise ValueError(f"this resource does not support queries")
 
-        # Construct a TinyDB search query out of individual AND terms.
-        full_query_expr = None
+        terms = []
 
-        # Iterate over all the keys in the search URL parameters and join search expressions
-        # for each key with an AND.
+        # Iterate over all the keys in the search URL parameters and create a search
+        # expression for each key.
         for key in search.keys():
             if "." in key:
                 # Special processing for 'hierarchical' keys, such as "custom_fields.foo".
@@ -268,28 +932,61 @@ class ApiResource:
             # Also make sure that we unquote all the values specified for a key, since they
             # may have been URL encoded.
             values = [unquote_plus(v) for v in search.getlist(key)]
-            if data_type is list:
+            if data_type is datetime.datetime:
+                # A timestamp search matches documents with the timestamp or a later one.
+                # Matching any of several timestamps is the same as matching the earliest.
+                values     = [min(_parse_timestamp(v) for v in values)]
+                query_expr = where(_TIMESTAMP_SEARCH_KEYS[key]) >= values[0]
+            elif data_type is list:
                 # If the parameter in our DB has a list value then we match if any of
                 # specified search values match any of the stored values. For example, a
                 # user's email is a list (of addresses). If any of them match any of the
                 # specified ones then that's a match.
-                new_query_expr = where_key.any(values)
+                query_expr = where_key.any(values)
             # For non-list values, we check if any one of the search values is matched.
             elif data_type is int:
                 # All URL query parameters are strings, but some fields in the database are
                 # ints and therefore need to be cast to int first.
-                new_query_expr = where_key.one_of([int(v) for v in values])
+                values     = [int(v) for v in values]
+                query_expr = where_key.one_of(values)
             else:
-                new_query_expr = where_key.one_of(values)
-            # Now add the search expression for this search query key to the overall search
-            # expression with an AND operator
+                query_expr = where_key.one_of(values)
+            terms.append((key, values, query_expr))
+
+        return terms
+
+    @staticmethod
+    def _and_query(terms):
+        """
+        Join the query expressions of the search terms with an AND operator.
+
+        Returns None if there are no terms.
+
+        """
+        full_query_expr = None
+        for _, _, query_expr in terms:
             if full_query_expr:
-                full_query_expr &= new_query_expr
+                full_query_expr &= query_expr
             else:
-                full_query_expr = new_query_expr
-
+                full_query_expr = query_expr
         return full_query_expr
 
+    def make_search_query(self, search):
+        """
+        Construct TinyDB search query expression from URL parameters.
+
+        A key can appear multiple times. For example:
+
+            ?email=foo@bar.com&email=x@y.com
+
+        This finds all records with email entries that match either one of the
+        two specified emails.
+
+        Returns None if no parameters were provided.
+
+        """
+        return self._and_query(self.make_search_terms(search))
+
     @classmethod
     def get_self_url(cls, *args, **kwargs):
         """
@@ -329,16 +1026,20 @@ class ApiResource:
         self.is_html = False  # pylint: disable=attribute-defined-outside-init
 
         try:
+            not_modified = self.not_modified("json", self.document_version(**kwargs))
+            if not_modified is not None:
+                return not_modified
             # GET on individual resources doesn't support search. The 'make_search_query'
             # function correctly raises an error if it's called on resources that don't
             # support search. Therefore, we just call it here for that error side effect.
-            _ = self.make_search_query(flask.request.args)
+            _ = self.make_search_query(self.search_args())
+            self.parse_fields_and_embeds()
             # We are using kwargs, because the object ID in the URL has different names
             # depending on the resource. The resource _get() implementations therefore use
             # different keyword parameter names, which we don't know here in the base class.
             # allow an exception.
             # pylint: disable=no-member
-            return self._get(**kwargs)
+            return self.select_fields(self._get(**kwargs), self.fields)
         except ValueError as ex:
             flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
 
@@ -351,17 +1052,21 @@ class ApiResource:
             flask_restful.abort(405, message=f"Method not allowed")
         self.is_html = True  # pylint: disable=attribute-defined-outside-init
         try:
+            not_modified = self.not_modified("html", self.document_version(**kwargs))
+            if not_modified is not None:
+                return not_modified
             # Get on individual resources doesn't support search. The 'make_search_query'
             # function correctly raises an error if it's called on resources that don't
             # support search. Therefore, we just call it here for that error side effect.
-            _ = self.make_search_query(flask.request.args)
+            _ = self.make_search_query(self.search_args())
+            self.parse_fields_and_embeds()
             # We are using kwargs, because the object ID in the URL has different names
             # depending on the resource. The resource _get() implementations therefore use
             # different keyword parameter names, which we don't know here in the base class.
             # _get() is defined in the child class, we don't want pylint to complain, so we
             # allow an exception.
             # pylint: disable=no-member
-            return self._htmlify(self._get(**kwargs))
+            return self._htmlify(self.select_fields(self._get(**kwargs), self.fields))
         except ValueError as ex:
             flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
 
@@ -381,15 +1086,66 @@ class ApiResource:
             kwargs['data'] = flask.request.json
             if not kwargs['data']:
                 raise Exception("expected request data")
-            # self.__class__ at this point will be a child class, which actually implements
-            # sanity_check(). We don't want pylint to complain, so allow an exception.
-            # pylint: disable=no-member
-            kwargs['data'], obj = self.__class__.sanity_check(**kwargs)
-            # _put is defined in the child class, only. We don't want pylint to complain, so
-            # we allow an exception.
+            # The check and all the writes of the update are done in a single transaction,
+            # so that they are committed atomically.
+            with _DB.transaction():
+                # self.__class__ at this point will be a child class, which actually
+                # implements sanity_check(). We don't want pylint to complain, so allow an
+                # exception.
+                # pylint: disable=no-member
+                kwargs['data'], obj = self.__class__.sanity_check(**kwargs)
+                self.check_if_match(obj)
+                # _put is defined in the child class, only. We don't want pylint to
+                # complain, so we allow an exception.
+                # pylint: disable=no-member
+                _ = self._put(obj=obj, **kwargs)
+            _notify_changes()
+            resp = flask.make_response({"msg" : "Ok"})
+            # The ETag of the new version, for use in the If-Match of the next update
+            etag = self.etag("json", kwargs['data']['_version'])
+            if etag is not None:
+                resp.set_etag(etag)
+            return resp
+        except ValueError as ex:
+            flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
+
+    @accept('application/json')
+    def patch(self, **kwargs):
+        """
+        Apply a partial update to a resource, and return the result in plain JSON.
+
+        The request body is a JSON merge patch (RFC 7396). Unlike a PUT, which
+        replaces the whole document, a patch only contains the changed keys,
+        and only those are validated and written.
+
+        """
+        if not hasattr(self, "_patch"):
+            flask_restful.abort(405, message="Method not allowed")
+        self.is_html = False  # pylint: disable=attribute-defined-outside-init
+        try:
+            content_type = flask.request.mimetype
+            if content_type not in self.PATCH_CONTENT_TYPES:
+                flask_restful.abort(406, message=f"API only supports "
+                                                 f"'{self.PATCH_CONTENT_TYPES[0]}' "
+                                                 f"Content-Type for PATCH, received: "
+                                                 f"{content_type}")
+            kwargs['data'] = flask.request.json
+            # A merge patch that isn't an object would replace the whole resource, which is
+            # what PUT is for
+            if not isinstance(kwargs['data'], dict) or not kwargs['data']:
+                raise ValueError("expected a JSON object with the changes")
+            # As for a PUT, the check and the write are done in a single transaction. The
+            # sanity_check() and _patch() implementations are in the child class.
             # pylint: disable=no-member
-            _    = self._put(obj=obj, **kwargs)
+            with _DB.transaction():
+                kwargs['data'], obj = self.__class__.sanity_check(patch=True, **kwargs)
+                self.check_if_match(obj)
+                _ = self._patch(obj=obj, **kwargs)
+            _notify_changes()
             resp = flask.make_response({"msg" : "Ok"})
+            etag = self.etag("json", kwargs['data']['_version'])
+            if etag is not None:
+                resp.set_etag(etag)
             return resp
         except ValueError as ex:
             flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
@@ -398,8 +1154,333 @@ class ApiResource:
 class ApiResourceList(ApiResource):
     """
     Base mixin for a generic list of API resources.
+
+    With the URL parameter '_explain=1', the result contains an additional
+    '_explain' section, which describes how the search was performed (see
+    search_table()) and where the time was spent.
+
+    With the URL parameter 'limit', the result is split into pages of at most
+    this many resources. The '_links' of the result then point to the 'next'
+    and 'prev' pages, if there are any. Those links contain an opaque 'cursor'
+    parameter, which identifies the position of the page in the list. Pages
+    are in the order of the resource IDs, so they remain stable while
+    resources are added or removed.
+
+    Lists can be streamed, rather than being built in full before they are
+    sent. This is the case for the 'application/x-ndjson' content type (one
+    JSON resource per line) and with the URL parameter '_stream=1' for JSON.
+    The documents are loaded and embedded in batches while the response is
+    written, so that the memory needed doesn't depend on the length of the
+    list. In a streamed JSON list, 'total_queried' comes after the resources.
+
+    The URL parameter 'fields' selects the fields of the resources in the list
+    (see parse_fields_and_embeds()).
+
+    Child classes specify in ITEMS the path of keys to the list of resources in
+    their result.
+
     """
 
+    ITEMS = "<overwrite in child class>"
+
+    # The class of the individual resources in the list (set at the end of the module)
+    SINGLE_RESOURCE_CLASS = None
+
+    # While a search is explained, this holds the details of the search plan and timings
+    explain = None
+
+    # Whether the list is streamed
+    stream = False
+
+    # The requested page as dictionary of 'limit', 'direction' and 'doc_id' (the latter two
+    # from the cursor, None for the first page). None if the full list was requested.
+    page = None
+
+    # The links to the pages next to the current one, if a page was requested
+    page_links = None
+
+    @staticmethod
+    def _parse_page_args():
+        """
+        Return the requested page, based on the 'limit' and 'cursor' URL parameters.
+        """
+        limit  = flask.request.args.get('limit')
+        cursor = flask.request.args.get('cursor')
+        if limit is None:
+            if cursor is not None:
+                raise ValueError("a cursor can only be used together with a limit")
+            return None
+        try:
+            limit = int(limit)
+        except ValueError as ex:
+            raise ValueError(f"invalid limit: {limit}") from ex
+        if not 1 <= limit <= _MAX_PAGE_LIMIT:
+            raise ValueError(f"limit needs to be between 1 and {_MAX_PAGE_LIMIT}")
+        direction, doc_id = _decode_cursor(cursor) if cursor else (None, None)
+        return {"limit" : limit, "direction" : direction, "doc_id" : doc_id}
+
+    def _page_url(self, direction, doc_id):
+        """
+        Return the URL of the current request, with a cursor for another page.
+        """
+        args           = flask.request.args.copy()
+        args['cursor'] = _encode_cursor(direction, doc_id)
+        return f"{flask.request.path}?{urlencode(list(args.items(multi=True)))}"
+
+    def _get_page(self, table, doc_ids, query):
+        """
+        Return the requested page out of the documents with the specified IDs.
+
+        The IDs need to be in ascending order. Starting at the cursor, the
+        documents are loaded in batches and the query (if any) is applied, until
+        the page is full. One more document than fits on the page is looked for,
+        to find out whether there is a next page. Links to the next and previous
+        pages are stored in 'page_links'.
+
+        Returns the documents on the page and the number of documents that the
+        query was evaluated against.
+
+        """
+        limit, direction, cursor_id = (self.page['limit'], self.page['direction'],
+                                       self.page['doc_id'])
+        if direction == "before":
+            # We walk backwards from the cursor, and turn the page around at the end
+            doc_ids = doc_ids[:bisect.bisect_left(doc_ids, cursor_id)][::-1]
+        elif direction == "after":
+            doc_ids = doc_ids[bisect.bisect_right(doc_ids, cursor_id):]
+
+        # Without a query, every loaded document ends up on the page
+        batch_size = limit + 1 if query is None else max(limit + 1, _SCAN_BATCH)
+        docs       = []
+        scanned    = 0
+        for start in range(0, len(doc_ids), batch_size):
+            batch = table.get_multiple(doc_ids[start:start + batch_size])
+            if query:
+                scanned += len(batch)
+                batch    = [doc for doc in batch if query(doc)]
+            docs.extend(batch)
+            if len(docs) > limit:
+                break
+        has_more = len(docs) > limit
+        docs     = docs[:limit]
+
+        links = {}
+        if direction == "before":
+            docs.reverse()
+            if has_more:
+                links['prev'] = ("before", docs[0].doc_id)
+            links['next'] = ("after", docs[-1].doc_id if docs else cursor_id - 1)
+        else:
+            if has_more:
+                links['next'] = ("after", docs[-1].doc_id)
+            if direction == "after":
+                links['prev'] = ("before", docs[0].doc_id if docs else cursor_id + 1)
+        self.page_links = {name : self._page_url(*cursor) for name, cursor in links.items()}
+        return docs, scanned
+
+    @staticmethod
+    def _flag_arg(name):
+        """
+        Return True if the URL parameter is '1', False if it is '0' or missing.
+        """
+        value = flask.request.args.get(name, "0")
+        if value not in ("0", "1"):
+            raise ValueError(f"invalid value for {name}: {value}")
+        return value == "1"
+
+    @staticmethod
+    def _stream_response(chunks, mimetype):
+        """
+        Return a response, which sends the chunks of text as they are produced.
+        """
+        return flask.Response(flask.stream_with_context(_buffered(chunks)), mimetype=mimetype)
+
+    def _get_items(self, res):
+        """
+        Return the list of resources in a result.
+        """
+        items = res
+        for key in self.ITEMS:
+            items = items[key]
+        return items
+
+    def add_self_links(self, docs, doc_class):
+        """
+        Add a link to its own resource to each of the documents (see _embed_all()).
+
+        The resource class of the documents is passed in as 'doc_class'.
+
+        """
+        def add_self_link(doc):
+            doc['_links'] = self.make_links({'self' : doc_class.get_self_url(doc.doc_id)})
+            return self.select_fields(doc, self.item_fields)
+        return _embed_all(add_self_link, docs)
+
+    def _get_list(self, **kwargs):
+        """
+        Return the list resource, with an explanation of the search if requested.
+        """
+        if self._flag_arg('_explain'):
+            if self.stream:
+                raise ValueError("a streamed list cannot be explained")
+            self.explain = {"plan" : None, "lookup_time" : 0}
+        self.page = self._parse_page_args()
+        self.parse_fields_and_embeds()
+        self.item_fields = self.fields
+
+        start_time = time.perf_counter()
+        # Create a TinyDB query out of the search query expression in the URL. If none was
+        # provided then search_query is None.
+        search_query = self.make_search_query(self.search_args())
+        # We are using kwargs, because the object ID in the URL has different names depending
+        # on the resource. The resource _get() implementations therefore use different
+        # keyword parameter names, which we don't know here in the base class.
+        # _get() is defined in the child class, we don't want pylint to complain, so we allow
+        # an exception.
+        # pylint: disable=no-member
+        res = self._get(query=search_query, **kwargs)
+        if self.page_links:
+            res['_links'].update(self.make_links(self.page_links))
+
+        items = self._get_items(res)
+        if self.stream and not isinstance(items, list):
+            # The number of items is only known once they have all been sent
+            num_items = 0
+
+            def counted(items):
+                nonlocal num_items
+                for item in items:
+                    num_items += 1
+                    yield item
+
+            container = res
+            for key in self.ITEMS[:-1]:
+                container = container[key]
+            container[self.ITEMS[-1]] = counted(items)
+            res['total_queried']      = lambda: num_items
+            return res
+        res['total_queried'] = len(items)
+        if self.explain is None:
+            return res
+
+        # Everything in _get() that wasn't the search is building the result, which mostly
+        # consists of embedding the data of the found resources.
+        get_time    = time.perf_counter() - start_time
+        lookup_time = self.explain['lookup_time']
+        start_time  = time.perf_counter()
+        json.dumps(res)
+        serialization_time = time.perf_counter() - start_time
+
+        res['_explain'] = {
+            "plan"       : self.explain['plan'],
+            "timings_ms" : {
+                "lookup"        : round(lookup_time * 1000, 3),
+                "embedding"     : round((get_time - lookup_time) * 1000, 3),
+                "serialization" : round(serialization_time * 1000, 3)
+            }
+        }
+        return res
+
+    def search_table(self, table, search, candidate_ids=None, **fixed_terms):
+        """
+        Return the documents of a table, which match the search URL parameters.
+
+        Rather than evaluating the full query against every document, the
+        search terms are planned:
+
+        * Each term for an indexed field (and each of the 'fixed_terms', which
+          are field=value conditions that are always applied, for example the
+          customer of a customer's ticket list) is looked up in its index.
+        * The resulting sets of document IDs are intersected, starting with the
+          smallest (most selective) one. The optional 'candidate_ids' take part
+          in this as well.
+        * Only the documents found this way are loaded, and only the terms for
+          fields without index are evaluated against them.
+
+        If no term can be answered from an index then the remaining query is
+        evaluated against all documents of the table. The documents are
+        returned in the order of their IDs. If a page was requested, then
+        only the documents needed for this page are loaded (see _get_page()).
+
+        If the search is explained, then the plan is recorded: The index terms
+        with the number of documents found for each, the terms that had to be
+        evaluated against the documents, and how many documents were scanned
+        and returned.
+
+        """
+        start_time = time.perf_counter()
+        terms      = self.make_search_terms(search)
+        indexed    = [(key, values, False) for key, values, _ in terms
+                      if _is_indexed(table, key)]
+        indexed.extend((field, [value], True) for field, value in fixed_terms.items())
+        filters    = [term for term in terms if not _is_indexed(table, term[0])]
+        query      = self._and_query(filters)
+
+        # A document matches an indexed term if it's found under any of the term's values
+        id_sets = [frozenset().union(*(_index_lookup(table, key, value) for value in values))
+                   for key, values, _ in indexed]
+        index_terms = [{"field"   : key,
+                        "values"  : values,
+                        "index"   : _index_name(table, key),
+                        "fixed"   : fixed,
+                        "matches" : len(id_set)}
+                       for (key, values, fixed), id_set in zip(indexed, id_sets)]
+        plan        = {
+            "table"        : table.name,
+            "index_terms"  : index_terms,
+            "filter_terms" : [key for key, _, _ in filters]
+        }
+        if candidate_ids is not None:
+            id_sets.append(frozenset(candidate_ids))
+            plan['candidates'] = len(candidate_ids)
+
+        if id_sets:
+            id_sets.sort(key=len)
+            doc_ids          = sorted(id_sets[0].intersection(*id_sets[1:]))
+            plan['strategy'] = "index"
+        else:
+            doc_ids          = None
+            plan['strategy'] = "full_scan"
+
+        if self.page is not None:
+            plan['page']  = {"limit" : self.page['limit']}
+            docs, scanned = self._get_page(table,
+                                           table.doc_ids() if doc_ids is None else doc_ids,
+                                           query)
+        elif self.stream:
+            # The documents are loaded while the response is written
+            return self._iter_docs(table, table.doc_ids() if doc_ids is None else doc_ids,
+                                   query)
+        elif doc_ids is None:
+            docs    = table.search(query) if query else table.all()
+            scanned = len(table) if query else 0
+        else:
+            docs    = table.get_multiple(doc_ids) if doc_ids else []
+            scanned = len(docs) if query else 0
+            if query:
+                docs = [doc for doc in docs if query(doc)]
+        plan['scanned']  = scanned
+        plan['returned'] = len(docs)
+
+        if self.explain is not None:
+            self.explain['plan']         = plan
+            self.explain['lookup_time'] += time.perf_counter() - start_time
+        return docs
+
+    @staticmethod
+    def _iter_docs(table, doc_ids, query):
+        """
+        Generate the documents with the specified IDs, which match the query.
+
+        The documents are loaded in batches, so that only a single batch needs
+        to be held in memory at any time.
+
+        """
+        for start in range(0, len(doc_ids), _SCAN_BATCH):
+            for doc in table.get_multiple(doc_ids[start:start + _SCAN_BATCH]):
+                if query is None or query(doc):
+                    yield doc
+
     @accept('application/json')
     def get(self, **kwargs):
         """
@@ -410,16 +1491,36 @@ class ApiResourceList(ApiResource):
         self.is_html = False  # pylint: disable=attribute-defined-outside-init
 
         try:
-            # Create a TinyDB query out of the search query expression in the URL. If none was
-            # provided then search_query is None.
-            search_query = self.make_search_query(flask.request.args)
-            # We are using kwargs, because the object ID in the URL has different names
-            # depending on the resource. The resource _get() implementations therefore use
-            # different keyword parameter names, which we don't know here in the base class.
-            # _get() is defined in the child class, we don't want pylint to complain, so we
-            # allow an exception.
-            # pylint: disable=no-member
-            return self._get(query=search_query, **kwargs)
+            not_modified = self.not_modified("json")
+            if not_modified is not None:
+                return not_modified
+            if self._flag_arg('_stream'):
+                self.stream = True
+                return self._stream_response(_json_chunks(self._get_list(**kwargs)),
+                                             "application/json")
+            return self._get_list(**kwargs)
+        except ValueError as ex:
+            flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
+
+    @get.support('application/x-ndjson')
+    def get_ndjson(self, **kwargs):
+        """
+        Stream the resources of a list as newline delimited JSON.
+
+        Each line holds one resource, as it would appear in the JSON list.
+
+        """
+        if not hasattr(self, "_get"):
+            flask_restful.abort(405, message="Method not allowed")
+        self.is_html = False  # pylint: disable=attribute-defined-outside-init
+        self.stream  = True
+        try:
+            not_modified = self.not_modified("ndjson")
+            if not_modified is not None:
+                return not_modified
+            items = self._get_items(self._get_list(**kwargs))
+            return self._stream_response((json.dumps(item) + "\n" for item in items),
+                                         "application/x-ndjson")
         except ValueError as ex:
             flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
 
@@ -432,16 +1533,10 @@ class ApiResourceList(ApiResource):
             flask_restful.abort(405, message=f"Method not allowed")
         self.is_html = True  # pylint: disable=attribute-defined-outside-init
         try:
-            # Create a TinyDB query out of the search query expression in the URL. If none was
-            # provided then search_query is None.
-            search_query = self.make_search_query(flask.request.args)
-            # We are using kwargs, because the object ID in the URL has different names
-            # depending on the resource. The resource _get() implementations therefore use
-            # different keyword parameter names, which we don't know here in the base class.
-            # _get() is defined in the child class, we don't want pylint to complain, so we
-            # allow an exception.
-            # pylint: disable=no-member
-            return self._htmlify(self._get(query=search_query, **kwargs))
+            not_modified = self.not_modified("html")
+            if not_modified is not None:
+                return not_modified
+            return self._htmlify(self._get_list(**kwargs))
         except ValueError as ex:
             flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
 
@@ -466,16 +1561,169 @@ class ApiResourceList(ApiResource):
             data = flask.request.json
             if not data:
                 raise Exception("expected request data")
-            data, _         = self.SINGLE_RESOURCE_CLASS.sanity_check(data)
-            new_id          = self._post(data)  # pylint: disable=no-member
-            new_url         = self.SINGLE_RESOURCE_CLASS.get_self_url(new_id)
-            new_obj         = self.SINGLE_RESOURCE_CLASS()
-            new_obj.is_html = self.is_html
+            # The check and all the writes for the new resource are done in a single
+            # transaction, so that they are committed atomically.
+            with _DB.transaction():
+                data, _ = self.SINGLE_RESOURCE_CLASS.sanity_check(data)
+                new_id  = self._post(data)  # pylint: disable=no-member
+            _notify_changes()
+            return self._created_response(new_id)
+        except ValueError as ex:
+            flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
+
+    def _created_response(self, new_id, fields=None, is_html=None):
+        """
+        Return the '201 Created' response for a new resource of the list.
+
+        The response contains the new resource, limited to the specified
+        fields (all of them if fields is None). It's rendered as HTML if
+        is_html is set, which defaults to the representation of the request.
+
+        """
+        # SINGLE_RESOURCE_CLASS is only set for the child classes
+        new_url         = self.SINGLE_RESOURCE_CLASS.get_self_url(new_id)
+        new_obj         = self.SINGLE_RESOURCE_CLASS()  # pylint: disable=not-callable
+        new_obj.is_html = self.is_html if is_html is None else is_html
+        new_obj.fields  = fields
+        # Tightly cooperating classes, we will allow the protected access
+        new_obj_data    = new_obj._get(new_id)  # pylint: disable=protected-access
+        resp            = flask.make_response(self.select_fields(new_obj_data, fields), 201)
+        resp.headers.extend({"Location" : new_url})
+        return resp
+
+
+class ApiResourceBulk(ApiResource):
+    """
+    Base mixin for the bulk creation of resources in a list.
+
+    A POST to a bulk resource creates many resources of LIST_CLASS at once.
+    The request body is either a JSON array of the resources, or NDJSON with
+    one resource per line. Each resource is checked and created as if it had
+    been POSTed to the list on its own, but all of them are written in a
+    single transaction. The request body is read completely before the
+    transaction starts, so that a slow client doesn't hold up other requests.
+
+    A resource that fails its sanity check doesn't stop the others from
+    being created. The response has an entry for each resource in the
+    request, in the same order, with the HTTP status of its creation, and
+    either a link to the new resource or the error message.
+
+    """
+
+    # The list resource class, in which the resources are created (set in the child class)
+    LIST_CLASS = ApiResourceList
+
+    # The content types of NDJSON request bodies
+    NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson")
+
+    # There is nothing to GET
+    def _get(self):
+        flask_restful.abort(405, message="Method not allowed")
+
+    def _items(self):
+        """
+        Return an iterator over the resources in the request body.
+
+        NDJSON is parsed line by line as it is read. A line that isn't valid
+        JSON is returned as the ValueError describing the problem, so that it
+        can be reported for that line.
+
+        """
+        content_type = flask.request.mimetype
+        if content_type == "application/json":
+            items = flask.request.json
+            if not isinstance(items, list):
+                raise ValueError("expected a JSON array of resources")
+            return iter(items)
+        if content_type in self.NDJSON_CONTENT_TYPES:
+            return self._ndjson_items(flask.request.stream)
+        flask_restful.abort(406, message=f"API only supports 'application/json' or "
+                                         f"'{self.NDJSON_CONTENT_TYPES[0]}' Content-Type, "
+                                         f"received: {content_type}")
+        return None
+
+    @staticmethod
+    def _ndjson_items(stream):
+        """
+        Yield the resources in the lines of an NDJSON stream.
+        """
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as ex:
+                yield ValueError(f"invalid JSON: {str(ex)}")
+
+    def _read_items(self, max_items):
+        """
+        Return a list of the resources in the request body.
+
+        A resource that isn't a JSON object (or a line of NDJSON that isn't
+        valid JSON) is replaced by the ValueError describing the problem, so
+        that it can be reported for that resource. Raises a ValueError if
+        there are more than 'max_items' resources.
+
+        """
+        items = []
+        for item in self._items():
+            if len(items) == max_items:
+                raise ValueError(f"at most {max_items} resources can be created at once")
+            if not isinstance(item, ValueError) and (not isinstance(item, dict) or not item):
+                item = ValueError("expected a JSON object")
+            items.append(item)
+        return items
+
+    def _create(self, list_resource, item):
+        """
+        Create a resource in the list and return its entry for the response.
+
+        This is called in the transaction of the whole request. A failure
+        doesn't write anything, so the transaction can carry on with the next
+        resource.
+
+        """
+        single_class = self.LIST_CLASS.SINGLE_RESOURCE_CLASS
+        try:
+            if isinstance(item, ValueError):
+                raise item
+            data, _ = single_class.sanity_check(item)
             # Tightly cooperating classes, we will allow the protected access
-            new_obj_data    = new_obj._get(new_id)  # pylint: disable=protected-access
-            resp            = flask.make_response(new_obj_data, 201)
-            resp.headers.extend({"Location" : new_url})
-            return resp
+            new_id  = list_resource._post(data)  # pylint: disable=protected-access
+        except ValueError as ex:
+            return {"status" : 400, "message" : f"Bad Request - {str(ex)}"}
+        except HTTPException as ex:
+            # Raised by flask_restful.abort(), which keeps the message in the data
+            message = getattr(ex, "data", {}).get("message", ex.description)
+            return {"status" : ex.code, "message" : message}
+        except Exception as ex:  # pylint: disable=broad-except
+            # Anything else would fail a POST of the resource on its own with a server error,
+            # for example a value of an unexpected type, for which a check isn't prepared. It
+            # is reported for this resource, rather than failing all others as well.
+            message = f"Internal Server Error - {type(ex).__name__}: {str(ex)}"
+            return {"status" : 500, "message" : message}
+        return {
+            "status" : 201,
+            "id"     : new_id,
+            "_links" : self.make_links({"self" : single_class.get_self_url(new_id)})
+        }
+
+    @accept('application/json')
+    def post(self):
+        """
+        Create the resources in the request body.
+        """
+        self.is_html = False  # pylint: disable=attribute-defined-outside-init
+        try:
+            items         = self._read_items(app.config.get('BULK_MAX_ITEMS', 10000))
+            list_resource = self.LIST_CLASS()
+            with _DB.transaction():
+                results = [self._create(list_resource, item) for item in items]
+            _notify_changes()
+            return {
+                "errors" : any(res['status'] != 201 for res in results),
+                "items"  : results
+            }
         except ValueError as ex:
             flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
 
@@ -490,20 +1738,28 @@ class _UserDataEmbedder:
     """
 
     def embed_user_data_in_result(self, user_data):
-        res = []
-        for user in user_data:
-            d = {
-                    "id"       : user.doc_id,
-                    "email"    : user['email'],
-                    "_created" : user.get('_created', ''),
-                    # make_links is provided by the class using this mixin
-                    # pylint: disable=no-member
-                    "_links"   : self.make_links({"self" : User.get_self_url(user.doc_id)})
-            }
-            if '_updated' in user:
-                d['_updated'] = user['_updated']
-            res.append(d)
-        return res
+        """
+        Return the embedded representation of each user (see _embed_all()).
+        """
+        return _embed_all(self.embed_user_data, user_data)
+
+    def embed_user_data(self, user):
+        """
+        Return the embedded representation of a single user.
+        """
+        d = {
+                "id"       : user.doc_id,
+                "email"    : user['email'],
+                "_created" : user.get('_created', ''),
+                # make_links is provided by the class using this mixin
+                # pylint: disable=no-member
+                "_links"   : self.make_links({"self" : User.get_self_url(user.doc_id)})
+        }
+        if '_updated' in user:
+            d['_updated'] = user['_updated']
+        # item_fields is provided by the class using this mixin
+        # pylint: disable=no-member
+        return self.select_fields(d, self.item_fields)
 
 
 class _CustomerDataEmbedder:
@@ -512,22 +1768,30 @@ class _CustomerDataEmbedder:
     """
 
     def embed_customer_data_in_result(self, cust_data):
-        res = []
-        for cust in cust_data:
-            d = {
-                    "id"       : cust.doc_id,
-                    "name"     : cust['name'],
-                    "_created" : cust.get('_created', ''),
-                    # make_links is provided by the class using this mixin
-                    # pylint: disable=no-member
-                    "_links"   : self.make_links({
-                                     "self" : Customer.get_self_url(cust.doc_id)}
-                                 )
-            }
-            if '_updated' in cust:
-                d['_updated'] = cust['_updated']
-            res.append(d)
-        return res
+        """
+        Return the embedded representation of each customer (see _embed_all()).
+        """
+        return _embed_all(self.embed_customer_data, cust_data)
+
+    def embed_customer_data(self, cust):
+        """
+        Return the embedded representation of a single customer.
+        """
+        d = {
+                "id"       : cust.doc_id,
+                "name"     : cust['name'],
+                "_created" : cust.get('_created', ''),
+                # make_links is provided by the class using this mixin
+                # pylint: disable=no-member
+                "_links"   : self.make_links({
+                                 "self" : Customer.get_self_url(cust.doc_id)}
+                             )
+        }
+        if '_updated' in cust:
+            d['_updated'] = cust['_updated']
+        # item_fields is provided by the class using this mixin
+        # pylint: disable=no-member
+        return self.select_fields(d, self.item_fields)
 
 
 class _TicketDataEmbedder:
@@ -536,27 +1800,35 @@ class _TicketDataEmbedder:
     """
 
     def embed_ticket_data_in_result(self, ticket_data):
-        res = []
-        for ticket in ticket_data:
-            d = {
-                    "id"             : ticket.doc_id,
-                    "aportio_id"     : ticket['aportio_id'],
-                    "customer_id"    : ticket['customer_id'],
-                    "user_id"        : ticket['user_id'],
-                    "short_title"    : ticket['short_title'],
-                    "_created"       : ticket.get('_created', ''),
-                    "status"         : ticket['status'],
-                    "classification" : ticket['classification'].get("l1", "(none)"),
-                    # make_links is provided by the class using this mixin
-                    # pylint: disable=no-member
-                    "_links"         : self.make_links({
-                                           "self" : Ticket.get_self_url(ticket.doc_id)
-                                       })
-            }
-            if '_updated' in ticket:
-                d['_updated'] = ticket['_updated']
-            res.append(d)
-        return res
+        """
+        Return the embedded representation of each ticket (see _embed_all()).
+        """
+        return _embed_all(self.embed_ticket_data, ticket_data)
+
+    def embed_ticket_data(self, ticket):
+        """
+        Return the embedded representation of a single ticket.
+        """
+        d = {
+                "id"             : ticket.doc_id,
+                "aportio_id"     : ticket['aportio_id'],
+                "customer_id"    : ticket['customer_id'],
+                "user_id"        : ticket['user_id'],
+                "short_title"    : ticket['short_title'],
+                "_created"       : ticket.get('_created', ''),
+                "status"         : ticket['status'],
+                "classification" : ticket['classification'].get("l1", "(none)"),
+                # make_links is provided by the class using this mixin
+                # pylint: disable=no-member
+                "_links"         : self.make_links({
+                                       "self" : Ticket.get_self_url(ticket.doc_id)
+                                   })
+        }
+        if '_updated' in ticket:
+            d['_updated'] = ticket['_updated']
+        # item_fields is provided by the class using this mixin
+        # pylint: disable=no-member
+        return self.select_fields(d, self.item_fields)
 
 
 # ===============================
@@ -590,6 +1862,7 @@ class Root(flask_restful.Resource, ApiResource):
                 "comments"                   : CommentList.get_self_url(),
                 "attachments"                : AttachmentList.get_self_url(),
                 "customer_user_associations" : CustomerUserAssociationList.get_self_url(),
+                "changes"                    : ChangeStream.get_self_url(),
             })
         }
 
@@ -613,22 +1886,26 @@ class UserList(flask_restful.Resource, ApiResourceList, _UserDataEmbedder):
     """
 
     URL                 = "/users"
+    ETAG_TABLES         = ("users",)
+    ITEMS               = ("_embedded", "users")
     VALID_SEARCH_FIELDS = {
+        "id"              : int,
         "email"           : list,
-        "custom_fields.*" : dict
+        "custom_fields.*" : dict,
+        **_TIMESTAMP_SEARCH_FIELDS
     }
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, query=None):
         """
         Return the user table data.
         """
-        if not query:
-            user_data = DB_USER_TABLE.all()
-        else:
-            user_data = DB_USER_TABLE.search(query)
+        # Searches by email are served from the (case insensitive) email index
+        user_data = self.search_table(DB_USER_TABLE, self.search_args())
 
         res = {
-            "total_queried" : len(user_data),
             "_embedded" : {
                 "users" : self.embed_user_data_in_result(user_data)
             },
@@ -665,23 +1942,26 @@ class CustomerList(flask_restful.Resource, ApiResourceList, _CustomerDataEmbedde
     """
 
     URL                 = "/customers"
+    ETAG_TABLES         = ("customers",)
+    ITEMS               = ("_embedded", "customers")
     VALID_SEARCH_FIELDS = {
+        "id"              : int,
         "name"            : str,
         "parent_id"       : int,
         "custom_fields.*" : dict,
+        **_TIMESTAMP_SEARCH_FIELDS
     }
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, query=None):
         """
         Return the customer list.
         """
-        if not query:
-            cust_data = DB_CUSTOMER_TABLE.all()
-        else:
-            cust_data = DB_CUSTOMER_TABLE.search(query)
+        cust_data = self.search_table(DB_CUSTOMER_TABLE, self.search_args())
 
         res = {
-            "total_queried" : len(cust_data),
             "_embedded"     : {
                 "customers" : self.embed_customer_data_in_result(cust_data)
             },
@@ -708,27 +1988,32 @@ class TicketList(flask_restful.Resource, ApiResourceList, _TicketDataEmbedder):
     """
 
     URL                 = "/tickets"
+    ETAG_TABLES         = ("tickets",)
+    ITEMS               = ("_embedded", "tickets")
     VALID_SEARCH_FIELDS = {
+        "id"              : int,
         "aportio_id"       : str,
         "customer_id"      : int,
         "user_id"          : int,
         "short_title"      : str,
         "status"           : str,
         "classification.*" : dict,
-        "custom_fields.*"  : dict
+        "custom_fields.*"  : dict,
+        **_TIMESTAMP_SEARCH_FIELDS
     }
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, query=None):
         """
         Return the ticket table data.
         """
-        if not query:
-            ticket_data = DB_TICKET_TABLE.all()
-        else:
-            ticket_data = DB_TICKET_TABLE.search(query)
+        # Aportio frequently looks up tickets by their aportio ID, which is served from the
+        # unique index.
+        ticket_data = self.search_table(DB_TICKET_TABLE, self.search_args())
 
         res = {
-            "total_queried" : len(ticket_data),
             "_embedded"     : {
                 "tickets" : self.embed_ticket_data_in_result(ticket_data)
             },
@@ -744,6 +2029,7 @@ class TicketList(flask_restful.Resource, ApiResourceList, _TicketDataEmbedder):
         Process the addition of a ticket.
         """
         new_ticket_id = DB_TICKET_TABLE.insert(data)
+        _record_change(Ticket, new_ticket_id, "create")
         return new_ticket_id
 
 
@@ -763,7 +2049,14 @@ class CommentList(flask_restful.Resource, ApiResourceList):
 
     """
 
-    URL = "/comments"
+    URL         = "/comments"
+    ETAG_TABLES = ("comments",)
+    ITEMS       = ("comments",)
+
+    VALID_SEARCH_FIELDS = {
+        "id" : int,
+        **_TIMESTAMP_SEARCH_FIELDS
+    }
 
     # All list resources get a query parameter from the parent class, even if they don't
     # all support it.
@@ -772,13 +2065,9 @@ class CommentList(flask_restful.Resource, ApiResourceList):
         """
         Return the list of all comments/worknotes.
         """
-        comments = DB_COMMENT_TABLE.all()
-        for comment in comments:
-            comment['_links'] = self.make_links({
-                'self' : Comment.get_self_url(comment.doc_id)
-            })
+        comments = self.search_table(DB_COMMENT_TABLE, self.search_args())
+        comments = self.add_self_links(comments, Comment)
         res = {
-            "total_queried" : len(comments),
             "comments"      : comments,
             "_links" : self.make_links({
                            "self"         : CommentList.get_self_url(),
@@ -792,6 +2081,7 @@ class CommentList(flask_restful.Resource, ApiResourceList):
         Process the addition of a comment to a ticket.
         """
         new_comment_id = DB_COMMENT_TABLE.insert(data)
+        _record_change(Comment, new_comment_id, "create")
         return new_comment_id
 
 
@@ -809,7 +2099,14 @@ class AttachmentList(flask_restful.Resource, ApiResourceList):
 
     """
 
-    URL = "/attachments"
+    URL         = "/attachments"
+    ETAG_TABLES = ("attachments",)
+    ITEMS       = ("attachments",)
+
+    VALID_SEARCH_FIELDS = {
+        "id" : int,
+        **_TIMESTAMP_SEARCH_FIELDS
+    }
 
     # All list resources get a query parameter from the parent class, even if they don't
     # all support it.
@@ -818,13 +2115,9 @@ class AttachmentList(flask_restful.Resource, ApiResourceList):
         """
         Return the list of all attachments.
         """
-        attachments = DB_ATTACHMENT_TABLE.all()
-        for attachment in attachments:
-            attachment['_links'] = self.make_links({
-                'self' : Attachment.get_self_url(attachment.doc_id)
-            })
+        attachments = self.search_table(DB_ATTACHMENT_TABLE, self.search_args())
+        attachments = self.add_self_links(attachments, Attachment)
         res = {
-            "total_queried" : len(attachments),
             "attachments"   : attachments,
             "_links" : self.make_links({
                            "self"         : AttachmentList.get_self_url(),
@@ -833,79 +2126,191 @@ class AttachmentList(flask_restful.Resource, ApiResourceList):
         }
         return res
 
+    @accept('application/json')
+    def post(self):
+        """
+        Create an attachment from a JSON document, a form or the raw file.
+
+        A JSON document has the file base64 encoded in 'attachment_data'. It is
+        parsed while it is read, and the file is decoded straight to disk, so
+        that only the other fields are held in memory. As an alternative, the
+        file can be uploaded as it is, which is streamed to disk as well:
+
+        * As 'multipart/form-data', with the file in the 'attachment_data'
+          field and 'ticket_id' as another field. The file name and content
+          type are taken from the file field, unless 'filename' and
+          'content_type' fields are given.
+        * As the raw request body with the content type of the file, and
+          'ticket_id' and 'filename' as URL parameters.
+
+        The response to an upload doesn't repeat the file.
+
+        """
+        self.is_html = False  # pylint: disable=attribute-defined-outside-init
+        uploads      = []
+        try:
+            if flask.request.mimetype == "application/json":
+                data = self._read_json_upload(uploads)
+            elif flask.request.mimetype == "multipart/form-data":
+                data = self._read_form_upload(uploads)
+            else:
+                data = self._read_raw_upload(uploads)
+            return self._create(data)
+        except ValueError as ex:
+            flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
+        finally:
+            # Uploads, which didn't become an attachment
+            for upload in uploads:
+                upload.discard()
+
+    def _create(self, data, in_transaction=None):
+        """
+        Create an attachment from an upload and return the '201 Created' response.
+
+        Reading the upload can take a while, so only the check and the writes
+        are done in a transaction, in which the optional function
+        in_transaction is called as well. The response is JSON and doesn't
+        repeat the file.
+
+        """
+        self.new_blobs = []  # pylint: disable=attribute-defined-outside-init
+        try:
+            with _DB.transaction():
+                data, _ = Attachment.sanity_check(data)
+                new_id  = self._post(data)
+                if in_transaction is not None:
+                    in_transaction()
+            _notify_changes()
+            return self._created_response(new_id, fields={"id", *data}, is_html=False)
+        finally:
+            # Stored files, if the transaction was rolled back after they were stored
+            Attachment.release_blobs(self.new_blobs)
+
+    @staticmethod
+    def _read_json_upload(uploads):
+        """
+        Return the attachment data of a JSON document with the base64 encoded file.
+        """
+        data = parse_json_upload(flask.request.stream, _ATTACHMENT_STAGING, "attachment_data",
+                                 _MAX_FORM_MEMORY)
+        if isinstance(data.get('attachment_data'), StagedFile):
+            uploads.append(data['attachment_data'])
+        return data
+
+    @staticmethod
+    def _read_form_upload(uploads):
+        """
+        Return the attachment data of a 'multipart/form-data' upload.
+
+        The file in the form is written to a staging file as it is parsed. All
+        staging files are added to the list of uploads.
+
+        """
+        # pylint: disable=unused-argument
+        def stream_factory(total_content_length, content_type, filename,
+                           content_length=None):
+            uploads.append(StagedFile(_ATTACHMENT_STAGING))
+            return uploads[-1]
+
+        _, form, files = parse_form_data(flask.request.environ, stream_factory=stream_factory,
+                                         max_form_memory_size=_MAX_FORM_MEMORY)
+        data = form.to_dict()
+        file = files.get('attachment_data')
+        if file is not None:
+            data['attachment_data'] = file.stream
+            data.setdefault('filename', file.filename)
+            data.setdefault('content_type', file.mimetype or "application/octet-stream")
+        return data
+
+    @staticmethod
+    def _read_raw_upload(uploads):
+        """
+        Return the attachment data of an upload of the raw file.
+
+        The metadata is checked before the file is read, so that a bad request
+        is refused before the file has been transferred.
+
+        """
+        data = flask.request.args.to_dict()
+        data['content_type']    = flask.request.mimetype or "application/octet-stream"
+        data['attachment_data'] = None
+        Attachment.sanity_check(dict(data))
+        uploads.append(StagedFile(_ATTACHMENT_STAGING))
+        uploads[-1].write_from(flask.request.stream)
+        data['attachment_data'] = uploads[-1]
+        return data
+
     def _post(self, data):
         """
         Process the addition of an attachment to a ticket.
         """
-        # Attachment files have a unique name generated for them when saving to server-side
-        # storage that looks like so:
-        #
-        # <attachment_id>__<filename>
-        #
-        # For example:
-        # 1__errors.log
-        #
-        # The directory structure of saved attachment files looks like this:
+        # Attachment files are stored by the SHA-256 hash of their content, so that the same
+        # file (for example the logo in an email signature) is only stored once, no matter
+        # how often it is attached. The attachments, which share a file, are found via the
+        # 'sha256' index. The directory structure of saved attachment files looks like this:
         #
         # attachment_storage/
-        #     ticket__<ticket_id>/
-        #         <unique_filename>
+        #     blobs/
+        #         <first two digits of the hash>/
+        #             <hash>
         #
         # For example:
         #
         # attachment_storage/
-        #     ticket__1/
-        #         1__errors.log
+        #     blobs/
+        #         0b/
+        #             0b4a1e...
+        #         e3/
+        #             e3b0c4...
         #
-        #     ticket__2/
-        #         2__some_image.jpg
-        #         3__some_doc.docx
-        #
-        #     ticket__3/
-        #         4__requirements.txt
-        #
-        # Note here that the numbered directories are Ticket IDs, and the numbers prefixing
-        # the file name are the attachment IDs.
-
-        # We first need to get the base64 encoded attachment out of the data, so that the
-        # attachment file is not saved to disk twice (as a file and as a base64 string)
-        attachment_data   = data.pop('attachment_data')
-        new_attachment_id = DB_ATTACHMENT_TABLE.insert(data)
-
+        # Attachments, which were stored before, may still have their file in the directory
+        # of their ticket, named by attachment ID and file name (see Attachment.file_path()).
+
+        # We first need to get the attachment out of the data, so that the attachment file is
+        # not saved to disk twice (as a file and as a base64 string). An uploaded file has
+        # already been written to a staging file, a base64 string is decoded and written to
+        # one now. The staging file is then moved into place.
+        upload            = data.pop('attachment_data')
+        decoded_data      = None
+        new_attachment_id = None
         try:
-            # Decode the attachment data
-            decoded_attachment_data = base64.b64decode(attachment_data)
-
-            # The filename is expected to exist in the data because it is a mandatory key.
-            filename        = data['filename']
-            unique_filename = f"{new_attachment_id}__{filename}"
-
-            # Create the paths to the directory and the attachment file
-            dir_path     = os.path.join(_ATTACHMENT_FOLDER,
-                                        f"ticket__{str(data['ticket_id'])}")
-            path_to_file = os.path.join(dir_path, unique_filename)
-
-            # Make the directory for the attachment if it doesn't already exist, then save the
-            # attachment file.
-            os.makedirs(dir_path, exist_ok=True)
-            with open(path_to_file, "wb") as attachment_file:
-                attachment_file.write(decoded_attachment_data)
+            if not isinstance(upload, StagedFile):
+                # Decode the attachment data
+                decoded_data = base64.b64decode(upload)
+                upload       = StagedFile(_ATTACHMENT_STAGING)
+            elif upload.error is not None:
+                # The attachment data couldn't be decoded while it was read
+                raise upload.error
+            with upload:
+                if decoded_data is not None:
+                    upload.write(decoded_data)
+                # The size and hash of the file are computed while it is written
+                data['size']      = upload.size
+                data['sha256']    = upload.sha256
+                new_attachment_id = DB_ATTACHMENT_TABLE.insert(data)
+                # If the file is stored already, then the attachment only needs the record,
+                # and the upload is discarded
+                blob_path = Attachment.blob_path(upload.sha256)
+                if not os.path.exists(blob_path):
+                    upload.commit(blob_path)
+                    self.new_blobs.append(upload.sha256)
         except OSError:
             # Trying to save the decoded attachment file to disk went wrong. Rollback the
             # database entry and return a 500 error.
             # Note that since Python 3.3, IOError became an alias for OSError, hence OSError is
             # the actual exception that will occur.
-            DB_ATTACHMENT_TABLE.remove(doc_ids=[new_attachment_id])
+            if new_attachment_id is not None:
+                DB_ATTACHMENT_TABLE.remove(doc_ids=[new_attachment_id])
             flask_restful.abort(500, message="Error occured while trying to save attachment "
                                              "file data")
         except Exception:
-            # Some error occured while trying to decode the attachment file data. Rollback the
-            # database entry and return a 500 error.
-            DB_ATTACHMENT_TABLE.remove(doc_ids=[new_attachment_id])
+            # Some error occured while trying to decode the attachment file data. Return a 500
+            # error.
             flask_restful.abort(500, message="Error occured while trying to decode "
                                              "attachment file data")
 
         # If we get here, everything went fine. Return the new attachment ID.
+        _record_change(Attachment, new_attachment_id, "create")
         return new_attachment_id
 
 
@@ -923,7 +2328,9 @@ class CustomerUserAssociationList(flask_restful.Resource, ApiResourceList):
 
     """
 
-    URL = "/customer_user_associations"
+    URL         = "/customer_user_associations"
+    ETAG_TABLES = ("user_customer_rels",)
+    ITEMS       = ("associations",)
 
     # All list resources get a query parameter from the parent class, even if they don't
     # all support it.
@@ -932,13 +2339,9 @@ class CustomerUserAssociationList(flask_restful.Resource, ApiResourceList):
         """
         Return the list of associations.
         """
-        associations = DB_USER_CUSTOMER_RELS_TABLE.all()
-        for association in associations:
-            association['_links'] = self.make_links({
-                'self' : CustomerUserAssociation.get_self_url(association.doc_id)
-            })
+        associations = self.search_table(DB_USER_CUSTOMER_RELS_TABLE, self.search_args())
+        associations = self.add_self_links(associations, CustomerUserAssociation)
         res = {
-            "total_queried" : len(associations),
             "associations"  : associations,
             "_links" : self.make_links({
                            "self"         : CustomerUserAssociationList.get_self_url(),
@@ -964,10 +2367,7 @@ class CustomerUserAssociationList(flask_restful.Resource, ApiResourceList):
         user_id = data['user_id']
 
         # Now check if we have this association already
-        assoc_q    = Query()
-        assoc_data = DB_USER_CUSTOMER_RELS_TABLE.search((assoc_q.customer_id == cust_id) &
-                                                        (assoc_q.user_id     == user_id))
-        if assoc_data:
+        if DB_USER_CUSTOMER_RELS_INDEX.contains(customer_id=cust_id, user_id=user_id):
             flask_restful.abort(400, message="Bad Request - association between customer "
                                              "and user exists already")
 
@@ -1001,7 +2401,8 @@ class User(flask_restful.Resource, ApiResource):
 
     """
 
-    URL = UserList.URL + "/<user_id>"
+    URL         = UserList.URL + "/<user_id>"
+    ETAG_TABLES = ("users",)
 
     @classmethod
     def exists(cls, user_id):
@@ -1034,9 +2435,9 @@ class User(flask_restful.Resource, ApiResource):
         return res
 
     @classmethod
-    def sanity_check(cls, data, user_id=None):
+    def sanity_check(cls, data, user_id=None, patch=False):
         """
-        Perform sanity check for POST/PUT user data.
+        Perform sanity check for POST/PUT/PATCH user data.
         """
         if user_id is not None:
             user_id = int(user_id)
@@ -1057,16 +2458,14 @@ class User(flask_restful.Resource, ApiResource):
             for e in email_list:
                 # raises exception if malformed email
                 validators.email(e)
-                # check if any user has this email already
-                UserQuery = Query()
-                user_set_similar_email = DB_USER_TABLE.search(UserQuery.email.any(e))
-                for user in user_set_similar_email:
+                # check if any user has this email already (regardless of case)
+                for user in DB_USER_TABLE.search_by(email=e):
                     if user_id is not None and (str(user.doc_id) == str(user_id)):
                         # We will match ourselves if some emails are still the same, but
                         # that's ok, so skip this check
                         continue
                     for email in user['email']:
-                        if e == email:
+                        if _normalize_email(e) == _normalize_email(email):
                             raise ValueError(f"user with email '{email}' exists already")
                 ret.append(e)
             return ret
@@ -1075,7 +2474,7 @@ class User(flask_restful.Resource, ApiResource):
         data = _dict_sanity_check(data,
                                   mandatory_keys = [("email", validate_emails)],
                                   optional_keys = [("custom_fields", dict)],
-                                  obj=user)
+                                  obj=user, patch=patch)
         return data, user
 
     def _put(self, data, user_id, obj):
@@ -1096,6 +2495,14 @@ class User(flask_restful.Resource, ApiResource):
         DB_USER_TABLE.update(data, doc_ids=[user_id])
         return User.get_self_url(user_id=user_id)
 
+    def _patch(self, data, user_id, obj):  # pylint: disable=unused-argument
+        """
+        Process a PATCH to change some keys of an existing user.
+        """
+        user_id = int(user_id)
+        _patch_document(DB_USER_TABLE, user_id, data)
+        return User.get_self_url(user_id=user_id)
+
 
 class Customer(flask_restful.Resource, ApiResource):
     """
@@ -1114,7 +2521,10 @@ class Customer(flask_restful.Resource, ApiResource):
 
     """
 
-    URL = CustomerList.URL + "/<customer_id>"
+    URL          = CustomerList.URL + "/<customer_id>"
+    ETAG_TABLES  = ("customers",)
+    NAME_MIN_LEN = 1
+    NAME_MAX_LEN = 300
 
     @classmethod
     def exists(cls, customer_id):
@@ -1153,6 +2563,47 @@ class Customer(flask_restful.Resource, ApiResource):
         res['_links'] = self.make_links(link_spec)
         return res
 
+    @classmethod
+    def sanity_check(cls, data, customer_id=None, patch=False):
+        """
+        Perform sanity check for POST/PUT/PATCH customer data.
+        """
+        if customer_id is not None:
+            customer_id = int(customer_id)
+            customer    = DB_CUSTOMER_TABLE.get(doc_id=customer_id)
+            if not customer:
+                flask_restful.abort(404, message=f"customer '{customer_id}' not found!")
+        else:
+            customer = None
+
+        # A custom validator for the name
+        def validate_name(text):
+            return _str_len_check(text, cls.NAME_MIN_LEN, cls.NAME_MAX_LEN)
+
+        # A custom validator for the parent, which needs to be some other customer
+        def validate_parent_id(parent_id):
+            parent_id = Customer.exists(parent_id)
+            if parent_id == customer_id:
+                raise ValueError("a customer can't be its own parent")
+            return parent_id
+
+        data = _dict_sanity_check(data,
+                                  mandatory_keys = [("name", validate_name)],
+                                  optional_keys = [
+                                      ("parent_id", validate_parent_id),
+                                      ("custom_fields", dict)
+                                  ],
+                                  obj=customer, patch=patch)
+        return data, customer
+
+    def _patch(self, data, customer_id, obj):  # pylint: disable=unused-argument
+        """
+        Process a PATCH to change some keys of an existing customer.
+        """
+        customer_id = int(customer_id)
+        _patch_document(DB_CUSTOMER_TABLE, customer_id, data)
+        return Customer.get_self_url(customer_id=customer_id)
+
 
 class Ticket(flask_restful.Resource, ApiResource):
     """
@@ -1204,10 +2655,14 @@ class Ticket(flask_restful.Resource, ApiResource):
     """
 
     URL                 = TicketList.URL + "/<ticket_id>"
+    ETAG_TABLES         = ("tickets", "comments", "attachments")
     SHORT_TITLE_MIN_LEN = 2
     SHORT_TITLE_MAX_LEN = 300
     LONG_TEXT_MIN_LEN   = 0
     LONG_TEXT_MAX_LEN   = 25000000
+    EMBEDS              = ("comments", "worknotes", "attachments")
+    FIXED_KEYS          = (("user_id", "user ID"), ("customer_id", "customer ID"),
+                           ("aportio_id", "aportio ID"))
 
     @classmethod
     def exists(cls, ticket_id):
@@ -1273,24 +2728,26 @@ class Ticket(flask_restful.Resource, ApiResource):
         ticket    = DB_TICKET_TABLE.get(doc_id=ticket_id)
         if not ticket:
             flask_restful.abort(404, message=f"Ticket '{ticket_id}' not found!")
-        # Receive information about all comments and worknotes for this ticket
-        comments_q = Query()
-        comments   = DB_COMMENT_TABLE.search((comments_q.ticket_id == ticket_id) &
-                                             (comments_q.type      == Comment.TYPE_COMMENT))
-        worknotes  = DB_COMMENT_TABLE.search((comments_q.ticket_id == ticket_id) &
-                                             (comments_q.type      == Comment.TYPE_WORKNOTE))
-        # Receive information about all attachments for this ticket
-        attachment_q = Query()
-        attachments  = DB_ATTACHMENT_TABLE.search(attachment_q.ticket_id == ticket_id)
         res = {
             "id" : ticket.doc_id,
         }
         res.update(ticket)
-        res['_embedded'] = {
-            "comments"    : self._embed_comment_data_in_result(comments),
-            "worknotes"   : self._embed_comment_data_in_result(worknotes),
-            "attachments" : self._embed_attachment_data_in_result(attachments),
-        }
+        # Only look up the comments, worknotes and attachments of this ticket if they are
+        # to be embedded
+        embedded = {}
+        if self.wants_embed("comments"):
+            comments = DB_COMMENT_TABLE.search_by(ticket_id=ticket_id,
+                                                  type=Comment.TYPE_COMMENT)
+            embedded['comments'] = self._embed_comment_data_in_result(comments)
+        if self.wants_embed("worknotes"):
+            worknotes = DB_COMMENT_TABLE.search_by(ticket_id=ticket_id,
+                                                   type=Comment.TYPE_WORKNOTE)
+            embedded['worknotes'] = self._embed_comment_data_in_result(worknotes)
+        if self.wants_embed("attachments"):
+            attachments = DB_ATTACHMENT_TABLE.search_by(ticket_id=ticket_id)
+            embedded['attachments'] = self._embed_attachment_data_in_result(attachments)
+        if embedded:
+            res['_embedded'] = embedded
         res['_links'] = self.make_links({
                             "self"         : Ticket.get_self_url(ticket.doc_id),
                             "contained_in" : TicketList.get_self_url(),
@@ -1330,9 +2787,9 @@ class Ticket(flask_restful.Resource, ApiResource):
         return classification_dict
 
     @classmethod
-    def sanity_check(cls, data, ticket_id=None):
+    def sanity_check(cls, data, ticket_id=None, patch=False):
         """
-        Perform sanity check for POST/PUT ticket data.
+        Perform sanity check for POST/PUT/PATCH ticket data.
 
         If a ticket ID was specified, this also looks up the object in the DB
         and returns this object.
@@ -1353,9 +2810,7 @@ class Ticket(flask_restful.Resource, ApiResource):
         def validate_aportio_id(aportio_id):
             if not isinstance(aportio_id, str):
                 raise ValueError("expected string type for aportio ID")
-            TicketQuery = Query()
-            ticket_with_aportio_id = DB_TICKET_TABLE.get(
-                                                    TicketQuery.aportio_id == aportio_id)
+            ticket_with_aportio_id = DB_TICKET_TABLE.get_by(aportio_id=aportio_id)
             if ticket_with_aportio_id and (ticket_with_aportio_id.doc_id != ticket_id):
                 raise ValueError(f"a ticket with aportio ID '{aportio_id}' "
                                  f"exists already")
@@ -1383,14 +2838,15 @@ class Ticket(flask_restful.Resource, ApiResource):
                                   optional_keys = [
                                       ("custom_fields", dict)
                                   ],
-                                  obj=ticket)
-        # Now check whether this user is even associated with that customer
-        cust_id    = data['customer_id']
-        user_id    = data['user_id']
-        assoc_q    = Query()
-        assoc_data = DB_USER_CUSTOMER_RELS_TABLE.search((assoc_q.customer_id == cust_id) &
-                                                        (assoc_q.user_id     == user_id))
-        if not assoc_data:
+                                  obj=ticket, patch=patch)
+        # Now check whether this user is even associated with that customer. A patch, which
+        # changes neither of them, can't break the association.
+        if patch and "customer_id" not in data and "user_id" not in data:
+            return data, ticket
+        new_ticket = _patched_document(ticket, data) if patch else data
+        cust_id    = new_ticket['customer_id']
+        user_id    = new_ticket['user_id']
+        if not DB_USER_CUSTOMER_RELS_INDEX.contains(customer_id=cust_id, user_id=user_id):
             flask_restful.abort(400, message=f"Bad Request - user '{user_id}' is not "
                                              f"associated with customer '{cust_id}'")
         return data, ticket
@@ -1402,17 +2858,8 @@ class Ticket(flask_restful.Resource, ApiResource):
         ticket    = obj
         ticket_id = int(ticket_id)
 
-        # Ensure that user and customer have not been changed (they can only be written once)
-        if data['user_id'] != ticket['user_id']:
-            flask_restful.abort(400, message=f"Bad Request - cannot change user ID in "
-                                             f"ticket '{ticket_id}'")
-        if data['customer_id'] != ticket['customer_id']:
-            flask_restful.abort(400, message=f"Bad Request - cannot change customer ID in "
-                                             f"ticket '{ticket_id}'")
-
-        if data['aportio_id'] != ticket['aportio_id']:
-            flask_restful.abort(400, message=f"Bad Request - cannot change aportio ID in "
-                                             f"ticket '{ticket_id}'")
+        # Ensure that user, customer and aportio ID have not been changed
+        self.check_fixed_keys(data, ticket, f"ticket '{ticket_id}'")
 
         # Remove keys that are not in the new resource
         keys_to_remove = [stored_key for stored_key in ticket.keys()
@@ -1420,6 +2867,17 @@ class Ticket(flask_restful.Resource, ApiResource):
         for old_key in keys_to_remove:
             DB_TICKET_TABLE.update(delete(old_key), doc_ids=[ticket_id])
         DB_TICKET_TABLE.update(data, doc_ids=[ticket_id])
+        _record_change(Ticket, ticket_id, "update")
+        return Ticket.get_self_url(ticket_id=ticket_id)
+
+    def _patch(self, data, ticket_id, obj):
+        """
+        Process a PATCH to change some keys of an existing ticket.
+        """
+        ticket_id = int(ticket_id)
+        self.check_fixed_keys(data, obj, f"ticket '{ticket_id}'", patch=True)
+        _patch_document(DB_TICKET_TABLE, ticket_id, data)
+        _record_change(Ticket, ticket_id, "update")
         return Ticket.get_self_url(ticket_id=ticket_id)
 
 
@@ -1430,11 +2888,14 @@ class Comment(flask_restful.Resource, ApiResource,
     """
 
     URL           = CommentList.URL + "/<comment_id>"
+    ETAG_TABLES   = ("comments", "tickets", "customers", "users")
     MIN_LEN       = 2
     MAX_LEN       = 25000000   # allowing for really big comments!
     TYPE_COMMENT  = "COMMENT"
     TYPE_WORKNOTE = "WORKNOTE"
     KNOWN_TYPES   = [TYPE_COMMENT, TYPE_WORKNOTE]
+    EMBEDS        = ("ticket", "customer", "user")
+    FIXED_KEYS    = (("user_id", "user ID"), ("ticket_id", "ticket ID"))
 
     @classmethod
     def exists(cls, comment_id):
@@ -1454,32 +2915,38 @@ class Comment(flask_restful.Resource, ApiResource,
         comment = DB_COMMENT_TABLE.get(doc_id=int(comment_id))
         if not comment:
             flask_restful.abort(404, message=f"Comment '{comment_id}' not found!")
-        ticket_data   = DB_TICKET_TABLE.get(doc_id=comment['ticket_id'])
-        customer_data = DB_CUSTOMER_TABLE.get(doc_id=ticket_data['customer_id'])
-        user_data = {}
-        if comment.get('user_id'):
-            user_data = DB_USER_TABLE.get(doc_id=comment['user_id'])
         res = dict(comment)
         res.update({
             "id" : comment.doc_id,
-            "_embedded" : {
-                "ticket"   : self.embed_ticket_data_in_result([ticket_data])[0],
-                "customer" : self.embed_customer_data_in_result([customer_data])[0]
-            },
             '_links' : self.make_links({
                            "self"         : Comment.get_self_url(comment.doc_id),
                            "contained_in" : CommentList.get_self_url(),
                        })
         })
+        # Only look up the ticket, customer and user of the comment if they are to be
+        # embedded. The customer is found via the ticket.
+        embedded    = {}
+        ticket_data = None
+        if self.wants_embed("ticket") or self.wants_embed("customer"):
+            ticket_data = DB_TICKET_TABLE.get(doc_id=comment['ticket_id'])
+        if self.wants_embed("ticket"):
+            embedded['ticket'] = self.embed_ticket_data(ticket_data)
+        if self.wants_embed("customer"):
+            customer_data        = DB_CUSTOMER_TABLE.get(doc_id=ticket_data['customer_id'])
+            embedded['customer'] = self.embed_customer_data(customer_data)
         # Only embed the user in the response if user_data exists
-        if user_data:
-            res['_embedded'].update({"user": self.embed_user_data_in_result([user_data])[0]})
+        if self.wants_embed("user") and comment.get('user_id'):
+            user_data = DB_USER_TABLE.get(doc_id=comment['user_id'])
+            if user_data:
+                embedded['user'] = self.embed_user_data(user_data)
+        if embedded:
+            res['_embedded'] = embedded
         return res
 
     @classmethod
-    def sanity_check(cls, data, comment_id=None):
+    def sanity_check(cls, data, comment_id=None, patch=False):
         """
-        Perform a sanity check for POST/PUT of comment data.
+        Perform a sanity check for POST/PUT/PATCH of comment data.
         """
         if comment_id is not None:
             comment_id = int(comment_id)
@@ -1506,20 +2973,22 @@ class Comment(flask_restful.Resource, ApiResource,
                                   optional_keys = [
                                       ("user_email", validators.email),
                                       ("user_id", User.exists)],
-                                  obj=comment)
+                                  obj=comment, patch=patch)
+        new_comment = _patched_document(comment, data) if patch else data
 
-        if not(data.get('user_id') or data.get('user_email')):
+        if not(new_comment.get('user_id') or new_comment.get('user_email')):
             raise ValueError(f"missing key(s): either 'user_id' or 'user_email' is required")
 
-        if data.get('user_id'):
+        # A patch, which changes neither the user nor the ticket, can't break the association
+        # between them
+        if new_comment.get('user_id') and (not patch or "user_id" in data or
+                                           "ticket_id" in data):
             # Check that the user is associated with the customer of the ticket.
-            ticket     = DB_TICKET_TABLE.get(doc_id=data['ticket_id'])
+            ticket     = DB_TICKET_TABLE.get(doc_id=new_comment['ticket_id'])
             cust_id    = ticket['customer_id']
-            user_id    = data['user_id']
-            assoc_q    = Query()
-            assoc_data = DB_USER_CUSTOMER_RELS_TABLE.search((assoc_q.customer_id == cust_id) &
-                                                            (assoc_q.user_id == user_id))
-            if not assoc_data:
+            user_id    = new_comment['user_id']
+            if not DB_USER_CUSTOMER_RELS_INDEX.contains(customer_id=cust_id,
+                                                        user_id=user_id):
                 flask_restful.abort(400, message=f"Bad Request - user '{user_id}' is not "
                                                  f"associated with ticket customer "
                                                  f"'{cust_id}'")
@@ -1537,13 +3006,8 @@ class Comment(flask_restful.Resource, ApiResource,
         comment    = obj
         comment_id = int(comment_id)
 
-        # Ensure that user and customer have not been changed (they can only be written once)
-        if data['user_id'] != comment['user_id']:
-            flask_restful.abort(400, message=f"Bad Request - cannot change user ID in "
-                                             f"comment '{comment_id}'")
-        if data['ticket_id'] != comment['ticket_id']:
-            flask_restful.abort(400, message=f"Bad Request - cannot change ticket ID in "
-                                             f"comment '{comment_id}'")
+        # Ensure that user and ticket have not been changed
+        self.check_fixed_keys(data, comment, f"comment '{comment_id}'")
 
         # Remove keys that are not in the new resource
         keys_to_remove = [stored_key for stored_key in comment.keys()
@@ -1551,6 +3015,17 @@ class Comment(flask_restful.Resource, ApiResource,
         for old_key in keys_to_remove:
             DB_COMMENT_TABLE.update(delete(old_key), doc_ids=[comment_id])
         DB_COMMENT_TABLE.update(data, doc_ids=[comment_id])
+        _record_change(Comment, comment_id, "update")
+        return Comment.get_self_url(comment_id=comment_id)
+
+    def _patch(self, data, comment_id, obj):
+        """
+        Process a PATCH to change some keys of an existing comment.
+        """
+        comment_id = int(comment_id)
+        self.check_fixed_keys(data, obj, f"comment '{comment_id}'", patch=True)
+        _patch_document(DB_COMMENT_TABLE, comment_id, data)
+        _record_change(Comment, comment_id, "update")
         return Comment.get_self_url(comment_id=comment_id)
 
 
@@ -1559,7 +3034,9 @@ class Attachment(flask_restful.Resource, ApiResource, _TicketDataEmbedder):
     A resource to represent an attachment for a ticket.
     """
 
-    URL     = AttachmentList.URL + "/<attachment_id>"
+    URL         = AttachmentList.URL + "/<attachment_id>"
+    ETAG_TABLES = ("attachments", "tickets")
+    EMBEDS      = ("ticket",)
 
     @classmethod
     def exists(cls, attachment_id):
@@ -1572,6 +3049,56 @@ class Attachment(flask_restful.Resource, ApiResource, _TicketDataEmbedder):
             raise ValueError(f"unknown attachment '{attachment_id}'")
         return attachment_id
 
+    @staticmethod
+    def blob_path(sha256):
+        """
+        Return the path of the stored file with the specified SHA-256 hash.
+        """
+        return os.path.join(_ATTACHMENT_BLOBS, sha256[:2], sha256)
+
+    @staticmethod
+    def blob_references(sha256):
+        """
+        Return the number of attachments, which refer to the stored file with the hash.
+        """
+        return len(DB_ATTACHMENT_TABLE.indexes['sha256'].lookup(sha256))
+
+    @staticmethod
+    def release_blobs(sha256_list):
+        """
+        Remove the stored files with the specified hashes, which no attachment refers to.
+
+        This is done in a transaction, so that no attachment can start to refer to a
+        file while it's being removed.
+
+        """
+        if not sha256_list:
+            return
+        with _DB.transaction():
+            for sha256 in sha256_list:
+                if Attachment.blob_references(sha256) == 0:
+                    try:
+                        os.remove(Attachment.blob_path(sha256))
+                    except FileNotFoundError:
+                        pass
+
+    @staticmethod
+    def file_path(attachment, attachment_id):
+        """
+        Return the path of the file, in which the data of an attachment is stored.
+
+        See AttachmentList._post() for the layout of the attachment storage.
+        Attachments, which were stored before the files were stored by their
+        hash, have their file in the directory of their ticket.
+
+        """
+        if 'sha256' in attachment:
+            path = Attachment.blob_path(attachment['sha256'])
+            if os.path.exists(path):
+                return path
+        return os.path.join(_ATTACHMENT_FOLDER, f"ticket__{str(attachment['ticket_id'])}",
+                            f"{str(attachment_id)}__{attachment['filename']}")
+
     def _get(self, attachment_id):
         """
         Return information about an attachment.
@@ -1579,30 +3106,29 @@ class Attachment(flask_restful.Resource, ApiResource, _TicketDataEmbedder):
         attachment = DB_ATTACHMENT_TABLE.get(doc_id=int(attachment_id))
         if not attachment:
             flask_restful.abort(404, message=f"attachment '{attachment_id}' not found!")
-        ticket_data = DB_TICKET_TABLE.get(doc_id=attachment['ticket_id'])
-        res         = dict(attachment)
-        # Load the attachment file as encoded base64 and update the response.
-        try:
-            path_to_file = os.path.join(_ATTACHMENT_FOLDER,
-                                        f"ticket__{str(attachment['ticket_id'])}",
-                                        f"{str(attachment.doc_id)}__{attachment['filename']}")
-            with open(path_to_file, "rb") as attachment_file:
-                encoded_attachment = base64.b64encode(attachment_file.read()).decode()
-        except FileNotFoundError:
-            # Attachment was in the database but not found on disk, return a 404
-            flask_restful.abort(404, message=(f"file for attachment '{attachment_id}' not "
-                                              "found!"))
+        res = dict(attachment)
         res.update({
-            "id"              : attachment.doc_id,
-            "attachment_data" : encoded_attachment,
-            "_embedded"       : {
-                "ticket" : self.embed_ticket_data_in_result([ticket_data])[0]
-            },
+            "id"     : attachment.doc_id,
             '_links' : self.make_links({
                            "self"         : Attachment.get_self_url(attachment.doc_id),
                            "contained_in" : AttachmentList.get_self_url(),
+                           "content"      : AttachmentContent.get_self_url(attachment.doc_id)
                        })
         })
+        # Load the attachment file as encoded base64 and update the response. The file can
+        # be large, so this is skipped if the data wasn't asked for.
+        if self.wants_field("attachment_data"):
+            try:
+                path_to_file = Attachment.file_path(attachment, attachment.doc_id)
+                with open(path_to_file, "rb") as attachment_file:
+                    res['attachment_data'] = base64.b64encode(attachment_file.read()).decode()
+            except FileNotFoundError:
+                # Attachment was in the database but not found on disk, return a 404
+                flask_restful.abort(404, message=(f"file for attachment '{attachment_id}' "
+                                                  "not found!"))
+        if self.wants_embed("ticket"):
+            ticket_data      = DB_TICKET_TABLE.get(doc_id=attachment['ticket_id'])
+            res['_embedded'] = {"ticket" : self.embed_ticket_data(ticket_data)}
         return res
 
     @classmethod
@@ -1618,12 +3144,20 @@ class Attachment(flask_restful.Resource, ApiResource, _TicketDataEmbedder):
         else:
             attachment = None
 
+        # The file name becomes part of the path of the attachment file, so it mustn't point
+        # anywhere else
+        def validate_filename(filename):
+            _str_len_check(filename, 1, 255)
+            if os.path.basename(filename) != filename or filename in (".", ".."):
+                raise ValueError("file name mustn't contain a path")
+            return filename
+
         # Some validator methods are set to lambdas that just return their value because they
         # are mandatory fields but they don't currently need any validation.
         data = _dict_sanity_check(data,
                                   mandatory_keys = [
                                       ("ticket_id", Ticket.exists),
-                                      ("filename", lambda x: x),
+                                      ("filename", validate_filename),
                                       ("content_type", lambda x: x),
                                       ("attachment_data", lambda x: x)],
                                   optional_keys = [],
@@ -1658,13 +3192,332 @@ class Attachment(flask_restful.Resource, ApiResource, _TicketDataEmbedder):
     #     return Comment.get_self_url(comment_id=comment_id)
 
 
+class AttachmentContent(flask_restful.Resource, ApiResource):
+    """
+    The raw data of an attachment.
+
+    This returns the file of the attachment as it was uploaded, with the
+    content type of the attachment, rather than base64 encoded in a JSON
+    document. The file is passed to the web server as it is, which can send
+    it without loading it into memory. Range requests are supported, so that
+    interrupted downloads of large files can be resumed.
+
+    """
+
+    URL = Attachment.URL + "/content"
+
+    # The content is returned for any Accept header: The client gets what was uploaded.
+    def get(self, attachment_id):
+        """
+        Return the file of an attachment.
+        """
+        try:
+            attachment = DB_ATTACHMENT_TABLE.get(doc_id=int(attachment_id))
+        except ValueError:
+            attachment = None
+        if not attachment:
+            flask_restful.abort(404, message=f"attachment '{attachment_id}' not found!")
+        path_to_file = Attachment.file_path(attachment, attachment.doc_id)
+        if not os.path.isfile(path_to_file):
+            flask_restful.abort(404, message=f"file for attachment '{attachment_id}' "
+                                             f"not found!")
+        # Flask looks for relative paths in the application's directory, rather than in the
+        # current one. send_file() answers conditional and range requests by itself. The
+        # hash of the content, if it is known, is the ideal ETag.
+        resp = flask.send_file(os.path.abspath(path_to_file),
+                               mimetype=attachment['content_type'],
+                               download_name=attachment['filename'],
+                               conditional=True,
+                               etag=attachment.get('sha256', True))
+        # Tell clients that they can resume downloads, not only those who try
+        resp.headers['Accept-Ranges'] = "bytes"
+        return resp
+
+
+# -----------------
+# Resumable uploads
+# -----------------
+
+class UploadSessionList(flask_restful.Resource, ApiResourceList):
+    """
+    Sessions for the upload of attachments in chunks.
+
+    POST the metadata of an attachment (everything but 'attachment_data') to
+    start a session. The file is then PUT in numbered chunks to the session,
+    which are kept in a staging directory. A chunk that didn't make it can be
+    sent again on its own, rather than the whole file. Once all chunks are
+    there, a POST to the session's 'commit' link creates the attachment.
+
+    """
+
+    URL = AttachmentList.URL + "/uploads"
+
+    def _post(self, data):
+        """
+        Start an upload session, removing the sessions that have expired.
+        """
+        self._remove_expired()
+        new_upload_id = DB_UPLOAD_TABLE.insert(data)
+        # A directory left behind by an earlier session with the same ID is stale
+        session_dir   = UploadSession.session_dir(new_upload_id)
+        shutil.rmtree(session_dir, ignore_errors=True)
+        os.makedirs(session_dir)
+        return new_upload_id
+
+    @staticmethod
+    def _remove_expired():
+        """
+        Remove the sessions, which haven't received a chunk for UPLOAD_SESSION_TTL_S seconds.
+
+        Adding a chunk updates the modification time of the session directory,
+        so that active sessions don't need to be written to the database.
+
+        """
+        expire_before = time.time() - app.config.get('UPLOAD_SESSION_TTL_S', 86400)
+        expired_ids   = []
+        for upload in DB_UPLOAD_TABLE.all():
+            try:
+                last_active = os.path.getmtime(UploadSession.session_dir(upload.doc_id))
+            except FileNotFoundError:
+                last_active = 0
+            if last_active < expire_before:
+                expired_ids.append(upload.doc_id)
+        for upload_id in expired_ids:
+            UploadSession.remove(upload_id)
+
+
+class UploadSession(flask_restful.Resource, ApiResource):
+    """
+    A session for the upload of an attachment in chunks.
+
+    The session lists the chunks that have been received, so that a client
+    can find out which ones it needs to send again after an interruption.
+
+    """
+
+    URL = UploadSessionList.URL + "/<upload_id>"
+
+    @staticmethod
+    def session_dir(upload_id):
+        """
+        Return the directory, in which the chunks of an upload session are kept.
+        """
+        return os.path.join(_UPLOAD_SESSIONS, str(upload_id))
+
+    @staticmethod
+    def get_session(upload_id):
+        """
+        Return the record of an upload session, aborting with 404 if there is none.
+        """
+        try:
+            upload = DB_UPLOAD_TABLE.get(doc_id=int(upload_id))
+        except ValueError:
+            upload = None
+        if not upload:
+            flask_restful.abort(404, message=f"upload '{upload_id}' not found!")
+        return upload
+
+    @staticmethod
+    def remove(upload_id):
+        """
+        Remove an upload session, including the chunks it received.
+        """
+        DB_UPLOAD_TABLE.remove(doc_ids=[int(upload_id)])
+        shutil.rmtree(UploadSession.session_dir(upload_id), ignore_errors=True)
+
+    @staticmethod
+    def chunk_path(upload_id, chunk):
+        """
+        Return the path of the file, in which a chunk of an upload session is stored.
+        """
+        return os.path.join(UploadSession.session_dir(upload_id), f"{chunk}.chunk")
+
+    @staticmethod
+    def chunks(upload_id):
+        """
+        Return the received chunks of an upload session, ordered by their number.
+
+        Each chunk is returned as a dictionary with its number and size.
+
+        """
+        chunks = []
+        try:
+            with os.scandir(UploadSession.session_dir(upload_id)) as entries:
+                for entry in entries:
+                    # Chunks that are still being received are in staging files
+                    match = re.fullmatch(r'(\d+)\.chunk', entry.name)
+                    if match:
+                        chunks.append({"chunk" : int(match.group(1)),
+                                       "size"  : entry.stat().st_size})
+        except FileNotFoundError:
+            pass
+        return sorted(chunks, key=lambda chunk: chunk['chunk'])
+
+    def _get(self, upload_id):
+        """
+        Return the metadata of an upload session and the chunks it received.
+        """
+        upload = UploadSession.get_session(upload_id)
+        chunks = UploadSession.chunks(upload.doc_id)
+        res    = dict(upload)
+        res.update({
+            "id"     : upload.doc_id,
+            "chunks" : chunks,
+            "size"   : sum(chunk['size'] for chunk in chunks),
+            '_links' : self.make_links({
+                           "self"         : UploadSession.get_self_url(upload.doc_id),
+                           "contained_in" : UploadSessionList.get_self_url(),
+                           "commit"       : UploadCommit.get_self_url(upload.doc_id)
+                       })
+        })
+        return res
+
+    @classmethod
+    def sanity_check(cls, data):  # no version with ID, since PUT (update) isn't allowed
+        """
+        Perform a sanity check of the metadata of an upload session.
+
+        This is the metadata of the attachment, which is checked like that of
+        an attachment, without the file.
+
+        """
+        if 'attachment_data' in data:
+            raise ValueError("the file of an upload is sent in chunks, not as "
+                             "'attachment_data'")
+        data, _ = Attachment.sanity_check({**data, "attachment_data" : None})
+        del data['attachment_data']
+        return data, None
+
+    @accept('application/json')
+    def delete(self, upload_id):
+        """
+        Cancel an upload session.
+        """
+        with _DB.transaction():
+            upload = UploadSession.get_session(upload_id)
+            UploadSession.remove(upload.doc_id)
+        return {"msg" : "Ok"}
+
+
+class UploadChunk(flask_restful.Resource, ApiResource):
+    """
+    A chunk of the file of an upload session.
+
+    PUT the raw data of the chunk. Chunks are numbered from 0, and are put
+    together in the order of their numbers. Sending a chunk again replaces
+    it.
+
+    """
+
+    URL = UploadSession.URL + "/chunks/<chunk>"
+
+    @accept('application/json')
+    def put(self, upload_id, chunk):
+        """
+        Store a chunk of an upload session.
+        """
+        max_chunks = app.config.get('UPLOAD_MAX_CHUNKS', 10000)
+        if not re.fullmatch(r'\d+', chunk) or int(chunk) >= max_chunks:
+            flask_restful.abort(400, message=f"Bad Request - chunk must be a number from 0 "
+                                             f"to {max_chunks - 1}")
+        upload_id = UploadSession.get_session(upload_id).doc_id
+        chunk     = int(chunk)
+        # The chunk is written to a staging file in the session directory, and only replaces
+        # an earlier version of the chunk once it is complete
+        with StagedFile(UploadSession.session_dir(upload_id)) as staged:
+            staged.write_from(flask.request.stream)
+            staged.commit(UploadSession.chunk_path(upload_id, chunk))
+        # The session may have been cancelled or committed while the chunk was received
+        if not DB_UPLOAD_TABLE.contains(doc_ids=[upload_id]):
+            shutil.rmtree(UploadSession.session_dir(upload_id), ignore_errors=True)
+            flask_restful.abort(404, message=f"upload '{upload_id}' not found!")
+        return {"chunk" : chunk, "size" : staged.size, "sha256" : staged.sha256}
+
+
+class UploadCommit(flask_restful.Resource, ApiResource):
+    """
+    The completion of an upload session.
+
+    A POST puts the chunks of the session together and creates the
+    attachment, which ends the session. The chunks need to be numbered 0 to
+    n-1 without a gap. The request body may contain the expected 'size' and
+    'sha256' hash of the whole file, which are then verified.
+
+    """
+
+    URL = UploadSession.URL + "/commit"
+
+    @staticmethod
+    def _expected(upload):
+        """
+        Return the expected size and hash of the file from the request body.
+        """
+        if not flask.request.content_length:
+            return {}
+        expected = flask.request.json
+        if not isinstance(expected, dict):
+            raise ValueError("expected a JSON object")
+        return _dict_sanity_check(expected,
+                                  mandatory_keys = [],
+                                  optional_keys = [
+                                      ("size", validators.integer),
+                                      ("sha256", lambda x: _str_len_check(x, 64, 64).lower())],
+                                  obj=upload)
+
+    @accept('application/json')
+    def post(self, upload_id):
+        """
+        Create the attachment from the chunks of an upload session.
+        """
+        self.is_html = False  # pylint: disable=attribute-defined-outside-init
+        try:
+            upload   = UploadSession.get_session(upload_id)
+            expected = self._expected(upload)
+            chunks   = UploadSession.chunks(upload.doc_id)
+            if not chunks:
+                raise ValueError("no chunks have been received")
+            missing = sorted(set(range(chunks[-1]['chunk'] + 1)) -
+                             {chunk['chunk'] for chunk in chunks})
+            if missing:
+                raise ValueError(f"missing chunk(s): {', '.join(map(str, missing))}")
+            with StagedFile(_ATTACHMENT_STAGING) as staged:
+                # The chunks are copied one block at a time, the file is never held in memory
+                for chunk in chunks:
+                    with open(UploadSession.chunk_path(upload.doc_id, chunk['chunk']),
+                              "rb") as chunk_file:
+                        staged.write_from(chunk_file)
+                if 'size' in expected and expected['size'] != staged.size:
+                    raise ValueError(f"expected a size of {expected['size']} bytes, "
+                                     f"received {staged.size}")
+                if 'sha256' in expected and expected['sha256'] != staged.sha256:
+                    raise ValueError(f"expected the SHA-256 hash {expected['sha256']}, "
+                                     f"received {staged.sha256}")
+
+                # The session ends with the creation of the attachment, unless it has been
+                # cancelled or committed in the meantime
+                def end_session():
+                    if not DB_UPLOAD_TABLE.contains(doc_ids=[upload.doc_id]):
+                        flask_restful.abort(404, message=f"upload '{upload_id}' not found!")
+                    DB_UPLOAD_TABLE.remove(doc_ids=[upload.doc_id])
+
+                # Tightly cooperating classes, we will allow the protected access
+                # pylint: disable=protected-access
+                resp = AttachmentList()._create({**upload, "attachment_data" : staged},
+                                                in_transaction=end_session)
+            shutil.rmtree(UploadSession.session_dir(upload.doc_id), ignore_errors=True)
+            return resp
+        except ValueError as ex:
+            flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
+
+
 class CustomerUserAssociation(flask_restful.Resource, ApiResource,
                               _UserDataEmbedder, _CustomerDataEmbedder):
     """
     A resource to represent the association between customer and user.
     """
 
-    URL = CustomerUserAssociationList.URL + "/<association_id>"
+    URL         = CustomerUserAssociationList.URL + "/<association_id>"
+    ETAG_TABLES = ("user_customer_rels", "users", "customers")
 
     @classmethod
     def sanity_check(cls, data):  # no version with ID, since PUT (update) isn't allowed
@@ -1727,8 +3580,13 @@ class UserCustomerList(flask_restful.Resource, ApiResourceList, _CustomerDataEmb
     """
 
     URL                 = User.URL + "/customers"
+    ETAG_TABLES         = ("users", "customers", "user_customer_rels")
+    ITEMS               = ("_embedded", "customers")
     VALID_SEARCH_FIELDS = CustomerList.VALID_SEARCH_FIELDS
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, user_id, query=None):
         """
         Return the customer list for a given user.
@@ -1736,22 +3594,12 @@ class UserCustomerList(flask_restful.Resource, ApiResourceList, _CustomerDataEmb
         user = DB_USER_TABLE.get(doc_id=int(user_id))
         if not user:
             flask_restful.abort(404, message=f"User '{user_id}' not found!")
-        rels_q       = Query()
-        rel_data     = DB_USER_CUSTOMER_RELS_TABLE.search(rels_q.user_id == int(user_id))
-        customer_ids = {r['customer_id'] for r in rel_data}
-        if not query:
-            # We don't seem to have a way to retrieve a set of objects via a set of ids?
-            # Doing it just in a loop for now...
-            customer_data = [DB_CUSTOMER_TABLE.get(doc_id=_id) for _id in customer_ids]
-        else:
-            # Need to manually join the rel and search results, since we can't seem to have
-            # complex queries that contain normal fields as well as doc_ids.
-            customer_data_search = DB_CUSTOMER_TABLE.search(query)
-            customer_data        = [c for c in customer_data_search
-                                    if c.doc_id in customer_ids]
+        # Only the customers of this user are candidates for the search
+        customer_ids  = DB_USER_CUSTOMER_RELS_INDEX.associated('user_id', int(user_id))
+        customer_data = self.search_table(DB_CUSTOMER_TABLE, self.search_args(),
+                                          candidate_ids=customer_ids)
 
         res = {
-            "total_queried" : len(customer_data),
             "_embedded"     : {
                 "customers" : self.embed_customer_data_in_result(customer_data)
             },
@@ -1778,8 +3626,13 @@ class CustomerUserList(flask_restful.Resource, ApiResourceList, _UserDataEmbedde
     """
 
     URL                 = Customer.URL + "/users"
+    ETAG_TABLES         = ("customers", "users", "user_customer_rels")
+    ITEMS               = ("_embedded", "users")
     VALID_SEARCH_FIELDS = UserList.VALID_SEARCH_FIELDS
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, customer_id, query=None):
         """
         Return list of users for a customer.
@@ -1787,21 +3640,12 @@ class CustomerUserList(flask_restful.Resource, ApiResourceList, _UserDataEmbedde
         cust = DB_CUSTOMER_TABLE.get(doc_id=int(customer_id))
         if not cust:
             flask_restful.abort(404, message=f"Customer '{customer_id}' not found!")
-        rels_q    = Query()
-        rel_data  = DB_USER_CUSTOMER_RELS_TABLE.search(rels_q.customer_id == int(customer_id))
-        user_ids  = {r['user_id'] for r in rel_data}
-        if not query:
-            # We don't seem to have a way to retrieve a set of objects via a set of ids?
-            # Doing it just in a loop for now...
-            user_data = [DB_USER_TABLE.get(doc_id=_id) for _id in user_ids]
-        else:
-            # Need to manually join the rel and search results, since we can't seem to have
-            # complex queries that contain normal fields as well as doc_ids.
-            user_data_search = DB_USER_TABLE.search(query)
-            user_data        = [u for u in user_data_search if u.doc_id in user_ids]
+        # Only the users of this customer are candidates for the search
+        user_ids  = DB_USER_CUSTOMER_RELS_INDEX.associated('customer_id', int(customer_id))
+        user_data = self.search_table(DB_USER_TABLE, self.search_args(),
+                                      candidate_ids=user_ids)
 
         res = {
-            "total_queried" : len(user_data),
             "_embedded"     : {
                 "users" : self.embed_user_data_in_result(user_data)
             },
@@ -1828,20 +3672,21 @@ class CustomerTicketList(flask_restful.Resource, ApiResourceList, _TicketDataEmb
     """
 
     URL                 = "/customers/<customer_id>/tickets"
+    ETAG_TABLES         = ("tickets",)
+    ITEMS               = ("_embedded", "tickets")
     VALID_SEARCH_FIELDS = TicketList.VALID_SEARCH_FIELDS
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, customer_id, query=None):
         """
         Return list of tickets for a customer.
         """
-        if not query:
-            ticket_data = DB_TICKET_TABLE.search(where('customer_id') == int(customer_id))
-        else:
-            query       = (where('customer_id') == int(customer_id)) & query
-            ticket_data = DB_TICKET_TABLE.search(query)
+        ticket_data = self.search_table(DB_TICKET_TABLE, self.search_args(),
+                                        customer_id=int(customer_id))
 
         res = {
-            "total_queried" : len(ticket_data),
             "_embedded"     : {
                 "tickets" : self.embed_ticket_data_in_result(ticket_data)
             },
@@ -1868,20 +3713,21 @@ class UserTicketList(flask_restful.Resource, ApiResourceList, _TicketDataEmbedde
     """
 
     URL                 = "/users/<user_id>/tickets"
+    ETAG_TABLES         = ("tickets",)
+    ITEMS               = ("_embedded", "tickets")
     VALID_SEARCH_FIELDS = TicketList.VALID_SEARCH_FIELDS
 
+    # The search is planned based on the URL parameters, rather than the query we get from
+    # the parent class.
+    # pylint: disable=unused-argument
     def _get(self, user_id, query=None):
         """
         Return the ticket list of a user.
         """
-        if not query:
-            ticket_data = DB_TICKET_TABLE.search(where('user_id') == int(user_id))
-        else:
-            query       = (where('user_id') == int(user_id)) & query
-            ticket_data = DB_TICKET_TABLE.search(query)
+        ticket_data = self.search_table(DB_TICKET_TABLE, self.search_args(),
+                                        user_id=int(user_id))
 
         res = {
-            "total_queried" : len(ticket_data),
             "_embedded"     : {
                 "tickets" : self.embed_ticket_data_in_result(ticket_data)
             },
@@ -1893,6 +3739,163 @@ class UserTicketList(flask_restful.Resource, ApiResourceList, _TicketDataEmbedde
         return res
 
 
+# --------------
+# Bulk resources
+# --------------
+
+class UserBulk(flask_restful.Resource, ApiResourceBulk):
+    """
+    Bulk creation of users.
+
+    POST a JSON array or NDJSON of users to create them all at once.
+
+    """
+
+    URL        = UserList.URL + "/_bulk"
+    LIST_CLASS = UserList
+
+
+class TicketBulk(flask_restful.Resource, ApiResourceBulk):
+    """
+    Bulk creation of tickets.
+
+    POST a JSON array or NDJSON of tickets to create them all at once.
+
+    """
+
+    URL        = TicketList.URL + "/_bulk"
+    LIST_CLASS = TicketList
+
+
+class CommentBulk(flask_restful.Resource, ApiResourceBulk):
+    """
+    Bulk creation of comments.
+
+    POST a JSON array or NDJSON of comments to create them all at once.
+
+    """
+
+    URL        = CommentList.URL + "/_bulk"
+    LIST_CLASS = CommentList
+
+
+# -------------
+# Change stream
+# -------------
+
+class ChangeStream(flask_restful.Resource, ApiResource):
+    """
+    A stream of the changes to tickets, comments and attachments.
+
+    Rather than polling the lists, clients can subscribe to this resource to be
+    told about every ticket, comment or attachment that is created or updated.
+    The changes are sent as Server-Sent Events (content type
+    'text/event-stream'), as soon as they are committed. The data of each event
+    is a JSON object with the kind of 'resource', the 'action' ('create' or
+    'update'), the 'id' of the resource, the time of the change and a link to
+    the resource.
+
+    Each event has a sequence number as its ID. To resume after a lost
+    connection, send the ID of the last received event in the 'Last-Event-ID'
+    header (or the 'last_event_id' URL parameter). The stream then starts with
+    the changes that followed it. Without it, only new changes are sent. If
+    changes since the given ID are no longer available, a 'resync' event is
+    sent first: The client should then catch up by other means, for example
+    via the 'updated_since' search of the lists.
+
+    An idle stream sends a comment line every 'CHANGES_KEEPALIVE_S' seconds.
+
+    Streams are woken up by the process, in which a change was committed. If
+    the server runs in several processes (with the SQLite backend), then a
+    stream only notices changes committed by another process when it checks
+    for changes before its next keep-alive, so those arrive up to
+    'CHANGES_KEEPALIVE_S' seconds late.
+
+    """
+
+    URL = "/changes"
+
+    @staticmethod
+    def _last_event_id():
+        """
+        Return the ID of the last event the client has received, or None.
+        """
+        last_id = flask.request.headers.get('Last-Event-ID',
+                                            flask.request.args.get('last_event_id'))
+        if last_id is None:
+            return None
+        try:
+            return int(last_id)
+        except ValueError as ex:
+            raise ValueError(f"invalid last event ID: {last_id}") from ex
+
+    @staticmethod
+    def _changes_after(last_id):
+        """
+        Return the recorded changes with a sequence number greater than last_id.
+        """
+        doc_ids = DB_CHANGE_TABLE.doc_ids()
+        return DB_CHANGE_TABLE.get_multiple(doc_ids[bisect.bisect_right(doc_ids, last_id):])
+
+    def _format_event(self, change):
+        """
+        Return a recorded change as Server-Sent Event.
+        """
+        data = {
+            "resource" : change['resource'],
+            "action"   : change['action'],
+            "id"       : change['resource_id'],
+            "_created" : change['_created'],
+            "_links"   : self.make_links({"self" : change['href']})
+        }
+        return f"id: {change.doc_id}\ndata: {json.dumps(data)}\n\n"
+
+    def _events(self, last_id):
+        """
+        Generate the events of the stream, waiting for new changes as needed.
+        """
+        doc_ids = DB_CHANGE_TABLE.doc_ids()
+        newest  = doc_ids[-1] if doc_ids else 0
+        if last_id is None:
+            last_id = newest
+        elif last_id > newest or (doc_ids and doc_ids[0] > last_id + 1):
+            # Either the client saw changes of a different database, or changes it hasn't
+            # seen were removed already.
+            yield "event: resync\ndata: {}\n\n"
+            last_id = min(last_id, newest)
+
+        keepalive = app.config.get('CHANGES_KEEPALIVE_S', 15)
+        while True:
+            # Changes are committed before the condition is notified. We hold the condition
+            # while we look for changes, so that a notification can't get lost between
+            # looking and waiting.
+            with _CHANGES_CONDITION:
+                changes = self._changes_after(last_id)
+                if not changes:
+                    _CHANGES_CONDITION.wait(keepalive)
+                    changes = self._changes_after(last_id)
+            if not changes:
+                yield ": keepalive\n\n"
+            for change in changes:
+                yield self._format_event(change)
+                last_id = change.doc_id
+
+    @accept('text/event-stream')
+    def get(self):
+        """
+        Return the stream of changes as Server-Sent Events.
+        """
+        self.is_html = False  # pylint: disable=attribute-defined-outside-init
+        try:
+            events = self._events(self._last_event_id())
+        except ValueError as ex:
+            flask_restful.abort(400, message=f"Bad Request - {str(ex)}")
+        resp = flask.Response(flask.stream_with_context(events), mimetype="text/event-stream")
+        # Proxies should pass every event on as soon as it is sent
+        resp.headers.extend({"Cache-Control" : "no-cache", "X-Accel-Buffering" : "no"})
+        return resp
+
+
 # ==========================================================================================
 # Now that all resources (collections and singles) are defined, we can let the collection
 # know - via class attribute - which class implements the single resource of the collection.
@@ -1905,6 +3908,7 @@ CustomerUserAssociationList.SINGLE_RESOURCE_CLASS = CustomerUserAssociation
 TicketList.SINGLE_RESOURCE_CLASS                  = Ticket
 CommentList.SINGLE_RESOURCE_CLASS                 = Comment
 AttachmentList.SINGLE_RESOURCE_CLASS              = Attachment
+UploadSessionList.SINGLE_RESOURCE_CLASS           = UploadSession
 
 # ===================================================
 # Registering the resource classes with our Flask app
@@ -1913,5 +3917,8 @@ for resource_class in [Root,
                        UserList, User, UserCustomerList, UserTicketList,
                        Customer, CustomerList, CustomerUserList, CustomerTicketList,
                        CustomerUserAssociationList, CustomerUserAssociation,
-                       Ticket, TicketList, Comment, CommentList, Attachment, AttachmentList]:
+                       Ticket, TicketList, Comment, CommentList,
+                       Attachment, AttachmentList, AttachmentContent,
+                       UploadSessionList, UploadSession, UploadChunk, UploadCommit,
+                       UserBulk, TicketBulk, CommentBulk, ChangeStream]:
     API.add_resource(resource_class, resource_class.URL)
@@ -1,13 +1,20 @@
 import base64
 import flask
+import hashlib
+import io
 import json
 import os
 import pytest
 import shutil
 import tempfile
+import time
 
-from itsm_api       import app
-from itsm_api.views import init_db
+from unittest                import mock
+
+from itsm_api                import app
+from itsm_api.sqlite_backend import SQLiteDB
+from itsm_api.storages       import LogStorage
+from itsm_api.views          import init_db
 
 
 JSON_HDRS_READ = {
@@ -23,26 +30,44 @@ JSON_HDRS_READWRITE = {
 }
 
 
-@pytest.fixture
-def client():
+@pytest.fixture(params=["tinydb", "sqlite"])
+def client(request):
     """
     Return new test client for each test.
 
     This establishes a new application context (which a fresh copy of the
-    database) in which the test runs.
+    database) in which the test runs. Each test runs once for every database
+    backend, since they all need to behave the same.
 
     """
     # Create a new temporary copy of the DB file at a unique, temporary location.
     # The temporary DB file used for each test is freshly initialized to whatever we have in
-    # db.json-example, so each test always has the same starting point.
+    # db.json-example, so each test always has the same starting point. The SQLite backend
+    # imports this file when it creates its own database.
     db_fname = tempfile.mktemp() + ".json"
     shutil.copy("db.json-example", db_fname)
-    app.config['DB_NAME'] = db_fname
+    app.config['DB_NAME']        = db_fname
+    app.config['DB_SQLITE_NAME'] = db_fname[:-len(".json")] + ".sqlite"
+    app.config['DB_BACKEND']     = request.param
     init_db()
 
     yield app.test_client()
 
-    os.remove(db_fname)  # delete the temporary database file
+    app.config['DB_BACKEND'] = "tinydb"
+    init_db()   # close the database, so that we can remove its files
+    # delete the temporary database files
+    for fname in [db_fname] + [app.config['DB_SQLITE_NAME'] + suffix
+                               for suffix in ["", "-wal", "-shm"]]:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def _blob_path(attachment):
+    """
+    Return the path of the stored file of an attachment.
+    """
+    return os.path.join("attachment_storage", "blobs", attachment['sha256'][:2],
+                        attachment['sha256'])
 
 
 def _get_root_links(client):
@@ -76,7 +101,8 @@ def test_root_resource(client):
             'tickets'                    : {'href': '/tickets'},
             'comments'                   : {'href': '/comments'},
             'attachments'                : {'href': '/attachments'},
-            'customer_user_associations' : {'href': '/customer_user_associations'}
+            'customer_user_associations' : {'href': '/customer_user_associations'},
+            'changes'                    : {'href': '/changes'}
         }
     }
 
@@ -246,6 +272,15 @@ def test_customer_user_association(client):
         }
     }
 
+    # The new association is visible from both sides right away
+    users = client.get("/customers/2/users", **JSON_HDRS_READ).get_json()
+    assert [u['id'] for u in users['_embedded']['users']] == [1, 2, 3]
+    customers = client.get("/users/3/customers", **JSON_HDRS_READ).get_json()
+    assert [c['id'] for c in customers['_embedded']['customers']] == [1, 2, 3]
+    customers = client.get("/users/3/customers?name=Bar%20Company",
+                           **JSON_HDRS_READ).get_json()
+    assert [c['id'] for c in customers['_embedded']['customers']] == [2]
+
 
 def test_customer_list(client):
     customers_url = _get_root_links(client)['customers']
@@ -318,6 +353,16 @@ def test_customer_list_search(client):
         }
     }
 
+    # Indexed terms, combined with a term for a field without index
+    customers_url = _get_root_links(client)['customers'] + "?parent_id=3" \
+                                                           "&custom_fields.phone=777-321-0987"
+    customers     = client.get(customers_url, **JSON_HDRS_READ).get_json()
+    assert [c['id'] for c in customers['_embedded']['customers']] == [2]
+
+    customers_url = _get_root_links(client)['customers'] + "?parent_id=3&name=Foobar%20Company"
+    customers     = client.get(customers_url, **JSON_HDRS_READ).get_json()
+    assert customers['total_queried'] == 0
+
 
 def test_user_list_search(client):
     users_url = _get_root_links(client)['users'] + \
@@ -358,6 +403,18 @@ def test_user_list_search(client):
     assert users['_embedded']['users'][0]['id'] == 3
     assert users['_embedded']['users'][0]['email'][0] == "foo@foobar.com"
 
+    # Email searches don't care about case, and can be combined with other search terms
+    users_url = _get_root_links(client)['users'] + "?email=FOO@FooBar.com" \
+                                                   "&email=another@user.com"
+    users     = client.get(users_url, **JSON_HDRS_READ).get_json()
+    assert [u['id'] for u in users['_embedded']['users']] == [2, 3]
+
+    users_url = _get_root_links(client)['users'] + "?email=FOO@FooBar.com" \
+                                                   "&email=another@user.com" \
+                                                   "&custom_fields.address.city=Littleville"
+    users     = client.get(users_url, **JSON_HDRS_READ).get_json()
+    assert [u['id'] for u in users['_embedded']['users']] == [2]
+
 
 def test_ticket_list_search(client):
     # Query with numeric parameter
@@ -387,6 +444,239 @@ def test_ticket_list_search(client):
         }
     }
 
+    # Query by aportio ID, which is served from the unique index
+    tickets_url = _get_root_links(client)['tickets'] + "?aportio_id=4321&aportio_id=1111"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in tickets['_embedded']['tickets']] == [1, 3]
+
+    # Combined with other search terms, which still need to match
+    tickets_url = _get_root_links(client)['tickets'] + "?aportio_id=4321&aportio_id=1111" \
+                                                       "&user_id=3"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in tickets['_embedded']['tickets']] == [3]
+
+    tickets_url = _get_root_links(client)['tickets'] + "?aportio_id=9999"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert tickets['total_queried'] == 0
+
+    # Several indexed terms, combined with a term for a field without index
+    tickets_url = _get_root_links(client)['tickets'] + "?status=OPEN&customer_id=1" \
+                                                       "&user_id=1&user_id=4" \
+                                                       "&classification.l1=incident"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in tickets['_embedded']['tickets']] == [1]
+
+    tickets_url = _get_root_links(client)['tickets'] + "?status=OPEN&status=CLOSED"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in tickets['_embedded']['tickets']] == [1, 2, 3, 4]
+
+    # Only a term without index
+    tickets_url = _get_root_links(client)['tickets'] + "?custom_fields.department=marketing"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in tickets['_embedded']['tickets']] == [1]
+
+
+def test_list_search_explain(client):
+    # A search with indexed terms and a term that has to be evaluated against the documents
+    tickets_url = _get_root_links(client)['tickets'] + "?status=OPEN&customer_id=1" \
+                                                       "&classification.l1=incident&_explain=1"
+    tickets     = client.get(tickets_url, **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in tickets['_embedded']['tickets']] == [1]
+    plan = tickets['_explain']['plan']
+    assert plan['table'] == "tickets"
+    assert plan['strategy'] == "index"
+    assert [(t['field'], t['values'], t['matches']) for t in plan['index_terms']] == \
+                                            [("status", ["OPEN"], 3), ("customer_id", [1], 3)]
+    assert plan['filter_terms'] == ["classification.l1"]
+    assert plan['scanned'] == 3
+    assert plan['returned'] == 1
+    assert set(tickets['_explain']['timings_ms']) == {"lookup", "embedding", "serialization"}
+
+    # Fixed terms of a nested list and searches without any indexed term
+    tickets_url = "/customers/1/tickets?custom_fields.department=marketing&_explain=1"
+    plan        = client.get(tickets_url, **JSON_HDRS_READ).get_json()['_explain']['plan']
+    assert plan['index_terms'][0]['field'] == "customer_id"
+    assert plan['index_terms'][0]['fixed']
+    assert (plan['scanned'], plan['returned']) == (3, 1)
+
+    tickets_url = _get_root_links(client)['tickets'] + "?custom_fields.department=marketing" \
+                                                       "&_explain=1"
+    plan        = client.get(tickets_url, **JSON_HDRS_READ).get_json()['_explain']['plan']
+    assert plan['strategy'] == "full_scan"
+    assert (plan['scanned'], plan['returned']) == (4, 1)
+
+    # Without explain, there is no such section
+    tickets_url = _get_root_links(client)['tickets'] + "?status=OPEN&_explain=0"
+    assert '_explain' not in client.get(tickets_url, **JSON_HDRS_READ).get_json()
+
+    rv = client.get(_get_root_links(client)['tickets'] + "?_explain=yes", **JSON_HDRS_READ)
+    assert rv.status_code == 400
+    assert "invalid value for _explain: yes" in rv.get_json()['message']
+
+
+def test_list_id_search(client):
+    def get_ids(url, items):
+        rv = client.get(url, **JSON_HDRS_READ)
+        assert rv.is_json  and  rv.status_code == 200
+        res = rv.get_json()
+        return [d['id'] if 'id' in d else d['_links']['self']['href']
+                for d in (res['_embedded'][items] if '_embedded' in res else res[items])]
+
+    # Several resources are fetched at once, in the order of their IDs. Unknown IDs are
+    # skipped, and other search terms still apply.
+    assert get_ids("/tickets?id=4&id=1&id=99", "tickets") == [1, 4]
+    assert get_ids("/tickets?id=1&id=2&status=OPEN", "tickets") == [1]
+    assert get_ids("/customers/1/tickets?id=1&id=2", "tickets") == [1]
+    assert get_ids("/users?id=2", "users") == [2]
+    assert get_ids("/customers?id=1&id=2", "customers") == [1, 2]
+    assert get_ids("/comments?id=2", "comments") == ["/comments/2"]
+    assert get_ids("/attachments?id=1&id=2", "attachments") == \
+                                                    ["/attachments/1", "/attachments/2"]
+
+    # The documents are looked up directly, rather than scanning the table
+    plan = client.get("/tickets?id=1&id=4&_explain=1",
+                      **JSON_HDRS_READ).get_json()['_explain']['plan']
+    assert plan['strategy'] == "index"
+    assert plan['index_terms'][0]['index'] == "DocumentID"
+    assert (plan['scanned'], plan['returned']) == (0, 2)
+
+    rv = client.get("/tickets?id=foo", **JSON_HDRS_READ)
+    assert rv.status_code == 400
+
+
+def test_list_timestamp_search(client):
+    def get_ids(url, items):
+        rv = client.get(url, **JSON_HDRS_READ)
+        assert rv.is_json  and  rv.status_code == 200
+        res = rv.get_json()
+        return [d['id'] if 'id' in d else d['_links']['self']['href']
+                for d in (res['_embedded'][items] if '_embedded' in res else res[items])]
+
+    tickets_url = _get_root_links(client)['tickets']
+    assert get_ids(tickets_url + "?updated_since=2020-05-13T21:32:07.199672",
+                   "tickets") == [3, 4]
+    assert get_ids(tickets_url + "?updated_since=2020-05-14", "tickets") == [4]
+    assert get_ids(tickets_url + "?created_since=2020-05-14&customer_id=1", "tickets") == [4]
+    assert get_ids("/customers/1/tickets?created_since=2020-05-01", "tickets") == [3, 4]
+    # Several timestamps are the same as the earliest of them, time zones are converted
+    assert get_ids(tickets_url + "?updated_since=2020-05-14&updated_since=2020-05-13",
+                   "tickets") == [3, 4]
+    assert get_ids(tickets_url + "?updated_since=2030-01-01T00:00:00Z", "tickets") == []
+    assert get_ids("/comments?updated_since=2020-05-14T14:09:26", "comments") == \
+                                                                            ["/comments/2"]
+    assert get_ids("/attachments?created_since=2020-06-12T12:00", "attachments") == \
+                                                    ["/attachments/1", "/attachments/2"]
+
+    # Users and customers of the example data have no timestamps, until they are changed
+    users_url = _get_root_links(client)['users']
+    assert get_ids(users_url + "?updated_since=2020-01-01", "users") == []
+    rv = client.put(users_url + "/2", **JSON_HDRS_READWRITE,
+                    data = json.dumps({"email" : ["updated@example.com"]}))
+    assert rv.status_code == 200
+    assert get_ids(users_url + "?updated_since=2020-01-01", "users") == [2]
+    assert get_ids("/customers?created_since=2020-01-01", "customers") == []
+
+    # The search is answered from the timestamp index
+    plan = client.get(tickets_url + "?updated_since=2020-05-14&_explain=1",
+                      **JSON_HDRS_READ).get_json()['_explain']['plan']
+    assert plan['strategy'] == "index"
+    assert plan['index_terms'][0]['field'] == "updated_since"
+    assert plan['index_terms'][0]['matches'] == 1
+
+    for url in [tickets_url + "?updated_since=yesterday", "/comments?text=foo"]:
+        rv = client.get(url, **JSON_HDRS_READ)
+        assert rv.is_json  and  rv.status_code == 400
+
+
+def test_list_pagination(client):
+    def get_page(url):
+        rv = client.get(url, **JSON_HDRS_READ)
+        assert rv.is_json  and  rv.status_code == 200
+        page = rv.get_json()
+        return [t['id'] for t in page['_embedded']['tickets']], page['_links']
+
+    # Walk forward through the pages
+    tickets_url = _get_root_links(client)['tickets']
+    ids, links  = get_page(tickets_url + "?limit=3")
+    assert ids == [1, 2, 3]
+    assert "prev" not in links
+    ids, links  = get_page(links['next']['href'])
+    assert ids == [4]
+    assert "next" not in links
+
+    # ... and back
+    ids, links  = get_page(links['prev']['href'])
+    assert ids == [1, 2, 3]
+    assert "prev" not in links
+    assert "next" in links
+
+    # Pages of a search keep the search terms in their links
+    ids, links = get_page(tickets_url + "?status=OPEN&limit=1")
+    assert ids == [1]
+    assert "status=OPEN" in links['next']['href']
+    ids, links = get_page(links['next']['href'])
+    assert ids == [3]
+    ids, links = get_page(links['next']['href'])
+    assert ids == [4]
+    assert "next" not in links
+    ids, links = get_page(links['prev']['href'])
+    assert ids == [3]
+
+    # A search that needs to evaluate a term against the documents
+    ids, links = get_page("/customers/1/tickets?classification.l1=incident&limit=1")
+    assert ids == [1]
+    assert "next" not in links
+
+    # Lists without embedded resources support pages as well
+    rv = client.get("/comments?limit=1", **JSON_HDRS_READ)
+    assert [c['_links']['self']
+            for c in rv.get_json()['comments']] == [{"href": "/comments/1"}]
+    rv = client.get(rv.get_json()['_links']['next']['href'], **JSON_HDRS_READ)
+    assert [c['_links']['self']
+            for c in rv.get_json()['comments']] == [{"href": "/comments/2"}]
+
+    for url, error_msg in [(tickets_url + "?limit=0", "limit needs to be between 1 and"),
+                           (tickets_url + "?limit=foo", "invalid limit: foo"),
+                           (tickets_url + "?limit=1&cursor=foo", "invalid cursor: foo"),
+                           (tickets_url + "?cursor=eyJhZnRlciI6MX0", "together with a limit")]:
+        rv = client.get(url, **JSON_HDRS_READ)
+        assert rv.status_code == 400
+        assert error_msg in rv.get_json()['message']
+
+
+def test_list_streaming(client):
+    for url in ["/tickets", "/tickets?status=OPEN&classification.l1=incident",
+                "/customers/1/users", "/comments"]:
+        full_list = client.get(url, **JSON_HDRS_READ).get_json()
+
+        # A streamed JSON list has the same content as the normal one
+        rv = client.get(url + ("&" if "?" in url else "?") + "_stream=1", **JSON_HDRS_READ)
+        assert rv.is_streamed
+        assert rv.is_json  and  rv.status_code == 200
+        assert rv.get_json() == full_list
+
+        # With NDJSON, every line holds one of the resources of the list
+        rv = client.get(url, headers={'Accept' : 'application/x-ndjson'})
+        assert rv.is_streamed  and  rv.status_code == 200
+        assert rv.headers['Content-Type'] == "application/x-ndjson"
+        items = full_list.get('_embedded', full_list)
+        items = [value for key, value in items.items() if isinstance(value, list)][0]
+        assert [json.loads(line) for line in rv.get_data(as_text=True).splitlines()] == items
+
+    # Pages can be streamed, too
+    page = client.get("/tickets?limit=2&_stream=1", **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in page['_embedded']['tickets']] == [1, 2]
+    assert page['total_queried'] == 2
+    page = client.get(page['_links']['next']['href'], **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in page['_embedded']['tickets']] == [3, 4]
+
+    rv = client.get("/tickets?_stream=1&_explain=1", **JSON_HDRS_READ)
+    assert rv.status_code == 400
+    assert "a streamed list cannot be explained" in rv.get_json()['message']
+
+    rv = client.get("/tickets?foo=bar", headers={'Accept' : 'application/x-ndjson'})
+    assert rv.status_code == 400
+
 
 def test_customer_user_list(client):
     customer_url = _get_root_links(client)['customers'] + "/1"
@@ -454,6 +744,11 @@ def test_customer_ticket_list(client):
     # created timestamps
     assert should_ticket.items() <= ticket.items()
 
+    # A search within the tickets of the customer
+    customer_ticket_list = client.get(customer_ticket_list_url + "?user_id=3&user_id=2",
+                                      **JSON_HDRS_READ).get_json()
+    assert [t['id'] for t in customer_ticket_list['_embedded']['tickets']] == [3]
+
 
 def test_user_customer_list(client):
     user_url = _get_root_links(client)['users'] + "/1"
@@ -753,6 +1048,36 @@ def test_update_comment(client):
     assert comment['text'] == "This is an updated text"
 
 
+def test_embedded_comments_follow_updates(client):
+    # The embedded comments of a ticket are found via an index on the comment table, which
+    # needs to follow any change of a comment's type.
+    ticket_url  = _get_root_links(client)['tickets'] + "/1"
+    ticket      = client.get(ticket_url, **JSON_HDRS_READ).get_json()
+    comment_url = ticket['_embedded']['comments'][0]['_links']['self']['href']
+
+    rv = client.put(comment_url, **JSON_HDRS_READWRITE,
+                    data = json.dumps({"user_id"   : 1,
+                                       "ticket_id" : 1,
+                                       "text"      : "Now a worknote",
+                                       "type"      : "WORKNOTE"}))
+    assert rv.is_json  and  rv.status_code == 200
+
+    ticket = client.get(ticket_url, **JSON_HDRS_READ).get_json()
+    assert ticket['_embedded']['comments'] == []
+    assert [w['text'] for w in ticket['_embedded']['worknotes']] == \
+                                            ["Has there been a follow up?", "Now a worknote"]
+
+    # A newly created comment shows up right away as well
+    rv = client.post(_get_root_links(client)['comments'], **JSON_HDRS_READWRITE,
+                     data = json.dumps({"user_id"   : 1,
+                                        "ticket_id" : 1,
+                                        "text"      : "Another comment",
+                                        "type"      : "COMMENT"}))
+    assert rv.is_json  and  rv.status_code == 201
+    ticket = client.get(ticket_url, **JSON_HDRS_READ).get_json()
+    assert [c['text'] for c in ticket['_embedded']['comments']] == ["Another comment"]
+
+
 def test_create_comment(client):
     comments_url  = _get_root_links(client)['comments']
 
@@ -815,6 +1140,331 @@ def test_create_comment(client):
     assert post_response == comment
 
 
+def test_conditional_get(client):
+    def get(url, etag=None, accept='application/json'):
+        headers = {'Accept' : accept}
+        if etag:
+            headers['If-None-Match'] = etag
+        return client.get(url, headers=headers)
+
+    # Single and list resources have an ETag, which tells whether the client's copy is current
+    etags = {}
+    for url in ["/tickets/1", "/tickets", "/comments", "/users/1", "/users/1/customers"]:
+        rv = get(url)
+        assert rv.status_code == 200  and  rv.headers['ETag']
+        etags[url] = rv.headers['ETag']
+        rv = get(url, etags[url])
+        assert rv.status_code == 304  and  rv.data == b""
+        assert rv.headers['ETag'] == etags[url]
+
+    # Other parameters and other content types are other representations
+    assert get("/tickets/1?fields=status").headers['ETag'] != etags["/tickets/1"]
+    assert get("/tickets/1", etags["/tickets/1"], accept='text/html').status_code == 200
+    assert get("/tickets", etags["/tickets"],
+               accept='application/x-ndjson').status_code == 200
+
+    # A change of a comment changes the comments and the ticket they are embedded in, but
+    # not the other resources
+    rv = client.put("/comments/2", **JSON_HDRS_READWRITE,
+                    data = json.dumps({"user_id"   : 1,
+                                       "ticket_id" : 1,
+                                       "text"      : "An updated text",
+                                       "type"      : "COMMENT"}))
+    assert rv.status_code == 200
+    for url in ["/tickets/1", "/comments"]:
+        rv = get(url, etags[url])
+        assert rv.status_code == 200  and  rv.headers['ETag'] != etags[url]
+        assert get(url, rv.headers['ETag']).status_code == 304
+    for url in ["/tickets", "/users/1", "/users/1/customers"]:
+        assert get(url, etags[url]).status_code == 304
+
+    # Rejected writes don't change anything, so the ETags stay valid
+    rv = client.post("/tickets", **JSON_HDRS_READWRITE, data = json.dumps({"status" : "BAD"}))
+    assert rv.status_code == 400
+    rv = client.put("/users/2", **JSON_HDRS_READWRITE,
+                    data = json.dumps({"email" : ["foo@foobar.com"]}))
+    assert rv.status_code == 400
+    for url in ["/tickets", "/users/1", "/users/1/customers"]:
+        assert get(url, etags[url]).status_code == 304
+
+    # Errors don't have an ETag
+    rv = get("/tickets/999")
+    assert rv.status_code == 404  and  'ETag' not in rv.headers
+
+
+def test_conditional_get_shared_sqlite(client):
+    if app.config['DB_BACKEND'] != "sqlite":
+        pytest.skip("only the SQLite database can be shared by several server processes")
+    rv   = client.get("/tickets/1", **JSON_HDRS_READ)
+    etag = rv.headers['ETag']
+
+    # The ETags don't change when the database is opened again, for example by another
+    # server process
+    init_db()
+    rv = client.get("/tickets/1", headers={'Accept' : 'application/json',
+                                           'If-None-Match' : etag})
+    assert rv.status_code == 304
+
+    # A change made through another connection to the database, as another server process
+    # would make it, changes the ETag
+    other_db = SQLiteDB(app.config['DB_SQLITE_NAME'])
+    try:
+        with other_db.transaction():
+            other_db.table('tickets').update({"title" : "Changed elsewhere"}, doc_ids=[1])
+    finally:
+        other_db.close()
+    rv = client.get("/tickets/1", headers={'Accept' : 'application/json',
+                                           'If-None-Match' : etag})
+    assert rv.status_code == 200
+    assert rv.get_json()['title'] == "Changed elsewhere"  and  rv.headers['ETag'] != etag
+
+
+def test_conditional_put(client):
+    def put(url, data, etag=None):
+        headers = dict(JSON_HDRS_READWRITE['headers'])
+        if etag:
+            headers['If-Match'] = etag
+        return client.put(url, headers=headers, data=json.dumps(data))
+
+    # The ETag of an individual resource starts with the version of its document
+    rv     = client.get("/tickets/3", **JSON_HDRS_READ)
+    ticket = rv.get_json()
+    etag   = rv.headers['ETag']
+    assert etag.startswith('"v0-')
+
+    # A resource that was read can be sent back as a whole, with a changed field
+    ticket['status'] = "CLOSED"
+    rv = put("/tickets/3", ticket, etag)
+    assert rv.is_json  and  rv.status_code == 200
+    new_etag = rv.headers['ETag']
+    assert new_etag.startswith('"v1-')
+    rv = client.get("/tickets/3", **JSON_HDRS_READ)
+    assert rv.headers['ETag'] == new_etag
+    assert rv.get_json()['_version'] == 1
+    assert rv.get_json()['status'] == "CLOSED"
+
+    # An update based on the old version is refused, and doesn't change anything
+    ticket['status'] = "OPEN"
+    rv = put("/tickets/3", ticket, etag)
+    assert rv.is_json  and  rv.status_code == 412
+    assert client.get("/tickets/3", **JSON_HDRS_READ).get_json()['status'] == "CLOSED"
+
+    # Changes to other resources don't make the ETag stale for an update
+    user_etag = client.get("/users/1", **JSON_HDRS_READ).headers['ETag']
+    rv = put("/users/2", {"email" : ["another@example.com"]})
+    assert rv.status_code == 200
+    rv = put("/users/1", {"email" : ["some@user.com"]}, user_etag)
+    assert rv.status_code == 200
+    rv = put("/users/1", {"email" : ["other@user.com"]}, user_etag)
+    assert rv.status_code == 412
+
+    # Any version matches '*', and updates without If-Match aren't checked
+    comment = {"user_id" : 1, "ticket_id" : 1, "text" : "Some text", "type" : "COMMENT"}
+    assert put("/comments/2", comment, "*").status_code == 200
+    assert put("/comments/2", comment).status_code == 200
+    assert client.get("/comments/2", **JSON_HDRS_READ).get_json()['_version'] == 2
+
+
+def test_patch(client):
+    def patch(url, data, etag=None, content_type="application/merge-patch+json"):
+        headers = {'Accept' : 'application/json', 'Content-Type' : content_type}
+        if etag:
+            headers['If-Match'] = etag
+        return client.patch(url, headers=headers, data=json.dumps(data))
+
+    # Only the keys in the patch are changed, the rest of the ticket stays as it is
+    before = client.get("/tickets/1", **JSON_HDRS_READ).get_json()
+    rv     = patch("/tickets/1", {"status" : "CLOSED"})
+    assert rv.is_json  and  rv.status_code == 200
+    assert rv.headers['ETag'].startswith('"v1-')
+    after = client.get("/tickets/1", **JSON_HDRS_READ).get_json()
+    assert after['status'] == "CLOSED"  and  after['_version'] == 1
+    for key in ("aportio_id", "short_title", "long_text", "classification", "custom_fields"):
+        assert after[key] == before[key]
+
+    # Objects are merged, and null removes a key
+    rv = patch("/tickets/1", {"classification" : {"l2" : None, "l3" : "x"},
+                              "custom_fields" : None}, rv.headers['ETag'])
+    assert rv.status_code == 200
+    after = client.get("/tickets/1", **JSON_HDRS_READ).get_json()
+    assert after['classification'] == {"l1" : "incident", "l3" : "x"}
+    assert "custom_fields" not in after  and  after['_version'] == 2
+
+    # The changed keys are validated, and keys can't be changed or removed if they mustn't
+    for data, msg in [({"status" : "FOO"}, "key 'status'"),
+                      ({"foo" : 1}, "invalid key(s)"),
+                      ({"short_title" : None}, "cannot remove mandatory key(s): short_title"),
+                      ({"classification" : {"l1" : None}}, "L1 classification missing"),
+                      ({"customer_id" : 2}, "cannot change customer ID"),
+                      ({"aportio_id" : "2222"}, "exists already"),
+                      ([], "expected a JSON object")]:
+        rv = patch("/tickets/1", data)
+        assert rv.status_code == 400  and  msg in rv.get_json()['message']
+    assert client.get("/tickets/1", **JSON_HDRS_READ).get_json()['_version'] == 2
+
+    # A stale If-Match is refused
+    assert patch("/tickets/1", {"status" : "OPEN"}, '"v1-0"').status_code == 412
+
+    # Users, customers and comments can be patched too, but not other resources
+    assert patch("/users/2", {"custom_fields" : {"mobile" : None}},
+                 content_type="application/json").status_code == 200
+    assert client.get("/users/2", **JSON_HDRS_READ).get_json()['custom_fields'] == \
+        {"address" : {"street" : "456 Elm Street", "city" : "Littleville"}}
+    assert patch("/customers/1", {"name" : "Baz Company"}).status_code == 200
+    assert client.get("/customers/1", **JSON_HDRS_READ).get_json()['name'] == "Baz Company"
+    assert patch("/customers/1", {"parent_id" : 1}).status_code == 400
+    assert patch("/comments/1", {"text" : "Any news?"}).status_code == 200
+    assert client.get("/comments/1", **JSON_HDRS_READ).get_json()['text'] == "Any news?"
+    assert patch("/comments/1", {"ticket_id" : 2}).status_code == 400
+    assert patch("/attachments/1", {"filename" : "foo.txt"}).status_code == 405
+    rv = patch("/tickets/1", {"status" : "OPEN"}, content_type="text/plain")
+    assert rv.status_code == 406
+    assert patch("/tickets/99", {"status" : "OPEN"}).status_code == 404
+
+
+def test_bulk_create(client):
+    # A JSON array of tickets, of which one fails its check and doesn't stop the others
+    tickets = [{"aportio_id" : f"bulk-{i}", "customer_id" : 1, "user_id" : 1,
+                "short_title" : f"Bulk ticket {i}", "long_text" : "Imported",
+                "status" : "OPEN", "classification" : {"l1" : "incident"}} for i in range(3)]
+    tickets[1]['user_id'] = 2   # not associated with customer 1
+    rv = client.post("/tickets/_bulk", data=json.dumps(tickets), **JSON_HDRS_READWRITE)
+    assert rv.status_code == 200
+    res = rv.get_json()
+    assert res['errors'] is True
+    assert [item['status'] for item in res['items']] == [201, 400, 201]
+    assert "is not associated with customer" in res['items'][1]['message']
+    new_ticket_url = res['items'][2]['_links']['self']['href']
+    assert client.get(new_ticket_url, **JSON_HDRS_READ).get_json()['aportio_id'] == "bulk-2"
+    assert client.get("/tickets?aportio_id=bulk-1", **JSON_HDRS_READ) \
+                 .get_json()['_embedded']['tickets'] == []
+
+    # NDJSON, with a line that isn't JSON
+    comments = [json.dumps({"ticket_id" : 1, "user_id" : 1, "text" : f"Comment {i}",
+                            "type" : "COMMENT"}) for i in range(2)]
+    rv = client.post("/comments/_bulk", data="\n".join([comments[0], "{foo", "", comments[1]]),
+                     headers={'Accept' : 'application/json',
+                              'Content-Type' : 'application/x-ndjson'})
+    assert rv.status_code == 200
+    assert [item['status'] for item in rv.get_json()['items']] == [201, 400, 201]
+    assert "invalid JSON" in rv.get_json()['items'][1]['message']
+
+    # Resources earlier in the request are taken into account by the checks of later ones
+    users = [{"email" : ["bulk@user.com"]}, {"email" : ["BULK@user.com"]}, "foo"]
+    rv    = client.post("/users/_bulk", data=json.dumps(users), **JSON_HDRS_READWRITE)
+    assert [item['status'] for item in rv.get_json()['items']] == [201, 400, 400]
+
+    # An item with a value of an unexpected type only fails itself
+    users = [{"email" : ["typed1@user.com"]},
+             {"email" : ["typed2@user.com"], "custom_fields" : 5},
+             {"email" : ["typed3@user.com"]}]
+    rv    = client.post("/users/_bulk", data=json.dumps(users), **JSON_HDRS_READWRITE)
+    assert rv.status_code == 200
+    items = rv.get_json()['items']
+    assert [item['status'] for item in items] == [201, 500, 201]
+    assert "TypeError" in items[1]['message']
+    assert client.get("/users?email=typed2@user.com", **JSON_HDRS_READ) \
+                 .get_json()['_embedded']['users'] == []
+    assert client.get("/users?email=typed3@user.com", **JSON_HDRS_READ) \
+                 .get_json()['_embedded']['users'] != []
+
+    # Requests, which aren't a list of resources or are too large, don't create anything
+    rv = client.post("/users/_bulk", data=json.dumps(users[0]), **JSON_HDRS_READWRITE)
+    assert rv.status_code == 400
+    app.config['BULK_MAX_ITEMS'] = 2
+    try:
+        users = [{"email" : [f"bulk{i}@user.com"]} for i in range(3)]
+        rv    = client.post("/users/_bulk", data=json.dumps(users), **JSON_HDRS_READWRITE)
+        assert rv.status_code == 400
+        assert client.get("/users?email=bulk0@user.com", **JSON_HDRS_READ) \
+                     .get_json()['_embedded']['users'] == []
+    finally:
+        del app.config['BULK_MAX_ITEMS']
+    assert client.get("/users/_bulk", **JSON_HDRS_READ).status_code == 405
+
+
+def test_change_stream(client):
+    def parse_event(chunk):
+        # Return the fields of a Server-Sent Event, with the data as JSON
+        event = dict(line.split(": ", 1) for line in chunk.decode().strip().split("\n"))
+        if 'data' in event:
+            event['data'] = json.loads(event['data'])
+        return event
+
+    app.config['CHANGES_KEEPALIVE_S'] = 0.05
+    sse_hdrs = {'headers' : {'Accept' : 'text/event-stream'}}
+
+    # A new subscriber only sees new changes, and is kept alive until there are some
+    rv = client.get('/changes', buffered=False, **sse_hdrs)
+    assert rv.status_code == 200  and  rv.mimetype == "text/event-stream"
+    events = iter(rv.response)
+    assert next(events) == b": keepalive\n\n"
+
+    rv_put = client.put("/comments/2", **JSON_HDRS_READWRITE,
+                        data = json.dumps({"user_id"   : 1,
+                                           "ticket_id" : 1,
+                                           "text"      : "An updated text",
+                                           "type"      : "COMMENT"}))
+    assert rv_put.status_code == 200
+    event = parse_event(next(events))
+    assert event['id'] == "1"
+    assert event['data']['resource'] == "comment"
+    assert event['data']['action'] == "update"
+    assert event['data']['id'] == 2
+    assert event['data']['_links'] == {"self" : {"href" : "/comments/2"}}
+
+    rv_post = client.post("/comments", **JSON_HDRS_READWRITE,
+                          data = json.dumps({"user_id"   : 1,
+                                             "ticket_id" : 1,
+                                             "text"      : "A new text",
+                                             "type"      : "WORKNOTE"}))
+    assert rv_post.status_code == 201
+    event = parse_event(next(events))
+    assert (event['id'], event['data']['action'], event['data']['id']) == ("2", "create", 3)
+    rv.close()
+
+    # Resume after the first event, via header or URL parameter
+    for kwargs in [{'headers' : {'Accept' : 'text/event-stream', 'Last-Event-ID' : '1'}},
+                   {'query_string' : {'last_event_id' : 1}, **sse_hdrs}]:
+        rv     = client.get('/changes', buffered=False, **kwargs)
+        events = iter(rv.response)
+        assert parse_event(next(events))['id'] == "2"
+        assert next(events) == b": keepalive\n\n"
+        rv.close()
+
+    # An ID the server doesn't know requires the client to resync
+    rv = client.get('/changes', buffered=False,
+                    headers={'Accept' : 'text/event-stream', 'Last-Event-ID' : '99'})
+    assert parse_event(next(iter(rv.response)))['event'] == "resync"
+    rv.close()
+
+    rv = client.get('/changes', headers={'Accept' : 'text/event-stream',
+                                         'Last-Event-ID' : 'foo'})
+    assert rv.status_code == 400
+
+    # Only the most recent changes are kept
+    app.config['CHANGES_RETAIN'] = 2
+    try:
+        for _ in range(3):
+            rv = client.post("/comments", **JSON_HDRS_READWRITE,
+                             data = json.dumps({"user_id"   : 1,
+                                                "ticket_id" : 1,
+                                                "text"      : "More text",
+                                                "type"      : "COMMENT"}))
+            assert rv.status_code == 201
+    finally:
+        del app.config['CHANGES_RETAIN']
+    rv = client.get('/changes', buffered=False,
+                    headers={'Accept' : 'text/event-stream', 'Last-Event-ID' : '3'})
+    assert parse_event(next(iter(rv.response)))['id'] == "4"
+    rv.close()
+    rv = client.get('/changes', buffered=False,
+                    headers={'Accept' : 'text/event-stream', 'Last-Event-ID' : '1'})
+    assert parse_event(next(iter(rv.response)))['event'] == "resync"
+    rv.close()
+    del app.config['CHANGES_KEEPALIVE_S']
+
+
 def test_get_attachments_list(client):
     # Get the url to the attachments list resource, then get the list of attachments that are
     # currently stored in the database.
@@ -897,6 +1547,37 @@ def test_get_attachment(client):
     assert attachment['_embedded']['ticket']['id'] == 1
 
 
+def test_get_attachment_content(client):
+    with open(os.path.join("attachment_storage", "ticket__2", "2__mt-fuji.jpeg"), "rb") as f:
+        image = f.read()
+
+    # The raw file is returned with the content type of the attachment
+    attachment = client.get("/attachments/2", **JSON_HDRS_READ).get_json()
+    rv         = client.get(attachment['_links']['content']['href'])
+    assert rv.status_code == 200  and  rv.mimetype == "image/jpeg"
+    assert rv.data == image
+    assert int(rv.headers['Content-Length']) == len(image)
+    assert "mt-fuji.jpeg" in rv.headers['Content-Disposition']
+    assert rv.headers['Accept-Ranges'] == "bytes"
+
+    # A download can be resumed with a range request
+    rv = client.get("/attachments/2/content", headers={'Range' : "bytes=100-"})
+    assert rv.status_code == 206
+    assert rv.data == image[100:]
+    assert rv.headers['Content-Range'] == f"bytes 100-{len(image) - 1}/{len(image)}"
+    rv = client.get("/attachments/2/content", headers={'Range' : f"bytes={len(image)}-"})
+    assert rv.status_code == 416
+
+    # The file's ETag makes the download conditional
+    etag = client.get("/attachments/2/content").headers['ETag']
+    rv   = client.get("/attachments/2/content", headers={'If-None-Match' : etag})
+    assert rv.status_code == 304
+
+    for url in ["/attachments/999/content", "/attachments/foo/content"]:
+        rv = client.get(url)
+        assert rv.status_code == 404  and  rv.is_json
+
+
 def test_embedded_attachments_in_ticket(client):
     # Get a ticket that has a attachment
     ticket_url = _get_root_links(client)['tickets'] + "/1"
@@ -925,6 +1606,54 @@ def test_embedded_attachments_in_ticket(client):
     assert attachment['_created'] == attachment['_updated']
 
 
+def test_fields_and_embed(client):
+    # A sparse ticket without any of its embedded resources
+    ticket_url = _get_root_links(client)['tickets'] + "/1"
+    rv         = client.get(ticket_url + "?fields=id,status,_created&embed=none",
+                            **JSON_HDRS_READ)
+    assert rv.is_json  and  rv.status_code == 200
+    ticket = rv.get_json()
+    assert set(ticket) == {"id", "status", "_created", "_links"}
+    assert ticket['status'] == "OPEN"
+
+    # Only some of the embedded resources
+    ticket = client.get(ticket_url + "?embed=comments,attachments",
+                        **JSON_HDRS_READ).get_json()
+    assert set(ticket['_embedded']) == {"comments", "attachments"}
+    assert "long_text" in ticket
+
+    # The attachment data is only loaded if it's asked for
+    attachment_url = _get_root_links(client)['attachments'] + "/1"
+    attachment     = client.get(attachment_url + "?fields=filename&embed=none",
+                                **JSON_HDRS_READ).get_json()
+    assert set(attachment) == {"filename", "_links"}
+    attachment     = client.get(attachment_url + "?fields=attachment_data",
+                                **JSON_HDRS_READ).get_json()
+    assert attachment['attachment_data'].startswith("VGhpcyBpcyBh")
+    assert attachment['_embedded']['ticket']['id'] == 1
+
+    # The user is the only embedded resource of this comment
+    comment = client.get("/comments/1?embed=user", **JSON_HDRS_READ).get_json()
+    assert set(comment['_embedded']) == {"user"}
+
+    # Lists return the requested fields of each resource
+    rv = client.get(_get_root_links(client)['tickets'] + "?fields=id,status",
+                    **JSON_HDRS_READ)
+    assert rv.is_json  and  rv.status_code == 200
+    for ticket in rv.get_json()['_embedded']['tickets']:
+        assert set(ticket) == {"id", "status", "_links"}
+    comments = client.get("/comments?fields=text", **JSON_HDRS_READ).get_json()['comments']
+    assert comments
+    assert all(set(comment) == {"text", "_links"} for comment in comments)
+
+    # Unknown embedded resources and empty parameters are rejected
+    for args in ["?embed=customer", "?fields=", "?embed=none,comments"]:
+        rv = client.get(ticket_url + args, **JSON_HDRS_READ)
+        assert rv.is_json  and  rv.status_code == 400
+    rv = client.get("/users?embed=tickets", **JSON_HDRS_READ)
+    assert rv.status_code == 400
+
+
 def test_post_attachment(client):
     # Get the url to the attachments list resource
     attachments_url = _get_root_links(client)['attachments']
@@ -992,15 +1721,13 @@ def test_post_attachment(client):
     assert attachment_data['_updated'] == newest_attachment_entry['_updated']
     assert attachment_data['_links'] == {
         'self'         : {'href': '/attachments/3'},
-        'contained_in' : {'href': '/attachments'}
+        'contained_in' : {'href': '/attachments'},
+        'content'      : {'href': '/attachments/3/content'}
     }
 
     # Finally, check that the correct attachment file was saved to the attachments directory
-    # under the correct ticket ID with the correct name
-    ticket_id           = str(attachment_data['ticket_id'])
-    attachment_id       = str(attachment_data['id'])
-    path_to_attach_file = os.path.join("attachment_storage", f"ticket__{ticket_id}",
-                                       f"{attachment_id}__text_to_post.txt")
+    # under the hash of its content
+    path_to_attach_file = _blob_path(attachment_data)
     assert os.path.isfile(path_to_attach_file)
 
     # Check that the contents of that file match the contents of the original file
@@ -1011,3 +1738,485 @@ def test_post_attachment(client):
 
     # Remove the directory holding the attachment file that was created from this test
     os.remove(path_to_attach_file)
+
+
+def test_upload_attachment(client):
+    def check_upload(rv, filename, content_type):
+        assert rv.status_code == 201
+        attachment = rv.get_json()
+        assert "attachment_data" not in attachment
+        assert attachment['filename'] == filename
+        assert attachment['content_type'] == content_type
+        assert attachment['size'] == len(data)
+        assert attachment['sha256'] == hashlib.sha256(data).hexdigest()
+        assert rv.headers['Location'].endswith(f"/attachments/{attachment['id']}")
+        assert client.get(f"/attachments/{attachment['id']}/content").data == data
+        return attachment
+
+    with open(os.path.join("test_data", "text_to_post.txt"), "rb") as f:
+        data = f.read()
+    created = []
+    try:
+        # The raw file, with the metadata in the URL
+        rv = client.post("/attachments?ticket_id=1&filename=raw.txt", data=data,
+                         headers={'Accept' : 'application/json',
+                                  'Content-Type' : 'text/plain'})
+        created.append(check_upload(rv, "raw.txt", "text/plain"))
+
+        # A form, with the file name and content type of the file field
+        rv = client.post("/attachments", headers={'Accept' : 'application/json'},
+                         content_type="multipart/form-data",
+                         data={"ticket_id" : "2",
+                               "attachment_data" : (io.BytesIO(data), "form.log",
+                                                    "text/x-log")})
+        created.append(check_upload(rv, "form.log", "text/x-log"))
+        assert created[-1]['ticket_id'] == 2
+
+        # A base64 JSON document gets a size and hash too
+        encoded = base64.b64encode(data).decode()
+        rv      = client.post("/attachments", **JSON_HDRS_READWRITE,
+                              data=json.dumps({"ticket_id" : 1, "filename" : "json.txt",
+                                               "content_type" : "text/plain",
+                                               "attachment_data" : encoded}))
+        assert rv.status_code == 201
+        created.append(rv.get_json())
+        assert created[-1]['sha256'] == hashlib.sha256(data).hexdigest()
+
+        # Bad metadata is refused, without leaving anything behind
+        for url in ["/attachments?ticket_id=999&filename=raw.txt",
+                    "/attachments?ticket_id=1&filename=../raw.txt",
+                    "/attachments?ticket_id=1"]:
+            rv = client.post(url, data=data, headers={'Accept' : 'application/json',
+                                                      'Content-Type' : 'text/plain'})
+            assert rv.status_code == 400
+        rv = client.post("/attachments", headers={'Accept' : 'application/json'},
+                         content_type="multipart/form-data",
+                         data={"ticket_id" : "999",
+                               "attachment_data" : (io.BytesIO(data), "form.log")})
+        assert rv.status_code == 400
+        assert len(client.get("/attachments", **JSON_HDRS_READ).get_json()['attachments']) == 5
+        assert os.listdir(os.path.join("attachment_storage", ".staging")) == []
+    finally:
+        # All of them have the same content, which is stored only once
+        assert len({_blob_path(attachment) for attachment in created}) == 1
+        os.remove(_blob_path(created[0]))
+
+
+def test_post_attachment_streamed_json(client):
+    def post(body):
+        return client.post("/attachments", data=body, **JSON_HDRS_READWRITE)
+
+    # A file larger than the chunks, in which the body is read, with the base64 line-wrapped
+    # and '/' escaped (both are valid JSON), and the file before the other fields
+    data    = bytes(range(256)) * 1000
+    encoded = base64.encodebytes(data).decode()
+    body    = '{"attachment_data" : %s, "ticket_id" : 1, "filename" : "big.bin", ' \
+              '"content_type" : "application/octet-stream"}' \
+              % json.dumps(encoded).replace("/", "\\/")
+    rv = post(body)
+    assert rv.status_code == 201
+    attachment = rv.get_json()
+    try:
+        assert attachment['size'] == len(data)
+        assert attachment['sha256'] == hashlib.sha256(data).hexdigest()
+        assert client.get(f"/attachments/{attachment['id']}/content").data == data
+    finally:
+        os.remove(_blob_path(attachment))
+
+    # Documents, which aren't valid, and files, which aren't valid base64, create nothing
+    for body, status, msg in [
+            ('{"ticket_id" : 1, "filename" : "x.bin"', 400, "invalid JSON"),
+            ('["ticket_id"]', 400, "invalid JSON"),
+            ('{"ticket_id" : 1} {}', 400, "invalid JSON"),
+            ('{"ticket_id" : "%s"}' % ("1" * 100000), 400, "65536 characters"),
+            ('{"ticket_id" : 1, "filename" : "x.bin", "content_type" : "text/plain", '
+             '"attachment_data" : "QUJD\\u0044"}', 500, "decode"),
+            ('{"attachment_data" : "A===QUJD", "ticket_id" : 1, "filename" : "x.bin", '
+             '"content_type" : "text/plain"}', 500, "decode")]:
+        rv = post(body)
+        assert rv.status_code == status  and  msg in rv.get_json()['message']
+    assert len(client.get("/attachments", **JSON_HDRS_READ).get_json()['attachments']) == 3
+    assert os.listdir(os.path.join("attachment_storage", ".staging")) == []
+
+
+def test_attachment_deduplication(client):
+    def upload(ticket_id, filename):
+        rv = client.post(f"/attachments?ticket_id={ticket_id}&filename={filename}",
+                         data=data, headers={'Accept' : 'application/json',
+                                             'Content-Type' : 'image/png'})
+        assert rv.status_code == 201
+        return rv.get_json()
+
+    # The same file attached to two tickets is stored once, under its hash
+    data  = os.urandom(10000)
+    first = upload(1, "logo.png")
+    try:
+        second = upload(2, "signature.png")
+        assert first['sha256'] == second['sha256'] == hashlib.sha256(data).hexdigest()
+        assert os.listdir(os.path.dirname(_blob_path(first))) == [first['sha256']]
+        assert os.listdir(os.path.join("attachment_storage", "ticket__2")) == \
+                                                                    ["2__mt-fuji.jpeg"]
+        for attachment in (first, second):
+            rv = client.get(f"/attachments/{attachment['id']}/content")
+            assert rv.data == data
+            # The hash is the ETag of the content
+            assert rv.headers['ETag'] == f'"{first["sha256"]}"'
+            rv = client.get(f"/attachments/{attachment['id']}/content",
+                            headers={'If-None-Match' : f'"{first["sha256"]}"'})
+            assert rv.status_code == 304
+    finally:
+        os.remove(_blob_path(first))
+
+
+def test_resumable_upload(client):
+    # Only the metadata of the attachment is given when the session is started
+    rv = client.post("/attachments/uploads", **JSON_HDRS_READWRITE,
+                     data=json.dumps({"ticket_id" : 1, "filename" : "big.bin",
+                                      "content_type" : "application/octet-stream",
+                                      "attachment_data" : "MTIzNA=="}))
+    assert rv.status_code == 400
+    assert "sent in chunks" in rv.get_json()['message']
+    rv = client.post("/attachments/uploads", **JSON_HDRS_READWRITE,
+                     data=json.dumps({"ticket_id" : 999, "filename" : "big.bin",
+                                      "content_type" : "application/octet-stream"}))
+    assert rv.status_code == 400
+    rv = client.post("/attachments/uploads", **JSON_HDRS_READWRITE,
+                     data=json.dumps({"ticket_id" : 1, "filename" : "big.bin",
+                                      "content_type" : "application/octet-stream"}))
+    assert rv.status_code == 201
+    upload     = rv.get_json()
+    upload_url = rv.headers['Location']
+    assert upload['chunks'] == [] and upload['size'] == 0
+
+    # Chunks can arrive in any order, and a chunk that is sent again replaces the first one
+    data   = os.urandom(200000)
+    chunks = [data[:70000], data[70000:140000], data[140000:]]
+    for number in (2, 0):
+        rv = client.put(f"{upload_url}/chunks/{number}", data=chunks[number],
+                        headers={'Accept' : 'application/json'})
+        assert rv.status_code == 200
+        assert rv.get_json() == {"chunk" : number, "size" : len(chunks[number]),
+                                 "sha256" : hashlib.sha256(chunks[number]).hexdigest()}
+    rv = client.put(f"{upload_url}/chunks/x", data=b"",
+                    headers={'Accept' : 'application/json'})
+    assert rv.status_code == 400
+    rv = client.put("/attachments/uploads/999/chunks/1", data=b"",
+                    headers={'Accept' : 'application/json'})
+    assert rv.status_code == 404
+
+    # The commit needs all chunks
+    commit_url = upload['_links']['commit']['href']
+    rv = client.post(commit_url, headers={'Accept' : 'application/json'})
+    assert rv.status_code == 400
+    assert "missing chunk(s): 1" in rv.get_json()['message']
+    rv = client.put(f"{upload_url}/chunks/1", data=b"garbled",
+                    headers={'Accept' : 'application/json'})
+    rv = client.put(f"{upload_url}/chunks/1", data=chunks[1],
+                    headers={'Accept' : 'application/json'})
+    rv = client.get(upload_url, headers={'Accept' : 'application/json'})
+    assert rv.get_json()['chunks'] == [{"chunk" : number, "size" : len(chunk)}
+                                       for number, chunk in enumerate(chunks)]
+    assert rv.get_json()['size'] == len(data)
+
+    # An expected hash, which doesn't match, keeps the session
+    rv = client.post(commit_url, **JSON_HDRS_READWRITE,
+                     data=json.dumps({"size" : len(data), "sha256" : "0" * 64}))
+    assert rv.status_code == 400
+    rv = client.post(commit_url, **JSON_HDRS_READWRITE,
+                     data=json.dumps({"size" : len(data),
+                                      "sha256" : hashlib.sha256(data).hexdigest()}))
+    assert rv.status_code == 201
+    attachment = rv.get_json()
+    try:
+        assert attachment['filename'] == "big.bin" and attachment['size'] == len(data)
+        assert 'attachment_data' not in attachment
+        rv = client.get(f"/attachments/{attachment['id']}/content")
+        assert rv.data == data
+        # The session has ended, and its chunks are gone
+        rv = client.get(upload_url, headers={'Accept' : 'application/json'})
+        assert rv.status_code == 404
+        assert not os.path.exists(os.path.join("attachment_storage", "uploads",
+                                               str(upload['id'])))
+    finally:
+        os.remove(_blob_path(attachment))
+
+    # A session can be cancelled
+    rv = client.post("/attachments/uploads", **JSON_HDRS_READWRITE,
+                     data=json.dumps({"ticket_id" : 1, "filename" : "big.bin",
+                                      "content_type" : "application/octet-stream"}))
+    upload_url = rv.headers['Location']
+    rv = client.put(f"{upload_url}/chunks/0", data=b"1234",
+                    headers={'Accept' : 'application/json'})
+    rv = client.delete(upload_url, headers={'Accept' : 'application/json'})
+    assert rv.status_code == 200
+    rv = client.get(upload_url, headers={'Accept' : 'application/json'})
+    assert rv.status_code == 404
+
+    # Sessions, which have been inactive for too long, are removed when a session is started
+    metadata = json.dumps({"ticket_id" : 1, "filename" : "big.bin",
+                           "content_type" : "application/octet-stream"})
+    rv = client.post("/attachments/uploads", **JSON_HDRS_READWRITE, data=metadata)
+    upload_url = rv.headers['Location']
+    app.config['UPLOAD_SESSION_TTL_S'] = -1
+    try:
+        rv = client.post("/attachments/uploads", **JSON_HDRS_READWRITE, data=metadata)
+        new_upload_url = rv.headers['Location']
+    finally:
+        app.config['UPLOAD_SESSION_TTL_S'] = 86400
+    rv = client.get(upload_url, headers={'Accept' : 'application/json'})
+    assert rv.status_code == 404
+    rv = client.delete(upload_url, headers={'Accept' : 'application/json'})
+    assert rv.status_code == 404
+    rv = client.delete(new_upload_url, headers={'Accept' : 'application/json'})
+    assert rv.status_code == 200
+    assert os.listdir(os.path.join("attachment_storage", "uploads")) == []
+
+
+@pytest.fixture
+def log_client():
+    """
+    Return new test client, which uses the log storage engine for the database.
+    """
+    db_fname = tempfile.mktemp() + ".json"
+    shutil.copy("db.json-example", db_fname)
+    app.config['DB_NAME']    = db_fname
+    app.config['DB_STORAGE'] = "log"
+    init_db()
+
+    yield app.test_client()
+
+    app.config['DB_STORAGE']           = "json"
+    app.config['DB_LOG_COMPACT_AFTER'] = 1000
+    init_db()   # close the database, so that we can remove its files
+    for fname in [db_fname, db_fname + ".log"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def test_log_storage(log_client):
+    db_fname  = app.config['DB_NAME']
+    log_fname = db_fname + ".log"
+    with open(db_fname) as f:
+        snapshot = f.read()
+
+    # Creating a comment only appends a record for the new comment and one for the record of
+    # the change to the log, both in a single batch
+    rv = log_client.post("/comments", **JSON_HDRS_READWRITE,
+                         data = json.dumps({"user_id"   : 1,
+                                            "ticket_id" : 1,
+                                            "text"      : "A logged comment",
+                                            "type"      : "COMMENT"}))
+    assert rv.is_json  and  rv.status_code == 201
+    with open(log_fname) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1
+    assert records[0]['op'] == "batch"
+    comment_record, change_record = records[0]['records']
+    assert comment_record['op'] == "set"
+    assert comment_record['table'] == "comments"
+    assert comment_record['id'] == "3"
+    assert comment_record['doc']['text'] == "A logged comment"
+    assert (change_record['table'], change_record['doc']['resource_id']) == ("changes", 3)
+    with open(db_fname) as f:
+        assert f.read() == snapshot
+
+    # Only the written documents are compared to find the changes
+    with mock.patch.object(LogStorage, "_diff", autospec=True,
+                           side_effect=LogStorage._diff) as diff:
+        rv = log_client.patch("/comments/3", **JSON_HDRS_READWRITE,
+                              data = json.dumps({"text" : "An edited comment"}))
+        assert rv.is_json  and  rv.status_code == 200
+    (_, changed, written), _ = diff.call_args
+    assert set(changed) == {"comments", "changes"}
+    assert written['comments'] == {"3"}
+    assert len(written['changes']) == 1
+    with open(log_fname) as f:
+        records = [json.loads(line) for line in f]
+    assert records[-1]['records'][0]['doc']['text'] == "An edited comment"
+
+    # The change survives a restart, which also compacts the log into the snapshot
+    init_db()
+    rv = log_client.get("/comments/3", **JSON_HDRS_READ)
+    assert rv.is_json  and  rv.status_code == 200
+    assert rv.get_json()['text'] == "An edited comment"
+    assert os.path.getsize(log_fname) == 0
+    with open(db_fname) as f:
+        assert json.load(f)['comments']['3']['text'] == "An edited comment"
+
+    # After the configured number of changes, the log is compacted
+    app.config['DB_LOG_COMPACT_AFTER'] = 2
+    init_db()
+    for text in ["first", "second"]:
+        rv = log_client.post("/comments", **JSON_HDRS_READWRITE,
+                             data = json.dumps({"user_id"   : 1,
+                                                "ticket_id" : 1,
+                                                "text"      : text,
+                                                "type"      : "COMMENT"}))
+        assert rv.is_json  and  rv.status_code == 201
+    assert os.path.getsize(log_fname) == 0
+    with open(db_fname) as f:
+        assert json.load(f)['comments']['5']['text'] == "second"
+
+    # An incomplete record at the end of the log is ignored
+    with open(log_fname, "a") as f:
+        f.write('{"op": "set", "table": "comments", "id": "6", "doc": {"te')
+    init_db()
+    rv = log_client.get("/comments/5", **JSON_HDRS_READ)
+    assert rv.is_json  and  rv.status_code == 200
+    rv = log_client.get("/comments/6", **JSON_HDRS_READ)
+    assert rv.status_code == 404
+
+
+@pytest.fixture
+def tables_client():
+    """
+    Return new test client, which uses the per-table storage engine for the database.
+    """
+    db_fname = tempfile.mktemp() + ".json"
+    shutil.copy("db.json-example", db_fname)
+    app.config['DB_NAME']    = db_fname
+    app.config['DB_STORAGE'] = "tables"
+    init_db()
+
+    yield app.test_client()
+
+    app.config['DB_STORAGE'] = "json"
+    init_db()
+    shutil.rmtree(db_fname + ".tables", ignore_errors=True)
+    os.remove(db_fname)
+
+
+def test_table_storage(tables_client):
+    dir_name = app.config['DB_NAME'] + ".tables"
+
+    def read_manifest():
+        with open(os.path.join(dir_name, "MANIFEST.json")) as f:
+            return json.load(f)
+
+    # The tables of the database file have been split into files of their own
+    manifest = read_manifest()
+    assert {"users", "customers", "tickets", "comments"} <= set(manifest['tables'])
+    assert set(os.listdir(dir_name)) == set(manifest['tables'].values()) | {"MANIFEST.json"}
+
+    # Creating a comment only writes new files for the comments table and for the table of
+    # changes, in which the new comment is recorded
+    rv = tables_client.post("/comments", **JSON_HDRS_READWRITE,
+                            data = json.dumps({"user_id"   : 1,
+                                               "ticket_id" : 1,
+                                               "text"      : "A stored comment",
+                                               "type"      : "COMMENT"}))
+    assert rv.is_json  and  rv.status_code == 201
+    new_manifest = read_manifest()
+    assert new_manifest['generation'] == manifest['generation'] + 1
+    assert {name for name in manifest['tables']
+            if manifest['tables'][name] != new_manifest['tables'][name]} == {"comments",
+                                                                              "changes"}
+    table_files = set(new_manifest['tables'].values())
+    assert set(os.listdir(dir_name)) == table_files | {"MANIFEST.json"}
+
+    # An update that removes fields consists of several writes, which are committed together
+    manifest = new_manifest
+    rv = tables_client.put("/users/1", **JSON_HDRS_READWRITE,
+                           data = json.dumps({"email" : ["foo123@foobar.com"]}))
+    assert rv.is_json  and  rv.status_code == 200
+    assert read_manifest()['generation'] == manifest['generation'] + 1
+
+    # A failed update doesn't commit anything
+    manifest = read_manifest()
+    rv = tables_client.put("/users/1", **JSON_HDRS_READWRITE,
+                           data = json.dumps({"email" : ["not-an-email"]}))
+    assert rv.status_code == 400
+    assert read_manifest() == manifest
+
+    # The changes survive a restart. Files of an unfinished commit are cleaned up.
+    with open(os.path.join(dir_name, "comments.999.json"), "w") as f:
+        f.write("{")
+    init_db()
+    assert "comments.999.json" not in os.listdir(dir_name)
+    rv = tables_client.get("/comments/3", **JSON_HDRS_READ)
+    assert rv.is_json  and  rv.status_code == 200
+    assert rv.get_json()['text'] == "A stored comment"
+    rv = tables_client.get("/users/1", **JSON_HDRS_READ)
+    assert rv.get_json()['email'] == ["foo123@foobar.com"]
+    assert "custom_fields" not in rv.get_json()
+
+
+def test_write_through(client):
+    if app.config['DB_BACKEND'] != "tinydb":
+        pytest.skip("only the TinyDB database is written to the JSON file")
+    db_fname = app.config['DB_NAME']
+
+    # By default, a change is in the file when the request returns
+    rv = client.post("/comments", **JSON_HDRS_READWRITE,
+                     data = json.dumps({"user_id"   : 1,
+                                        "ticket_id" : 1,
+                                        "text"      : "Written through",
+                                        "type"      : "COMMENT"}))
+    assert rv.is_json  and  rv.status_code == 201
+    with open(db_fname) as f:
+        assert json.load(f)['comments']['3']['text'] == "Written through"
+
+
+@pytest.fixture
+def write_behind_client():
+    """
+    Return new test client, which writes changes to the database in the background.
+    """
+    db_fname = tempfile.mktemp() + ".json"
+    shutil.copy("db.json-example", db_fname)
+    app.config['DB_NAME']               = db_fname
+    app.config['DB_FSYNC']              = "interval"
+    app.config['DB_FLUSH_INTERVAL_MS']  = 60000
+    app.config['DB_FLUSH_AFTER_WRITES'] = 2
+    init_db()
+
+    yield app.test_client()
+
+    app.config['DB_FSYNC']              = "always"
+    app.config['DB_FLUSH_INTERVAL_MS']  = 100
+    app.config['DB_FLUSH_AFTER_WRITES'] = 100
+    init_db()
+    os.remove(db_fname)
+
+
+def test_write_behind(write_behind_client):
+    db_fname = app.config['DB_NAME']
+
+    def stored_comments():
+        # The file may be in the middle of being written by the background thread
+        with open(db_fname) as f:
+            try:
+                return json.load(f)['comments']
+            except ValueError:
+                return {}
+
+    def post_comment(text):
+        rv = write_behind_client.post("/comments", **JSON_HDRS_READWRITE,
+                                      data = json.dumps({"user_id"   : 1,
+                                                         "ticket_id" : 1,
+                                                         "text"      : text,
+                                                         "type"      : "COMMENT"}))
+        assert rv.is_json  and  rv.status_code == 201
+        return rv.headers['Location']
+
+    # A new comment is visible right away, but not written to the file yet
+    url = post_comment("first")
+    rv  = write_behind_client.get(url, **JSON_HDRS_READ)
+    assert rv.is_json  and  rv.status_code == 200
+    assert rv.get_json()['text'] == "first"
+    assert "3" not in stored_comments()
+
+    # After the configured number of writes, they are flushed in the background
+    post_comment("second")
+    for _ in range(100):
+        if "4" in stored_comments():
+            break
+        time.sleep(0.05)
+    assert stored_comments()["3"]['text'] == "first"
+    assert stored_comments()["4"]['text'] == "second"
+
+    # Closing the database flushes outstanding writes
+    post_comment("third")
+    assert "5" not in stored_comments()
+    init_db()
+    assert stored_comments()["5"]['text'] == "third"